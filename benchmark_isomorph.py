@@ -0,0 +1,90 @@
+"""
+Compares the two ways HypergraphFlag.make_minimal_isomorph can find the minimal
+isomorph: partition refinement (the default) and trying every permutation.
+
+All graphs of order 7 to 9 are taken from nauty, given a random labelling and
+minimized by both methods. Since the permutation scan is slow at order 9, it is
+only run on a random sample of the graphs of each order; pass "all" as the
+first argument to run it on every graph. Random 3-graphs, oriented graphs and
+multigraphs are checked as well.
+
+Usage: sage -python benchmark_isomorph.py [sample size | all]
+"""
+
+from sage.all import *
+from flagmatic.all import *
+
+import random
+import sys
+import time
+
+random.seed(0)
+
+sample_size = 200
+if len(sys.argv) > 1:
+    sample_size = None if sys.argv[1] == "all" else int(sys.argv[1])
+
+
+def relabelled(g, cls):
+    perm = list(range(1, g.n + 1))
+    random.shuffle(perm)
+    h = cls()
+    h.n = g.n
+    for e in g.edges:
+        h.add_edge([perm[v - 1] for v in e])
+    return h
+
+
+def time_method(graphs, cls, method):
+    results = []
+    start = time.time()
+    for g in graphs:
+        h = cls(repr(g))
+        h.make_minimal_isomorph(method=method)
+        results.append(repr(h))
+    return time.time() - start, results
+
+
+def compare(name, graphs, cls):
+    sample = graphs
+    if sample_size is not None and len(graphs) > sample_size:
+        sample = random.sample(graphs, sample_size)
+    rt, rr = time_method(graphs, cls, "refinement")
+    srt, srr = time_method(sample, cls, "permutations")
+    rs = dict(zip(map(repr, graphs), rr))
+    mismatches = sum(1 for g, s in zip(sample, srr) if rs[repr(g)] != s)
+    sys.stdout.write("%-22s %7d graphs  refinement %8.3fs  permutations %8.3fs (%d graphs)  mismatches %d\n" %
+                     (name, len(graphs), rt, srt, len(sample), mismatches))
+    return mismatches
+
+
+def random_graph(cls, n, r, oriented, multiplicity=1):
+    g = cls()
+    g.n = n
+    p = random.random()
+    if oriented:
+        for e in Combinations(range(1, n + 1), 2):
+            if random.random() < p:
+                g.add_edge(e if random.random() < 0.5 else e[::-1])
+    else:
+        for e in Combinations(range(1, n + 1), r):
+            for i in range(multiplicity):
+                if random.random() < p:
+                    g.add_edge(e)
+    return g
+
+
+total = 0
+
+for n in range(7, 10):
+    family = [relabelled(GraphFlag(G), GraphFlag) for G in graphs.nauty_geng(str(n))]
+    total += compare("2-graphs, order %d" % n, family, GraphFlag)
+
+for n in range(7, 10):
+    total += compare("3-graphs, order %d" % n, [random_graph(ThreeGraphFlag, n, 3, False) for i in range(100)], ThreeGraphFlag)
+    total += compare("oriented, order %d" % n, [random_graph(OrientedGraphFlag, n, 2, True) for i in range(100)], OrientedGraphFlag)
+    total += compare("2-multigraphs, order %d" % n, [random_graph(TwoMultigraphFlag, n, 2, False, 2) for i in range(100)], TwoMultigraphFlag)
+
+if total > 0:
+    sys.stdout.write("The two methods disagree on %d graphs.\n" % total)
+    sys.exit(1)
@@ -0,0 +1,65 @@
+"""
+Checks that the two graph generation methods, "hash" and "augmentation", give the
+same graphs and flags. The cases cover forbidden subgraphs (including ones with an
+isolated vertex), forbidden induced subgraphs, forbidden edge numbers, 3-graphs,
+oriented graphs and multigraphs.
+
+Usage: sage -python check_generation.py [largest order]
+"""
+
+from sage.all import *
+from flagmatic.all import *
+
+import sys
+import time
+
+max_order = 6
+if len(sys.argv) > 1:
+    max_order = int(sys.argv[1])
+
+
+cases = [
+    ("2-graphs", GraphFlag, {}),
+    ("2-graphs, no K3", GraphFlag, {"forbidden_graphs": [GraphFlag("3:121323")]}),
+    ("2-graphs, no K3 + K1", GraphFlag, {"forbidden_graphs": [GraphFlag("4:121323")]}),
+    ("2-graphs, no induced P3", GraphFlag, {"forbidden_induced_graphs": [GraphFlag("3:1223")]}),
+    ("2-graphs, no induced 2K1", GraphFlag, {"forbidden_induced_graphs": [GraphFlag("2:")]}),
+    ("3-graphs, no K4-", ThreeGraphFlag, {"forbidden_graphs": [ThreeGraphFlag("4:123124134")]}),
+    ("3-graphs, edge numbers", ThreeGraphFlag, {"forbidden_edge_numbers": [(4, 3), (4, 4)]}),
+    ("oriented, no C3", OrientedGraphFlag, {"forbidden_graphs": [OrientedGraphFlag("3:122331")]}),
+    ("oriented, no induced 2K1", OrientedGraphFlag, {"forbidden_induced_graphs": [OrientedGraphFlag("2:")]}),
+    ("2-multigraphs", TwoMultigraphFlag, {}),
+    ("2-multigraphs, no double K3", TwoMultigraphFlag, {"forbidden_graphs": [TwoMultigraphFlag("3:121213132323")]}),
+]
+
+
+def generated(cls, n, tg, method, forbidden):
+    start = time.time()
+    if tg is None:
+        graphs = cls.generate_graphs(n, method=method, **forbidden)
+    else:
+        graphs = cls.generate_flags(n, tg, method=method, **forbidden)
+    names = [repr(g) for g in graphs]
+    return time.time() - start, names
+
+
+def compare(name, cls, n, tg, forbidden):
+    ht, hn = generated(cls, n, tg, "hash", forbidden)
+    at, an = generated(cls, n, tg, "augmentation", forbidden)
+    ok = sorted(hn) == sorted(an) and len(set(an)) == len(an)
+    sys.stdout.write("%-30s order %d%s  %6d graphs  hash %7.3fs  augmentation %7.3fs  %s\n" %
+                     (name, n, "" if tg is None else " type %s" % tg, len(hn), ht, at, "ok" if ok else "MISMATCH"))
+    return 0 if ok else 1
+
+
+total = 0
+
+for name, cls, forbidden in cases:
+    for n in range(2, max_order + 1):
+        total += compare(name, cls, n, None, forbidden)
+    for tg in cls.generate_graphs(2, **forbidden):
+        total += compare(name, cls, max_order - 1, tg, forbidden)
+
+if total > 0:
+    sys.stdout.write("The two methods disagree in %d cases.\n" % total)
+    sys.exit(1)
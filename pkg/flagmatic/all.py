@@ -37,6 +37,8 @@ from .oriented_graph_flag import *
 from .multigraph_flag import *
 
 from .problem import *
+from .cache import set_cache, clear_cache, set_table_cache, clear_table_cache, table_cache_stats
+from .parallel import configure_pool, close_pool
 
 from .construction import *
 from .blowup_construction import *
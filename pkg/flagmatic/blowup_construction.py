@@ -40,7 +40,9 @@ from copy import copy
 from .three_graph_flag import *
 from .graph_flag import *
 from .oriented_graph_flag import *
+from .hypergraph_flag import make_graph_block
 from .construction import *
+from .parallel import get_pool, chunked_map
 
 from tqdm import tqdm
 
@@ -52,6 +54,7 @@ def zero_eigenvectors_mp(tg, flags, tv, graph, cn, k, s, weights):
 
     total = Integer(0)
     row = [0] * len(flags)
+    flags_block = make_graph_block(flags, k)
 
     for ov in UnorderedTuples(range(1, cn + 1), k - s):
 
@@ -61,17 +64,16 @@ def zero_eigenvectors_mp(tg, flags, tv, graph, cn, k, s, weights):
 
         if weights:
             for v in ov:
-                factor *= self._weights[v - 1]
+                factor *= weights[v - 1]
 
         ig = graph.degenerate_induced_subgraph(tv + ov)
         ig.t = s
         ig.make_minimal_isomorph()
 
-        for j in range(len(flags)):
-            if ig.is_labelled_isomorphic(flags[j]):
-                row[j] += factor
-                total += factor
-                break
+        j = flags_block.index(ig)
+        if j != -1:
+            row[j] += factor
+            total += factor
 
     for j in range(len(flags)):
         row[j] /= total
@@ -127,16 +129,14 @@ def symm_subgraph_densities_mp(P, graph, factor):
     
 class BlowupConstruction(Construction):
 
-    def __init__(self, g, weights=None, field=None, phantom_edge=None, no_symmetry=False, use_mp=True, nauty_presort=True):
+    def __init__(self, g, weights=None, field=None, phantom_edge=None, no_symmetry=False, use_mp=True, nauty_presort=True, pool=None):
 
         self.tuple_orbit_reps_dict = {}
 
         self.nauty_presort = nauty_presort
 
-        self.pool = None
-        if use_mp:
-            import multiprocessing as mp
-            self.pool = mp.Pool()
+        self._pool = pool
+        self._use_mp = use_mp
             
         if g.oriented and g.is_degenerate:
             raise NotImplementedError("degenerate oriented graphs not supported.")
@@ -171,6 +171,17 @@ class BlowupConstruction(Construction):
                 if type(g) is GraphFlag or type(g) is OrientedGraphFlag:
                     self._use_symmetry = True
 
+    @property
+    def pool(self):
+        r"""
+        The worker pool to use, or None. Unless a pool was given, this is the shared pool,
+        fetched each time it is needed, so that a later ``configure_pool`` takes effect.
+        """
+        pool = getattr(self, "_pool", None)
+        if pool is None and getattr(self, "_use_mp", False):
+            pool = get_pool()
+        return pool
+
     @property
     def graph(self):
         return self._graph
@@ -199,9 +210,9 @@ class BlowupConstruction(Construction):
         if self.pool is not None:
             if self.nauty_presort and not hasattr(self, "_phantom_edge"):
                 print(f"Nauty presort ...")
-                arguments = [(P, n, cn, self._weights, self._graph) for P in UnorderedTuples(range(1, cn + 1), n)]
+                tuples = UnorderedTuples(range(1, cn + 1), n)
                 factor_dict, P_dict = {}, {}
-                for ghash, factor, P in self.pool.starmap(subgraph_densities_presort_mp, tqdm(arguments)):
+                for ghash, factor, P in chunked_map(self.pool, subgraph_densities_presort_mp, tuples, (n, cn, self._weights, self._graph), show_progress=True):
                     if ghash not in P_dict.keys():
                         P_dict[ghash] = P
                     factor_dict[ghash] = factor_dict.get(ghash, 0) + factor
@@ -217,8 +228,9 @@ class BlowupConstruction(Construction):
                     total += factor
                 
             else:
-                arguments = [(P, n, cn, self._weights, self._graph, self._phantom_edge if hasattr(self, "_phantom_edge") else None) for P in UnorderedTuples(range(1, cn + 1), n)]
-                for ghash, ig, gchash, igc, factor, contains_phantom_edge in self.pool.starmap(subgraph_densities_mp, tqdm(arguments)):
+                tuples = UnorderedTuples(range(1, cn + 1), n)
+                shared = (n, cn, self._weights, self._graph, self._phantom_edge if hasattr(self, "_phantom_edge") else None)
+                for ghash, ig, gchash, igc, factor, contains_phantom_edge in chunked_map(self.pool, subgraph_densities_mp, tuples, shared, show_progress=True):
                     if ghash in sharp_graph_counts:
                         sharp_graph_counts[ghash] += factor
                     else:
@@ -278,6 +290,7 @@ class BlowupConstruction(Construction):
         k = flags[0].n  # assume all flags the same order
 
         rows = []
+        flags_block = make_graph_block(flags, k)
         
         if self.pool is not None:
             assert not hasattr(self, "_phantom_edge")
@@ -323,11 +336,10 @@ class BlowupConstruction(Construction):
                     ig.t = s
                     ig.make_minimal_isomorph()
 
-                    for j in range(len(flags)):
-                        if ig.is_labelled_isomorphic(flags[j]):
-                            row[j] += factor
-                            total += factor
-                            break
+                    j = flags_block.index(ig)
+                    if j != -1:
+                        row[j] += factor
+                        total += factor
 
                 for j in range(len(flags)):
                     row[j] /= total
@@ -428,6 +440,7 @@ class BlowupConstruction(Construction):
         t_total, t_orb_reps = self.tuple_orbit_reps(s)
 
         rows = []
+        flags_block = make_graph_block(flags, k)
         
         # TODO: mp option
         
@@ -449,10 +462,9 @@ class BlowupConstruction(Construction):
                     ig.t = s
                     ig.make_minimal_isomorph()
 
-                    for j in range(len(flags)):
-                        if ig.is_labelled_isomorphic(flags[j]):
-                            row[j] += Integer(factor) / total
-                            break
+                    j = flags_block.index(ig)
+                    if j != -1:
+                        row[j] += Integer(factor) / total
 
                 rows.append(row)
 
@@ -0,0 +1,331 @@
+"""
+
+flagmatic 2
+
+Copyright (c) 2012, E. R. Vaughan. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1) Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+
+2) Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation and/or
+other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Further development of Flagmatic is supported by ERC.
+http://cordis.europa.eu/project/rcn/104324_en.html
+"""
+
+import hashlib, os, shutil, sys, zipfile
+from collections import OrderedDict
+import numpy
+
+# Bump this if the way graphs are generated or stored changes.
+cache_format_version = 2
+
+cache_enabled = True
+cache_directory = os.environ.get("FLAGMATIC_CACHE_DIR",
+                                 os.path.join(os.path.expanduser("~"), ".flagmatic", "cache"))
+
+
+def set_cache(enabled=True, directory=None):
+    r"""
+    Turns the on-disk cache of graphs and flags on or off, and optionally changes the
+    directory in which it is kept. The directory can also be set with the environment
+    variable FLAGMATIC_CACHE_DIR.
+    """
+    global cache_enabled, cache_directory
+    cache_enabled = enabled
+    if not directory is None:
+        cache_directory = directory
+
+
+def clear_cache():
+    r"""
+    Deletes everything in the cache directory.
+    """
+    if os.path.isdir(cache_directory):
+        shutil.rmtree(cache_directory)
+
+
+def cache_key(*items):
+    r"""
+    Returns a hex digest identifying items. Lists are sorted first, so that the order in
+    which forbidden graphs are given does not matter.
+    """
+    parts = [str(cache_format_version)]
+    for item in items:
+        if isinstance(item, (list, tuple)):
+            parts.append("[" + ",".join(sorted(str(x) for x in item)) + "]")
+        else:
+            parts.append(str(item))
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def cache_filename(key, suffix=".npz"):
+    return os.path.join(cache_directory, key[:2], key + suffix)
+
+
+def graphs_key(flag_cls, order, tg, forbidden_edge_numbers, forbidden_graphs, forbidden_induced_graphs):
+    return cache_key("graphs", flag_cls.__name__, order, tg, forbidden_edge_numbers,
+                     forbidden_graphs, forbidden_induced_graphs)
+
+
+def pack_graphs(graphs):
+    r"""
+    Returns (header, numbers, edges) for a list of flags of the same order and number of
+    labelled vertices: header holds n, t, r and whether every flag is known to be a
+    minimal isomorph, numbers the number of edges of each flag, and edges the vertices of
+    all the edges packed into one array of bytes.
+    """
+    if hasattr(graphs, "pack"):
+        return graphs.pack()
+    n = graphs[0].n if len(graphs) > 0 else 0
+    t = graphs[0].t if len(graphs) > 0 else 0
+    r = graphs[0].r if len(graphs) > 0 else 0
+    minimal = all(g._certified_minimal_isomorph for g in graphs)
+    header = numpy.array([n, t, r, minimal], dtype=numpy.int32)
+    numbers = numpy.array([g.ne for g in graphs], dtype=numpy.int32)
+    edges = numpy.array([v for g in graphs for e in g.edges for v in e], dtype=numpy.uint8)
+    return header, numbers, edges
+
+
+def unpack_graphs(flag_cls, header, numbers, edges):
+    r"""
+    Inverse of pack_graphs. If the header says so, the flags are marked as minimal
+    isomorphs again, so that comparing them does not recompute their minimal isomorphs.
+    """
+    from .hypergraph_flag import certify_minimal_isomorph
+    n, t, r, minimal = [int(x) for x in header]
+    graphs = []
+    pos = 0
+    for ne in numbers:
+        g = flag_cls()
+        g.n = n
+        for i in range(int(ne)):
+            g.add_edge(tuple(int(v) for v in edges[pos:pos + r]))
+            pos += r
+        g.t = t
+        if minimal:
+            certify_minimal_isomorph(g)
+        graphs.append(g)
+    return graphs
+
+
+def save_graphs(key, graphs):
+    r"""
+    Stores a list of flags of the same order and number of labelled vertices.
+    """
+    header, numbers, edges = pack_graphs(graphs)
+
+    filename = cache_filename(key)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with open(temp_filename, "wb") as f:
+        numpy.savez_compressed(f, header=header, numbers=numbers, edges=edges)
+    os.replace(temp_filename, filename)
+
+
+def load_graphs(key, flag_cls, compact=False):
+    r"""
+    Returns the list of flags stored under key, or None if there is no such list. If
+    compact is True, the flags are returned as a PackedGraphs over the stored arrays, so
+    that they are never all unpacked at once.
+    """
+    filename = cache_filename(key)
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        with numpy.load(filename) as data:
+            header = data["header"]
+            numbers = data["numbers"]
+            edges = data["edges"]
+    except (IOError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        sys.stdout.write("Ignoring unreadable cache file %s.\n" % filename)
+        return None
+
+    if compact:
+        from .hypergraph_flag import PackedGraphs
+        return PackedGraphs.from_arrays(flag_cls, header, numbers, edges)
+    return unpack_graphs(flag_cls, header, numbers, edges)
+
+
+def lookup_graphs(flag_cls, order, tg, forbidden_edge_numbers, forbidden_graphs, forbidden_induced_graphs,
+                  compact=False):
+    r"""
+    Returns the cached flags of the given order and type (or the unlabelled graphs if tg
+    is None), or None if they are not in the cache or the cache is turned off. See
+    load_graphs for compact.
+    """
+    if not cache_enabled:
+        return None
+    key = graphs_key(flag_cls, order, tg, forbidden_edge_numbers, forbidden_graphs, forbidden_induced_graphs)
+    return load_graphs(key, flag_cls, compact=compact)
+
+
+def store_graphs(flag_cls, order, tg, forbidden_edge_numbers, forbidden_graphs, forbidden_induced_graphs, graphs):
+    r"""
+    Puts flags into the cache, so that lookup_graphs can find them later.
+    """
+    if not cache_enabled:
+        return
+    key = graphs_key(flag_cls, order, tg, forbidden_edge_numbers, forbidden_graphs, forbidden_induced_graphs)
+    try:
+        save_graphs(key, graphs)
+    except (IOError, OSError):
+        sys.stdout.write("Could not write to cache directory %s.\n" % cache_directory)
+
+
+def graphs_digest(graphs):
+    r"""
+    Returns a hex digest of a list of graphs, taking their order into account.
+    """
+    h = hashlib.sha256()
+    for g in graphs:
+        h.update(str(g).encode("utf-8"))
+        h.update(b";")
+    return h.hexdigest()
+
+
+def products_key(flag_cls, graphs_hash, tg, flags_hash):
+    return cache_key("products", flag_cls.__name__, graphs_hash, tg, flags_hash)
+
+
+def lookup_products(key):
+    r"""
+    Returns the cached product array stored under key, memory-mapped read-only, or None
+    if there is no such array or the cache is turned off.
+    """
+    if not cache_enabled:
+        return None
+    filename = cache_filename(key, ".npy")
+    if not os.path.exists(filename):
+        return None
+    try:
+        return numpy.load(filename, mmap_mode="r")
+    except (IOError, ValueError):
+        sys.stdout.write("Ignoring unreadable cache file %s.\n" % filename)
+        return None
+
+
+def store_products(key, rarray):
+    r"""
+    Puts a product array into the cache. It is stored uncompressed so that it can be
+    memory-mapped when it is read back.
+    """
+    if not cache_enabled:
+        return
+    filename = cache_filename(key, ".npy")
+    try:
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        with open(temp_filename, "wb") as f:
+            numpy.save(f, rarray)
+        os.replace(temp_filename, filename)
+    except (IOError, OSError):
+        sys.stdout.write("Could not write to cache directory %s.\n" % cache_directory)
+
+
+class TableCache(object):
+    r"""
+    An in-memory cache of the combinatorial tables (permutations, combinations and
+    arrangements of vertices) used by the flag algorithms. Tables are stored as read-only
+    numpy arrays; once more than ``limit`` bytes are held, the least recently used tables
+    are dropped. A table that is dropped while still in use stays alive until it is no
+    longer referenced.
+
+    Tables built before the worker pool is started are inherited by forked workers; as
+    they are never written to, their pages stay shared.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.tables = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, build, *args):
+        r"""
+        Returns the table stored under key, calling build(*args) to make it if necessary.
+        """
+        table = self.tables.get(key)
+        if table is not None:
+            self.tables.move_to_end(key)
+            self.hits += 1
+            return table
+
+        self.misses += 1
+        table = numpy.ascontiguousarray(build(*args))
+        table.flags.writeable = False
+        self.tables[key] = table
+        self.nbytes += table.nbytes
+        self.shrink()
+        return table
+
+    def shrink(self):
+        r"""
+        Drops the least recently used tables until at most limit bytes are held. The most
+        recently used table is always kept.
+        """
+        while self.nbytes > self.limit and len(self.tables) > 1:
+            key, table = self.tables.popitem(last=False)
+            self.nbytes -= table.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self.tables.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {"tables": len(self.tables), "bytes": self.nbytes, "limit": self.limit,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+table_cache = TableCache(int(os.environ.get("FLAGMATIC_TABLE_CACHE_BYTES", 256 * 2 ** 20)))
+
+
+def set_table_cache(limit):
+    r"""
+    Sets the number of bytes of combinatorial tables that are kept in memory. The limit
+    can also be set with the environment variable FLAGMATIC_TABLE_CACHE_BYTES, and
+    applies separately to each worker process.
+    """
+    table_cache.limit = limit
+    table_cache.shrink()
+
+
+def clear_table_cache():
+    r"""
+    Drops all the combinatorial tables held in memory, and resets the counts returned by
+    table_cache_stats.
+    """
+    table_cache.clear()
+
+
+def table_cache_stats():
+    r"""
+    Returns a dictionary with the number of tables and bytes held in memory, the limit,
+    and the number of hits, misses and evictions so far.
+    """
+    return table_cache.stats()
@@ -46,18 +46,37 @@ cdef class HypergraphFlag (Flag):
     cdef int _edges[MAX_NUMBER_OF_EDGE_INTS]
     cpdef is_labelled_isomorphic(self, HypergraphFlag other)
     cdef HypergraphFlag c_induced_subgraph(self, int *verts, int num_verts)
+    cdef int c_induced_edges(self, int *verts, int num_verts, int *edges)
     cdef int c_has_subgraph (self, HypergraphFlag h)
 
 cdef class combinatorial_info_block:
-    cdef int np
-    cdef int *p
+    cdef int np, width
+    cdef unsigned char *p
+    cdef object table
 
-cdef int *generate_permutations_fixing(int n, int s, int *number_of)
-cdef int *generate_combinations(int n, int s, int *number_of)
-cdef int *generate_combinations_plus(int n, int s, int *number_of)
-cdef int *generate_pair_combinations(int n, int s, int m1, int m2, int *number_of)
-cdef int *generate_equal_pair_combinations(int n, int s, int m, int *number_of)
+cdef combinatorial_info_block generate_permutations_fixing(int n, int s)
+cdef combinatorial_info_block generate_combinations(int n, int s)
+cdef combinatorial_info_block generate_combinations_plus(int n, int s)
+cdef combinatorial_info_block generate_pair_combinations(int n, int s, int m1, int m2)
+cdef combinatorial_info_block generate_equal_pair_combinations(int n, int s, int m)
 
 cdef class graph_block:
     cdef int n, len
+    cdef object source
     cdef void **graphs
+    cdef int *table
+    cdef int table_size
+    cdef int find(self, HypergraphFlag g)
+
+cdef class induced_flag_index:
+    cdef readonly int n, s, m, first, last
+    cdef int num_embeddings, num_subsets
+    cdef int *ids
+    cdef list flags
+
+cdef class PackedGraphs:
+    cdef readonly object flag_cls
+    cdef readonly int n, t, r, multiplicity
+    cdef readonly bint oriented, minimal
+    cdef int first, length
+    cdef object numbers, offsets, edges
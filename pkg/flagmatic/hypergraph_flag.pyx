@@ -46,14 +46,16 @@ DEF MAX_NUMBER_OF_VERTICES = 35
 
 
 from libc.stdlib cimport malloc, calloc, realloc, free
-from libc.string cimport memset
+from libc.string cimport memset, memcpy
 
 import sys # remove this, just for testing
 import numpy
 cimport numpy
 
 from tqdm import tqdm
-import multiprocessing as mp
+
+from .parallel import get_pool, chunked_map
+from .cache import table_cache
 
 from sage.arith.all import binomial, falling_factorial
 from sage.combinat.all import Combinations, Permutations, Tuples, Subsets
@@ -99,6 +101,84 @@ def process_small_graphs_mp(sg, n, s, max_ne, possible_edges, oriented, forbidde
                         hash_list.append(ng_hash)
                         
     return graph_list, hash_list
+
+
+def augment_small_graph_mp(sg, n, s, max_ne, possible_edges, oriented, forbidden_edge_numbers, forbidden_graphs, forbidden_induced_graphs):
+    # Canonical augmentation: a graph is kept only if sg is its canonical parent, i.e. if
+    # deleting its highest numbered unlabelled vertex of maximum degree (in the minimal
+    # isomorph) leaves a graph isomorphic to sg. Each graph then has exactly one parent,
+    # so only the children of sg need to be compared with each other.
+    parent = sg.__copy__()
+    parent.make_minimal_isomorph()
+    ds = sg.degrees()
+    maxd = max(ds[s:] + (0,))
+
+    graph_list, hash_list = [], set()
+
+    def consider(ng, ne):
+
+            # The new vertex must be an unlabelled vertex of maximum degree.
+            if ne < maxd or max(ng.degrees()[s:]) > ne:
+                    return
+
+            if not forbidden_edge_numbers is None and ng.has_forbidden_edge_numbers(forbidden_edge_numbers, must_have_highest=True):
+                    return
+
+            if not forbidden_induced_graphs is None and ng.has_forbidden_graphs(forbidden_induced_graphs, must_have_highest=True, induced=True):
+                    return
+
+            ng = ng.__copy__()
+            ng.make_minimal_isomorph()
+
+            if n - 1 > s:
+                    nds = ng.degrees()
+                    c = max(v for v in range(s + 1, n + 1) if nds[v - 1] == ne)
+                    pg = ng.induced_subgraph([v for v in range(1, n + 1) if v != c])
+                    pg.t = s
+                    pg.make_minimal_isomorph()
+                    if not pg.is_labelled_isomorphic(parent):
+                            return
+
+            ng_hash = hash(ng)
+            if ng_hash not in hash_list:
+                graph_list.append(ng)
+                hash_list.add(ng_hash)
+
+    # Edges are added one at a time. Containing a forbidden subgraph is preserved by adding
+    # edges, so once it happens none of the larger edge sets need to be looked at. The
+    # check is made on each graph before it is extended, so that the graph with no new
+    # edges is checked too (a forbidden graph may have an isolated vertex).
+    def extend(ng, ne, first, chosen):
+
+            if not forbidden_graphs is None and ng.has_forbidden_graphs(forbidden_graphs, must_have_highest=True):
+                    return
+
+            consider(ng, ne)
+
+            if ne == max_ne or ne + len(possible_edges) - first < maxd:
+                    return
+
+            for i in range(first, len(possible_edges)):
+
+                    e = possible_edges[i]
+
+                    # Repeated edges (multigraphs) are taken in order.
+                    if i > first and e == possible_edges[i - 1]:
+                            continue
+
+                    # For oriented graphs, can't have bidirected edges.
+                    if oriented and (e[1], e[0]) in chosen:
+                            continue
+
+                    nng = ng.__copy__()
+                    nng.add_edge(e)
+                    extend(nng, ne + 1, i + 1, chosen + [e])
+
+    ng = sg.__copy__()
+    ng.n = n
+    extend(ng, 0, 0, [])
+
+    return graph_list, list(hash_list)
     
 
 cdef class HypergraphFlag (Flag):
@@ -518,7 +598,7 @@ cdef class HypergraphFlag (Flag):
         
 
         @classmethod
-        def generate_flags(cls, n, tg, r=3, oriented=False, multiplicity=1, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None, use_mp=False, show_progress=False):
+        def generate_flags(cls, n, tg, r=3, oriented=False, multiplicity=1, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None, use_mp=False, show_progress=False, method="hash", pool=None):
                 """
                 For an integer n, and a type tg, returns a list of all tg-flags on n
                 vertices, that satisfy certain constraints.
@@ -531,6 +611,15 @@ cdef class HypergraphFlag (Flag):
                 forbidden_induced_subgraphs should be a list of graphs that are forbidden as
                 _induced_ subgraphs.
                 
+                method should be "hash" or "augmentation". With "hash", every extension of
+                every smaller graph is kept unless an isomorphic graph has already been
+                found. With "augmentation", an extension is only kept if the smaller graph
+                is its canonical parent, so each isomorphism class is produced once. The
+                same graphs are returned either way, but possibly in a different order.
+                
+                If use_mp is True, the work is done by pool, or by the shared pool (see
+                configure_pool) if pool is None.
+                
                 EXAMPLES:
                 
                 
@@ -551,6 +640,9 @@ cdef class HypergraphFlag (Flag):
                 if tg.t != 0:
                         raise NotImplementedError("type must not contain labelled vertices.")
         
+                if not method in ["hash", "augmentation"]:
+                        raise ValueError
+
                 s = tg.n
         
                 if n < s:
@@ -568,7 +660,7 @@ cdef class HypergraphFlag (Flag):
                 hashes = set()
                 
                 smaller_graphs = cls.generate_flags(n - 1, tg, r, oriented, multiplicity, forbidden_edge_numbers=forbidden_edge_numbers,
-                        forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs, use_mp=use_mp)
+                        forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs, use_mp=use_mp, method=method, pool=pool)
                 
                 possible_edges = []
         
@@ -585,20 +677,29 @@ cdef class HypergraphFlag (Flag):
                 if multiplicity > 1:
                         possible_edges = sum(([e] * multiplicity for e in possible_edges), [])
                 
+                if method == "augmentation":
+                    process = augment_small_graph_mp
+                else:
+                    process = process_small_graphs_mp
+
                 if use_mp:
-                    arguments = [(sg, n, s, max_ne, possible_edges, oriented, forbidden_edge_numbers, forbidden_graphs, forbidden_induced_graphs) for sg in smaller_graphs]
+                    shared = (n, s, max_ne, possible_edges, oriented, forbidden_edge_numbers, forbidden_graphs, forbidden_induced_graphs)
 
-                    p = mp.Pool()
-                    for graph_list, hash_list in p.starmap(process_small_graphs_mp, tqdm(arguments) if show_progress else arguments):
+                    for graph_list, hash_list in chunked_map(get_pool() if pool is None else pool, process, smaller_graphs, shared, show_progress=show_progress):
+                        if method == "augmentation":
+                            new_graphs.extend(graph_list)
+                            continue
                         for ng, ng_hash in zip(graph_list, hash_list):
                             if not ng_hash in hashes:
                                 new_graphs.append(ng)
                                 hashes.add(ng_hash)
-                    p.close()
                 
                 else:
                     for sg in (tqdm(smaller_graphs) if show_progress else smaller_graphs):
-                        graph_list, hash_list = process_small_graphs_mp(sg, n, s, max_ne, possible_edges, oriented, forbidden_edge_numbers, forbidden_graphs, forbidden_induced_graphs)
+                        graph_list, hash_list = process(sg, n, s, max_ne, possible_edges, oriented, forbidden_edge_numbers, forbidden_graphs, forbidden_induced_graphs)
+                        if method == "augmentation":
+                            new_graphs.extend(graph_list)
+                            continue
                         for ng, ng_hash in zip(graph_list, hash_list):
                             if not ng_hash in hashes:
                                 new_graphs.append(ng)
@@ -644,9 +745,9 @@ cdef class HypergraphFlag (Flag):
 
 
         @classmethod
-        def generate_graphs(cls, n, r=3, oriented=False, multiplicity=1, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None, use_mp=False, show_progress=False):
+        def generate_graphs(cls, n, r=3, oriented=False, multiplicity=1, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None, use_mp=False, show_progress=False, method="hash", pool=None):
                 return cls.generate_flags(n, cls(r=r, oriented=oriented, multiplicity=multiplicity), r, oriented, multiplicity, forbidden_edge_numbers=forbidden_edge_numbers,
-                        forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs, use_mp=use_mp, show_progress=show_progress)
+                        forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs, use_mp=use_mp, show_progress=show_progress, method=method, pool=pool)
 
 
         @classmethod
@@ -845,6 +946,78 @@ cdef class HypergraphFlag (Flag):
                 return Integer(found) / total
 
 
+        @classmethod
+        def subgraph_census(cls, graphs, k):
+                """
+                Counts the induced subgraphs of order k of each of the given graphs, which
+                must all have the same order n, in one pass. Returns a pair (subgraphs, rows):
+                subgraphs is a list of the different (unlabelled, minimal) induced subgraphs
+                that were found, and rows is an int64 array with a row (gi, hi, count) for
+                each graph gi and subgraph hi that it contains, count being the number of
+                k-sets of vertices that induce it. So the density of subgraphs[hi] in
+                graphs[gi] is count / binomial(n, k).
+
+                Each induced subgraph is looked up by its labelled edges, so that it is only
+                made minimal the first time that those edges are seen.
+                """
+
+                cdef combinatorial_info_block cib
+                cdef unsigned char *c
+                cdef int nc, i, gi, ne, edge_bytes, n = -1
+                cdef int edges[MAX_NUMBER_OF_EDGE_INTS]
+                cdef int verts[MAX_NUMBER_OF_VERTICES]
+                cdef HypergraphFlag g, ig
+
+                subgraphs = []
+                canonical_indices = {}
+                labelled_indices = {}
+                rows = []
+
+                for gi in range(len(graphs)):
+
+                        g = <HypergraphFlag ?> graphs[gi]
+
+                        if g.is_degenerate:
+                                raise NotImplementedError("degenerate graphs are not supported.")
+                        if n == -1:
+                                n = g._n
+                                if k < 0 or k > n:
+                                        raise ValueError("k must be between 0 and the order of the graphs.")
+                                cib = generate_combinations(n, k)
+                                c = cib.p
+                                nc = cib.np
+                        elif g._n != n:
+                                raise ValueError("graphs must all have the same order.")
+
+                        edge_bytes = g._r * sizeof(int)
+                        counts = {}
+
+                        for i in range(nc):
+
+                                load_vertices(verts, &c[i * k], k)
+                                ne = g.c_induced_edges(verts, k, edges)
+                                key = (<char *> edges)[:ne * edge_bytes]
+                                hi = labelled_indices.get(key)
+
+                                if hi is None:
+                                        ig = g.c_induced_subgraph(verts, k)
+                                        ig.make_minimal_isomorph()
+                                        canonical_key = (<char *> ig._edges)[:ig.ne * edge_bytes]
+                                        hi = canonical_indices.get(canonical_key)
+                                        if hi is None:
+                                                hi = len(subgraphs)
+                                                canonical_indices[canonical_key] = hi
+                                                subgraphs.append(ig)
+                                        labelled_indices[key] = hi
+
+                                counts[hi] = counts.get(hi, 0) + 1
+
+                        for hi in sorted(counts):
+                                rows.append((gi, hi, counts[hi]))
+
+                return subgraphs, numpy.array(rows, dtype=numpy.int64).reshape(-1, 3)
+
+
         def complement(self, minimal=False):
                 """
                 Returns the complement of the graph. Not implemented for oriented graphs.
@@ -978,14 +1151,21 @@ cdef class HypergraphFlag (Flag):
                 raw_minimize_edges(self._edges, self.ne, self._r, self._oriented)
 
 
-        def make_minimal_isomorph(self):
+        def make_minimal_isomorph(self, method="refinement"):
+                """
+                Relabels the unlabelled vertices so that the sorted edge list is
+                lexicographically minimal. By default the search is pruned using
+                partition refinement; method="permutations" tries every permutation
+                of the unlabelled vertices instead. Both give the same result.
+                """
 
                 cdef int i
                 cdef int *new_edges
                 cdef int *winning_edges
                 cdef int *e
                 
-                cdef int *p
+                cdef combinatorial_info_block cib
+                cdef unsigned char *p
                 cdef int np
                 cdef int is_lower
                                 
@@ -993,11 +1173,21 @@ cdef class HypergraphFlag (Flag):
                 
                 if self._certified_minimal_isomorph:
                         return
+
+                if not method in ["refinement", "permutations"]:
+                        raise ValueError("method must be 'refinement' or 'permutations'.")
+
+                if method == "refinement" and self._n - self._t > 3:
+                        if canonical_minimize_edges(self._edges, self.ne, self._n, self._t, self._r, self._oriented):
+                                self._certified_minimal_isomorph = True
+                                return
                 
                 new_edges = <int *> malloc (sizeof(int) * self._r * self.ne)
                 winning_edges = <int *> malloc (sizeof(int) * self._r * self.ne)
                 
-                p = generate_permutations_fixing(self._n, self._t, &np)
+                cib = generate_permutations_fixing(self._n, self._t)
+                p = cib.p
+                np = cib.np
         
                 for i in range(np):
                 
@@ -1058,11 +1248,6 @@ cdef class HypergraphFlag (Flag):
 
         cdef HypergraphFlag c_induced_subgraph(self, int *verts, int num_verts):
 
-                cdef int nm = 0, i, j
-                cdef int *e
-                cdef int got
-                cdef int te[3]
-                
                 cdef HypergraphFlag ig = type(self)()
 
                 if self.is_degenerate:
@@ -1074,6 +1259,23 @@ cdef class HypergraphFlag (Flag):
                 ig.multiplicity = self._multiplicity
                 ig.t = 0
 
+                ig.ne = self.c_induced_edges(verts, num_verts, ig._edges)
+                ig.minimize_edges()
+                return ig
+
+
+        cdef int c_induced_edges(self, int *verts, int num_verts, int *edges):
+                """
+                Writes the edges of the subgraph induced by verts, relabelled 1, ..., num_verts,
+                to edges, and returns their number. If verts is increasing, and the edges of
+                this graph are in order, then so are the written edges.
+                """
+
+                cdef int nm = 0, i, j
+                cdef int *e
+                cdef int got
+                cdef int te[3]
+
                 if self._r == 3:
                 
                         for i in range(self.ne):
@@ -1090,7 +1292,7 @@ cdef class HypergraphFlag (Flag):
                                                 got += 1
                                                 te[2] = j + 1
                                 if got == 3:
-                                        e = &ig._edges[3 * nm]
+                                        e = &edges[3 * nm]
                                         e[0] = te[0]
                                         e[1] = te[1]
                                         e[2] = te[2]
@@ -1109,14 +1311,12 @@ cdef class HypergraphFlag (Flag):
                                                 got += 1
                                                 te[1] = j + 1
                                 if got == 2:
-                                        e = &ig._edges[2 * nm]
+                                        e = &edges[2 * nm]
                                         e[0] = te[0]
                                         e[1] = te[1]
                                         nm += 1
 
-                ig.ne = nm
-                ig.minimize_edges()
-                return ig
+                return nm
         
 
         cdef int c_has_subgraph (self, HypergraphFlag h):
@@ -1125,7 +1325,8 @@ cdef class HypergraphFlag (Flag):
                 """
         
                 cdef int i, j, k, l
-                cdef int *p
+                cdef combinatorial_info_block cib
+                cdef unsigned char *p
                 cdef int np
                 cdef int *new_edges
                 cdef int *can_use
@@ -1140,7 +1341,9 @@ cdef class HypergraphFlag (Flag):
                 new_edges = <int *> malloc (sizeof(int) * self._r * self.ne)
                 can_use = <int *> malloc (sizeof(int) * self.ne)
                 
-                p = generate_permutations(self._n, &np)
+                cib = generate_permutations(self._n)
+                p = cib.p
+                np = cib.np
         
                 for i in range(np):
                 
@@ -1199,12 +1402,13 @@ cdef class HypergraphFlag (Flag):
         
         def has_forbidden_edge_numbers(self, forbidden_edge_numbers, must_have_highest=False):
         
-                cdef int *c
+                cdef combinatorial_info_block cib
+                cdef unsigned char *c
                 cdef int nc, i, j, k, l, fe
                 cdef int *edges
                 cdef int *e
                 cdef int got
-                cdef int *comb
+                cdef unsigned char *comb
                 cdef int num_e, max_e, ceiling
         
                 if self.is_degenerate:
@@ -1237,7 +1441,9 @@ cdef class HypergraphFlag (Flag):
                         
                         if must_have_highest:
                         
-                                c = generate_combinations(self._n - 1, k - 1, &nc)
+                                cib = generate_combinations(self._n - 1, k - 1)
+                                c = cib.p
+                                nc = cib.np
         
                                 for i in range(nc):
                                         comb = &c[(k - 1) * i]
@@ -1271,7 +1477,9 @@ cdef class HypergraphFlag (Flag):
         
                         else:
         
-                                c = generate_combinations(self._n, k, &nc)
+                                cib = generate_combinations(self._n, k)
+                                c = cib.p
+                                nc = cib.np
         
                                 for i in range(nc):
                                         comb = &c[k * i]
@@ -1304,8 +1512,10 @@ cdef class HypergraphFlag (Flag):
         
         def has_forbidden_graphs(self, graphs, must_have_highest=False, induced=False):
         
-                cdef int *c
+                cdef combinatorial_info_block cib
+                cdef unsigned char *c
                 cdef int nc, i, j
+                cdef int verts[MAX_NUMBER_OF_VERTICES]
                 cdef HypergraphFlag h, ig
                 
                 if self.is_degenerate:
@@ -1319,13 +1529,16 @@ cdef class HypergraphFlag (Flag):
                                 continue # vacuous condition
         
                         if must_have_highest:
-                                c = generate_combinations_plus(self._n, h._n, &nc)
+                                cib = generate_combinations_plus(self._n, h._n)
                         else:
-                                c = generate_combinations(self._n, h._n, &nc)
+                                cib = generate_combinations(self._n, h._n)
+                        c = cib.p
+                        nc = cib.np
         
                         for j in range(nc):
                         
-                                ig = self.c_induced_subgraph(&c[j * h._n], h._n)
+                                load_vertices(verts, &c[j * h._n], h._n)
+                                ig = self.c_induced_subgraph(verts, h._n)
                         
                                 if ig.ne < h.ne:
                                         continue
@@ -1530,27 +1743,68 @@ cdef class HypergraphFlag (Flag):
         #
         
         @classmethod
-        def flag_products (cls, graph_block gb, HypergraphFlag tg, graph_block flags1, graph_block flags2):
-            
-                cdef int *p
-                cdef int np
-                cdef int *pp
-                cdef int *pf1
-                cdef int *pf2
-                cdef int *edges
-                cdef int *cur_edges
-                cdef int n, s, m1, m2, ne, i, j, k, gi
-                cdef int cnte, cnf1e, cnf2e
-                cdef int has_type, has_f1
-                cdef int f1index, f2index, equal_flags_mode, nzcount, row
+        def flag_products (cls, graph_block gb, HypergraphFlag tg, graph_block flags1, graph_block flags2, first=0, last=None,
+                           induced_flag_index index=None):
+                """
+                Returns the products of the flags in flags1 and flags2 (or of flags1 with
+                itself if flags2 is None) in the graphs of gb. If first and last are given,
+                only the graphs with indices in range(first, last) are used; the rows keep
+                their indices in gb, so the results for consecutive ranges can be
+                concatenated.
+
+                The embeddings of tg in each graph are found first, and only for those are
+                the vertices of the two flags chosen, so no table of all the arrangements is
+                built. An s-set of vertices is only tried in full if it induces as many
+                edges as tg and its vertex degrees allow it, and each set is searched until
+                one embedding is found; the others are its images under the automorphisms
+                of tg. The flag induced by each choice of flag vertices is computed once per
+                embedding, rather than once for every pair it is part of.
+
+                If index is given, it must be an induced_flag_index of the graphs of gb for
+                the order of tg and of the flags, and the products are read off from it for
+                the graphs that it covers. This is only supported if flags2 is None.
+                """
+
+                if index is not None:
+                        if not flags2 is None:
+                                raise NotImplementedError("an index can only be used for the products of flags1 with itself.")
+                        if index.s != tg.n or index.m != flags1.n:
+                                raise ValueError("index does not match the orders of the type and flags.")
+                        return indexed_flag_products(index, flags1)
+
+                cdef combinatorial_info_block combs_block, perms_block, subsets1_block, subsets2_block
+                cdef unsigned char *combs
+                cdef unsigned char *perms
+                cdef int *auts
+                cdef unsigned char *subsets1
+                cdef unsigned char *subsets2
+                cdef int *ids1
+                cdef int *ids2
+                cdef unsigned char *c
+                cdef unsigned long long *masks1
+                cdef unsigned long long *masks2
+                cdef unsigned long long ma, mb
+                cdef int n, s, m1, m2, ncombs, nperms, nauts, nsubsets1, nsubsets2
+                cdef int i, j, k, ai, a, b, gi, gfirst, glast, found
+                cdef int f1index, f2index, equal_flags_mode, row, capacity
                 cdef int *grb
+                cdef numpy.int64_t *buf
+                cdef int emb[MAX_NUMBER_OF_VERTICES]
+                cdef int verts[MAX_NUMBER_OF_VERTICES]
+                cdef int available[MAX_NUMBER_OF_VERTICES]
+                cdef int in_type[MAX_NUMBER_OF_VERTICES + 1]
+                cdef int g_degrees[MAX_NUMBER_OF_VERTICES + 1]
+                cdef int t_degrees[MAX_NUMBER_OF_VERTICES + 1]
+                cdef int edges[MAX_NUMBER_OF_EDGE_INTS]
 
                 cdef HypergraphFlag g, t, f1, f2
+
+                gfirst = max(first, 0)
+                glast = gb.len if last is None else min(last, gb.len)
                 
-                rarray = numpy.zeros([0, 5], dtype=int)
                 row = 0
-                
-                #sig_on()
+                capacity = 1024
+                buf = <numpy.int64_t *> malloc (sizeof(numpy.int64_t) * 5 * capacity)
                 
                 n = gb.n
                 s = tg.n
@@ -1560,150 +1814,165 @@ cdef class HypergraphFlag (Flag):
         
                         equal_flags_mode = 0
                         m2 = flags2.n
-                        p = generate_pair_combinations(n, s, m1, m2, &np)
         
                 else:
         
                         equal_flags_mode = 1
                         m2 = flags1.n
                         flags2 = flags1
-                        p = generate_equal_pair_combinations(n, s, m1, &np)
-        
-                cur_edges = <int *> malloc (sizeof(int) * MAX_NUMBER_OF_EDGE_INTS)
-                pf1 = <int *> malloc (sizeof(int) * m1)
-                pf2 = <int *> malloc (sizeof(int) * m2)
+
+                # In equal flags mode each unordered pair of flag vertex sets is visited once,
+                # and counted twice by store_products.
+                denominator = falling_factorial(n, s) * binomial(n - s, m1 - s) * binomial(n - m1, m2 - s)
+
+                # Embeddings of the type are found one s-set at a time: the first ordering of
+                # the set that induces tg is searched for, and the others are obtained from it
+                # by the automorphisms of tg.
+                combs_block = generate_combinations(n, s)
+                combs = combs_block.p
+                ncombs = combs_block.np
+                perms_block = generate_permutations(s)
+                perms = perms_block.p
+                nperms = perms_block.np
+                auts = type_automorphisms(tg, &nauts)
+
+                memset(t_degrees, 0, sizeof(int) * (s + 1))
+                for i in range(tg._r * tg.ne):
+                        t_degrees[tg._edges[i]] += 1
+
+                # The flag vertices are chosen among the n - s vertices outside the type,
+                # and given as positions in available.
+                subsets1_block = generate_combinations(n - s, m1 - s)
+                subsets1 = subsets1_block.p
+                nsubsets1 = subsets1_block.np
+                masks1 = subset_masks(subsets1, nsubsets1, m1 - s)
+                ids1 = <int *> malloc (sizeof(int) * max(nsubsets1, 1))
+                if equal_flags_mode:
+                        subsets2 = subsets1
+                        masks2 = masks1
+                        ids2 = ids1
+                        nsubsets2 = nsubsets1
+                else:
+                        subsets2_block = generate_combinations(n - s, m2 - s)
+                        subsets2 = subsets2_block.p
+                        nsubsets2 = subsets2_block.np
+                        masks2 = subset_masks(subsets2, nsubsets2, m2 - s)
+                        ids2 = <int *> malloc (sizeof(int) * max(nsubsets2, 1))
+
                 grb = <int *> malloc (flags1.len * flags2.len * sizeof(int))
         
+                for gi in range(gfirst, glast):
         
-                for gi in range(gb.len):
-        
-                        #sig_on()
-                
                         g = <HypergraphFlag> gb.graphs[gi]
                 
                         memset(grb, 0, flags1.len * flags2.len * sizeof(int))
-                
-                        ne = g.ne
-                        edges = g._edges
-        
-                        has_type = 0
-                        has_f1 = 0
+
+                        memset(g_degrees, 0, sizeof(int) * (n + 1))
+                        for i in range(g._r * g.ne):
+                                g_degrees[g._edges[i]] += 1
         
-                        for i in range(np):
-                        
-                                pp = &p[(i * n)]
-                        
-                                if pp[0] != 0:
-                        
-                                        for j in range(s):
-                                                pf1[j] = pp[j]
-                                                pf2[j] = pp[j]
-                                                        
-                                        has_type = 0
-                                        t = g.c_induced_subgraph(pf1, s)
-                                        if tg.is_labelled_isomorphic(t):
-                                                has_type = 1
-                
-                                if has_type == 0:
+                        for i in range(ncombs):
+
+                                c = &combs[i * s]
+                                load_vertices(verts, c, s)
+                                if g.c_induced_edges(verts, s, edges) != tg.ne:
                                         continue
-                                
-                                if has_type and pp[s] != 0:
-                
-                                        has_f1 = 0
-                
-                                        for j in range(m1 - s):
-                                                pf1[s + j] = pp[s + j]
-                
-                                        f1 = g.c_induced_subgraph(pf1, m1)
-                                        f1.t = s
-                                        f1.make_minimal_isomorph()
-        
-                                        for j in range(flags1.len):
-                                                if f1.is_labelled_isomorphic(<HypergraphFlag> flags1.graphs[j]):
-                                                        has_f1 = 1
-                                                        f1index = j
+
+                                found = 0
+                                for j in range(nperms):
+                                        for k in range(s):
+                                                emb[k] = c[perms[j * s + k] - 1]
+                                                if g_degrees[emb[k]] < t_degrees[k + 1]:
                                                         break
-                
-                                if has_f1 == 0:
+                                        else:
+                                                t = g.c_induced_subgraph(emb, s)
+                                                if tg.is_labelled_isomorphic(t):
+                                                        found = 1
+                                                        break
+
+                                if found == 0:
                                         continue
-                
-                                for j in range(m2 - s):
-                                        pf2[s + j] = pp[m1 + j]
-                
-                                f2 = g.c_induced_subgraph(pf2, m2)
-                                f2.t = s
-                                f2.make_minimal_isomorph()
-                                
-                                for j in range(flags2.len):
-                                        if f2.is_labelled_isomorphic(<HypergraphFlag> flags2.graphs[j]):
-                                                f2index = j
-                                                grb[(f1index * flags1.len) + f2index] += 1
-                                                break
-        
-                        if equal_flags_mode:
-                
-                                nzcount = 0
-                                for i in range(flags1.len):
-                                        for j in range(i, flags1.len):
-                                                k = grb[(i * flags1.len) + j] + grb[(j * flags1.len) + i]
-                                                if k != 0:
-                                                        nzcount += 1
-        
-                                rarray.resize([row + nzcount, 5], refcheck=False)
-                                
-                                for i in range(flags1.len):
-                                        for j in range(i, flags1.len):
-                                                k = grb[(i * flags1.len) + j] + grb[(j * flags1.len) + i]
-                                                if k != 0:
-                                                        rarray[row, 0] = gi
-                                                        rarray[row, 1] = i
-                                                        rarray[row, 2] = j
-                                                        rarray[row, 3] = k
-                                                        rarray[row, 4] = np * 2
-                                                        row += 1
-        
-                        else:
-                
-                                nzcount = 0
-                                for i in range(flags1.len):
-                                        for j in range(flags2.len):
-                                                k = grb[(i * flags1.len) + j]
-                                                if k != 0:
-                                                        nzcount += 1
-        
-                                rarray.resize([row + nzcount, 5], refcheck=False)
-                                
-                                for i in range(flags1.len):
-                                        for j in range(flags2.len):
-                                                k = grb[(i * flags1.len) + j]
-                                                if k != 0:
-                                                        rarray[row, 0] = gi
-                                                        rarray[row, 1] = i
-                                                        rarray[row, 2] = j
-                                                        rarray[row, 3] = k
-                                                        rarray[row, 4] = np
-                                                        row += 1
-        
-                free(cur_edges)
-                free(pf1)
-                free(pf2)
+
+                                memset(in_type, 0, sizeof(int) * (n + 1))
+                                for k in range(s):
+                                        in_type[c[k]] = 1
+                                k = 0
+                                for j in range(1, n + 1):
+                                        if not in_type[j]:
+                                                available[k] = j
+                                                k += 1
+
+                                for ai in range(nauts):
+
+                                        for k in range(s):
+                                                verts[k] = emb[auts[ai * s + k] - 1]
+
+                                        found = 0
+                                        for a in range(nsubsets1):
+                                                for k in range(m1 - s):
+                                                        verts[s + k] = available[subsets1[a * (m1 - s) + k] - 1]
+                                                f1 = g.c_induced_subgraph(verts, m1)
+                                                f1.t = s
+                                                f1.make_minimal_isomorph()
+                                                ids1[a] = flags1.find(f1)
+                                                if ids1[a] != -1:
+                                                        found = 1
+
+                                        if found == 0:
+                                                continue
+
+                                        if not equal_flags_mode:
+                                                for b in range(nsubsets2):
+                                                        for k in range(m2 - s):
+                                                                verts[s + k] = available[subsets2[b * (m2 - s) + k] - 1]
+                                                        f2 = g.c_induced_subgraph(verts, m2)
+                                                        f2.t = s
+                                                        f2.make_minimal_isomorph()
+                                                        ids2[b] = flags2.find(f2)
+
+                                        for a in range(nsubsets1):
+                                                f1index = ids1[a]
+                                                if f1index == -1:
+                                                        continue
+                                                ma = masks1[a]
+                                                for b in range(nsubsets2):
+                                                        f2index = ids2[b]
+                                                        if f2index == -1:
+                                                                continue
+                                                        mb = masks2[b]
+                                                        if ma & mb:
+                                                                continue
+                                                        # In equal flags mode, only take the pairs where the smallest
+                                                        # vertex is in the first set.
+                                                        if equal_flags_mode and (mb & (~mb + 1)) < (ma & (~ma + 1)):
+                                                                continue
+                                                        grb[(f1index * flags1.len) + f2index] += 1
+        
+                        buf = store_products(buf, &row, &capacity, gi, grb, flags1.len, flags2.len,
+                                equal_flags_mode, denominator)
+        
+                rarray = products_array(buf, row)
+
+                free(buf)
+                free(auts)
+                free(masks1)
+                free(ids1)
+                if not equal_flags_mode:
+                        free(masks2)
+                        free(ids2)
                 free(grb)
-        
-                #sig_off()
                 
                 return rarray
 
 
         @classmethod
         def modified_flag_products (cls, gb_graphs, gb_n, HypergraphFlag tg, flags1_graphs, flags1_n):
-        
-                gb = make_graph_block(gb_graphs, gb_n)
-                flags1 = make_graph_block(flags1_graphs, flags1_n)
-            
             
-                cdef int *p
+                cdef graph_block gb, flags1, flags2
+                cdef combinatorial_info_block cib
+                cdef unsigned char *p
                 cdef int np
-                cdef int *pp
+                cdef unsigned char *pp
                 cdef int *pf1
                 cdef int *pf2
                 cdef int *edges
@@ -1711,13 +1980,18 @@ cdef class HypergraphFlag (Flag):
                 cdef int n, s, m1, m2, ne, i, j, k, gi
                 cdef int cnte, cnf1e, cnf2e
                 cdef int has_type, has_f1
-                cdef int f1index, f2index, equal_flags_mode, nzcount, row
+                cdef int f1index, f2index, equal_flags_mode, row, capacity
                 cdef int *grb
+                cdef numpy.int64_t *buf
 
                 cdef HypergraphFlag g, t, f1, f2
                 
-                rarray = numpy.zeros([0, 5], dtype=int)
+                gb = make_graph_block(gb_graphs, gb_n)
+                flags1 = make_graph_block(flags1_graphs, flags1_n)
+
                 row = 0
+                capacity = 1024
+                buf = <numpy.int64_t *> malloc (sizeof(numpy.int64_t) * 5 * capacity)
                 
                 #sig_on()
                 
@@ -1729,7 +2003,9 @@ cdef class HypergraphFlag (Flag):
                 equal_flags_mode = 1
                 m2 = flags1.n
                 flags2 = flags1
-                p = generate_equal_pair_combinations(n, s, m1, &np)
+                cib = generate_equal_pair_combinations(n, s, m1)
+                p = cib.p
+                np = cib.np
         
                 cur_edges = <int *> malloc (sizeof(int) * MAX_NUMBER_OF_EDGE_INTS)
                 pf1 = <int *> malloc (sizeof(int) * m1)
@@ -1780,11 +2056,9 @@ cdef class HypergraphFlag (Flag):
                                         f1.t = s
                                         f1.make_minimal_isomorph()
         
-                                        for j in range(flags1.len):
-                                                if f1.is_labelled_isomorphic(<HypergraphFlag> flags1.graphs[j]):
-                                                        has_f1 = 1
-                                                        f1index = j
-                                                        break
+                                        f1index = flags1.find(f1)
+                                        if f1index != -1:
+                                                has_f1 = 1
                 
                                 if has_f1 == 0:
                                         continue
@@ -1796,56 +2070,16 @@ cdef class HypergraphFlag (Flag):
                                 f2.t = s
                                 f2.make_minimal_isomorph()
                                 
-                                for j in range(flags2.len):
-                                        if f2.is_labelled_isomorphic(<HypergraphFlag> flags2.graphs[j]):
-                                                f2index = j
-                                                grb[(f1index * flags1.len) + f2index] += 1
-                                                break
-        
-                        if equal_flags_mode:
-                
-                                nzcount = 0
-                                for i in range(flags1.len):
-                                        for j in range(i, flags1.len):
-                                                k = grb[(i * flags1.len) + j] + grb[(j * flags1.len) + i]
-                                                if k != 0:
-                                                        nzcount += 1
+                                f2index = flags2.find(f2)
+                                if f2index != -1:
+                                        grb[(f1index * flags1.len) + f2index] += 1
         
-                                rarray.resize([row + nzcount, 5], refcheck=False)
-                                
-                                for i in range(flags1.len):
-                                        for j in range(i, flags1.len):
-                                                k = grb[(i * flags1.len) + j] + grb[(j * flags1.len) + i]
-                                                if k != 0:
-                                                        rarray[row, 0] = gi
-                                                        rarray[row, 1] = i
-                                                        rarray[row, 2] = j
-                                                        rarray[row, 3] = k
-                                                        rarray[row, 4] = np * 2
-                                                        row += 1
-        
-                        else:
-                
-                                nzcount = 0
-                                for i in range(flags1.len):
-                                        for j in range(flags2.len):
-                                                k = grb[(i * flags1.len) + j]
-                                                if k != 0:
-                                                        nzcount += 1
-        
-                                rarray.resize([row + nzcount, 5], refcheck=False)
-                                
-                                for i in range(flags1.len):
-                                        for j in range(flags2.len):
-                                                k = grb[(i * flags1.len) + j]
-                                                if k != 0:
-                                                        rarray[row, 0] = gi
-                                                        rarray[row, 1] = i
-                                                        rarray[row, 2] = j
-                                                        rarray[row, 3] = k
-                                                        rarray[row, 4] = np
-                                                        row += 1
+                        buf = store_products(buf, &row, &capacity, gi, grb, flags1.len, flags2.len,
+                                equal_flags_mode, np * 2 if equal_flags_mode else np)
         
+                rarray = products_array(buf, row)
+
+                free(buf)
                 free(cur_edges)
                 free(pf1)
                 free(pf2)
@@ -1859,6 +2093,102 @@ cdef class HypergraphFlag (Flag):
 #
 
 
+cdef numpy.int64_t *store_products(numpy.int64_t *buf, int *row, int *capacity, int gi, int *grb,
+        int len1, int len2, bint equal_flags_mode, int denominator):
+        """
+        Appends a row (gi, i, j, numerator, denominator) to buf for each non-zero
+        entry of grb, doubling the capacity of buf whenever it fills up.
+        """
+
+        cdef int i, j, k
+        cdef numpy.int64_t *r
+
+        for i in range(len1):
+                for j in range(i if equal_flags_mode else 0, len2):
+
+                        if equal_flags_mode:
+                                k = grb[(i * len1) + j] + grb[(j * len1) + i]
+                        else:
+                                k = grb[(i * len1) + j]
+                        if k == 0:
+                                continue
+
+                        if row[0] == capacity[0]:
+                                capacity[0] *= 2
+                                buf = <numpy.int64_t *> realloc (buf, sizeof(numpy.int64_t) * 5 * capacity[0])
+
+                        r = &buf[row[0] * 5]
+                        r[0] = gi
+                        r[1] = i
+                        r[2] = j
+                        r[3] = k
+                        r[4] = denominator
+                        row[0] += 1
+
+        return buf
+
+
+cdef products_array(numpy.int64_t *buf, int rows):
+        """
+        Copies the first rows rows of buf into a new int64 array with 5 columns.
+        """
+
+        cdef numpy.ndarray[numpy.int64_t, ndim=2] rarray = numpy.empty([rows, 5], dtype=numpy.int64)
+
+        if rows > 0:
+                memcpy(&rarray[0, 0], buf, sizeof(numpy.int64_t) * 5 * rows)
+
+        return rarray
+
+
+cdef int *type_automorphisms(HypergraphFlag tg, int *number_of):
+        """
+        Returns a newly allocated table of the permutations of the vertices of tg that are
+        automorphisms of tg, in the same format as generate_permutations.
+        """
+
+        cdef combinatorial_info_block cib
+        cdef int *auts
+        cdef int np, na, i, s
+        cdef HypergraphFlag ig
+
+        s = tg._n
+        cib = generate_permutations(s)
+        np = cib.np
+        auts = <int *> malloc (sizeof(int) * max(np * s, 1))
+        na = 0
+
+        for i in range(np):
+                load_vertices(&auts[na * s], &cib.p[i * s], s)
+                ig = tg.c_induced_subgraph(&auts[na * s], s)
+                ig.t = tg.t
+                if tg.is_labelled_isomorphic(ig):
+                        na += 1
+
+        if number_of:
+                number_of[0] = na
+
+        return auts
+
+
+cdef unsigned long long *subset_masks(unsigned char *subsets, int number_of, int s):
+        """
+        Returns a newly allocated array of the bit masks of the s-sets in subsets, as given
+        by generate_combinations, with bit i - 1 set for element i.
+        """
+
+        cdef unsigned long long *masks
+        cdef int i, j
+
+        masks = <unsigned long long *> malloc (sizeof(unsigned long long) * max(number_of, 1))
+        for i in range(number_of):
+                masks[i] = 0
+                for j in range(s):
+                        masks[i] |= (<unsigned long long> 1) << (subsets[i * s + j] - 1)
+
+        return masks
+
+
 cdef void raw_minimize_edges(int *edges, int m, int r, bint oriented):
 
         cdef int i
@@ -1940,295 +2270,929 @@ cdef void raw_minimize_edges(int *edges, int m, int r, bint oriented):
                         round += 1
 
 
-cdef class combinatorial_info_block:
-        pass
+#
+# Canonical labelling by partition refinement.
+#
+# The minimal isomorph is the relabelling whose sorted edge list is smallest.
+# Reading the possible edges in lexicographic order, this is the same as the
+# relabelling whose vector of edge multiplicities is largest. New labels are
+# handed out in increasing order. Once k labels are assigned, the vertices that
+# are left are only distinguished by the multisets of multiplicities they see,
+# and sorting these gives an upper bound for every way of finishing the
+# labelling. Branches that cannot beat the best labelling found so far are cut.
+#
 
-previous_permutations = {}
+cdef struct canonical_info:
+        int n
+        int r
+        bint oriented
+        int npos
+        int *mult
+        int *lab
+        int *used
+        int *best
+        bint have_best
+        int *buffers
+        int *vals
+        int *hmax
 
-cdef int *generate_permutations_fixing(int n, int s, int *number_of):
 
-        cdef int *p
-        cdef int fac, i, j
+cdef inline void sort_descending(int *a, int m):
 
-        # see if we've already generated it!
-        key = (n, s)
-        if key in previous_permutations.keys():
-        
-                cib = <combinatorial_info_block>previous_permutations[key]
-                fac = cib.np
-                p = cib.p
-        
-        else:
+        cdef int i, j, x
+
+        for i in range(1, m):
+                x = a[i]
+                j = i - 1
+                while j >= 0 and a[j] < x:
+                        a[j + 1] = a[j]
+                        j -= 1
+                a[j + 1] = x
+
+
+cdef inline int compare_vectors(int *a, int *b, int m):
+
+        cdef int i
+
+        for i in range(m):
+                if a[i] > b[i]:
+                        return 1
+                if a[i] < b[i]:
+                        return -1
+        return 0
+
+
+cdef inline bint keep_largest(int *h, int *v, int m, bint found):
 
-                perms = Permutations(range(s + 1, n + 1)).list()
-                fac = len(perms)
-                p = <int *> malloc (sizeof(int) * n * fac)
-                for i in range(fac):
-                        for j in range(n):
-                                if j < s:
-                                        p[(i * n) + j] = j + 1
+        cdef int i
+
+        if not found or compare_vectors(v, h, m) > 0:
+                for i in range(m):
+                        h[i] = v[i]
+        return True
+
+
+cdef void canonical_bound(canonical_info *ci, int k, int *out):
+
+        cdef int n = ci.n
+        cdef int *M = ci.mult
+        cdef int *lab = ci.lab
+        cdef int *used = ci.used
+        cdef int *vals = ci.vals
+        cdef int *h
+        cdef int a, b, c, u, w, x, m, i
+        cdef int p = 0
+        cdef bint found
+
+        if ci.r == 3:
+
+                # best row of co-degrees over pairs of unassigned vertices
+                h = &ci.hmax[n * n]
+                if k <= n - 3:
+                        found = False
+                        for u in range(n):
+                                if used[u]:
+                                        continue
+                                for x in range(u + 1, n):
+                                        if used[x]:
+                                                continue
+                                        m = 0
+                                        for w in range(n):
+                                                if w != u and w != x and not used[w]:
+                                                        vals[m] = M[(u * n + x) * n + w]
+                                                        m += 1
+                                        sort_descending(vals, m)
+                                        found = keep_largest(h, vals, m, found)
+
+                # best row of co-degrees over pairs made of lab[a] and an unassigned vertex
+                if k <= n - 2:
+                        for a in range(k):
+                                h = &ci.hmax[a * n]
+                                found = False
+                                for u in range(n):
+                                        if used[u]:
+                                                continue
+                                        m = 0
+                                        for w in range(n):
+                                                if w != u and not used[w]:
+                                                        vals[m] = M[(lab[a] * n + u) * n + w]
+                                                        m += 1
+                                        sort_descending(vals, m)
+                                        found = keep_largest(h, vals, m, found)
+
+                for a in range(n - 2):
+                        for b in range(a + 1, n - 1):
+                                if b < k:
+                                        for c in range(b + 1, k):
+                                                out[p] = M[(lab[a] * n + lab[b]) * n + lab[c]]
+                                                p += 1
+                                        m = 0
+                                        for u in range(n):
+                                                if not used[u]:
+                                                        out[p + m] = M[(lab[a] * n + lab[b]) * n + u]
+                                                        m += 1
+                                        sort_descending(&out[p], m)
+                                        p += m
                                 else:
-                                        p[(i * n) + j] = <int> perms[i][j - s]
+                                        h = &ci.hmax[a * n] if a < k else &ci.hmax[n * n]
+                                        for i in range(n - 1 - b):
+                                                out[p] = h[i]
+                                                p += 1
+
+        elif ci.oriented:
+
+                # best row over unassigned vertices: edges to labelled vertices, then the rest
+                h = ci.hmax
+                if k < n:
+                        found = False
+                        for u in range(n):
+                                if used[u]:
+                                        continue
+                                for b in range(k):
+                                        vals[b] = M[u * n + lab[b]]
+                                m = k
+                                for w in range(n):
+                                        if w != u and not used[w]:
+                                                vals[m] = M[u * n + w]
+                                                m += 1
+                                sort_descending(&vals[k], m - k)
+                                found = keep_largest(h, vals, m, found)
+
+                for a in range(n):
+                        if a < k:
+                                for b in range(k):
+                                        if b != a:
+                                                out[p] = M[lab[a] * n + lab[b]]
+                                                p += 1
+                                m = 0
+                                for u in range(n):
+                                        if not used[u]:
+                                                out[p + m] = M[lab[a] * n + u]
+                                                m += 1
+                                sort_descending(&out[p], m)
+                                p += m
+                        else:
+                                for i in range(n - 1):
+                                        out[p] = h[i]
+                                        p += 1
 
-                cib = combinatorial_info_block()
-                cib.np = fac
-                cib.p = p
-                previous_permutations[key] = cib
-        
-        if number_of:
-                number_of[0] = fac
+        else:
 
-        return p
+                # best row of degrees over unassigned vertices
+                h = ci.hmax
+                if k <= n - 2:
+                        found = False
+                        for u in range(n):
+                                if used[u]:
+                                        continue
+                                m = 0
+                                for w in range(n):
+                                        if w != u and not used[w]:
+                                                vals[m] = M[u * n + w]
+                                                m += 1
+                                sort_descending(vals, m)
+                                found = keep_largest(h, vals, m, found)
+
+                for a in range(n - 1):
+                        if a < k:
+                                for b in range(a + 1, k):
+                                        out[p] = M[lab[a] * n + lab[b]]
+                                        p += 1
+                                m = 0
+                                for u in range(n):
+                                        if not used[u]:
+                                                out[p + m] = M[lab[a] * n + u]
+                                                m += 1
+                                sort_descending(&out[p], m)
+                                p += m
+                        else:
+                                for i in range(n - 1 - a):
+                                        out[p] = h[i]
+                                        p += 1
+
+
+cdef void canonical_search(canonical_info *ci, int k):
+
+        cdef int n = ci.n
+        cdef int npos = ci.npos
+        cdef int i, j, u
+        cdef int first = -1
+        cdef int *bounds = &ci.buffers[k * n * npos]
+        cdef int *bound
+
+        # The bound for each vertex is found once and kept in bounds. The most promising
+        # vertex is tried first, so that good labellings are found early.
+        for u in range(n):
+                if ci.used[u]:
+                        continue
+                ci.lab[k] = u
+                ci.used[u] = 1
+                canonical_bound(ci, k + 1, &bounds[u * npos])
+                ci.used[u] = 0
+                if first == -1 or compare_vectors(&bounds[u * npos], &bounds[first * npos], npos) > 0:
+                        first = u
+
+        for i in range(-1, n):
+
+                if i == -1:
+                        u = first
+                else:
+                        u = i
+                        if u == first or ci.used[u]:
+                                continue
 
-cdef int *generate_permutations(int n, int *number_of):
+                ci.lab[k] = u
+                ci.used[u] = 1
+                bound = &bounds[u * npos]
 
-        return generate_permutations_fixing(n, <int> 0, number_of)
+                if not ci.have_best or compare_vectors(bound, ci.best, npos) > 0:
+                        if k + 1 == n:
+                                for j in range(npos):
+                                        ci.best[j] = bound[j]
+                                ci.have_best = True
+                        else:
+                                canonical_search(ci, k + 1)
 
-def get_permutations (n):
- 
-        cdef int *p
-        cdef int np, i, j
-        
-        p = generate_permutations(n, &np)
-        return [[p[(i * n) + j] for j in range(n)] for i in range(np)]
+                ci.used[u] = 0
 
 
-previous_combinations = {}
+cdef bint canonical_minimize_edges(int *edges, int m, int n, int t, int r, bint oriented):
+        """
+        Relabels the vertices t + 1, ..., n so that the sorted edge list is as
+        small as possible. Gives the same edges as trying every permutation, but
+        only explores labellings that the refinement cannot rule out. Returns
+        False, leaving the edges alone, if the graph has edges with repeated
+        vertices.
+        """
 
-cdef int *generate_combinations(int n, int s, int *number_of):
+        cdef canonical_info ci
+        cdef int i, j, a, b, c, p, q
+        cdef int *e
 
-        cdef int *p
-        cdef int fac, i, j
+        if not (r == 3 and not oriented) and r != 2:
+                return False
 
-        # see if we've already generated it!
-        key = (n, s)
-        if key in previous_combinations.keys():
-        
-                cib = <combinatorial_info_block>previous_combinations[key]
-                fac = cib.np
-                p = cib.p
+        for i in range(m):
+                e = &edges[i * r]
+                for j in range(r):
+                        for a in range(j + 1, r):
+                                if e[j] == e[a]:
+                                        return False
 
+        ci.n = n
+        ci.r = r
+        ci.oriented = oriented
+        if r == 3:
+                ci.npos = n * (n - 1) * (n - 2) // 6
+        elif oriented:
+                ci.npos = n * (n - 1)
         else:
+                ci.npos = n * (n - 1) // 2
+
+        ci.mult = <int *> calloc(n * n * (n if r == 3 else 1), sizeof(int))
+        ci.lab = <int *> calloc(n, sizeof(int))
+        ci.used = <int *> calloc(n, sizeof(int))
+        ci.best = <int *> calloc(ci.npos, sizeof(int))
+        ci.buffers = <int *> calloc(n * n * ci.npos, sizeof(int))
+        ci.vals = <int *> calloc(n, sizeof(int))
+        ci.hmax = <int *> calloc((n + 1) * n, sizeof(int))
+        ci.have_best = False
+
+        for i in range(m):
+                e = &edges[i * r]
+                if r == 3:
+                        a, b, c = e[0] - 1, e[1] - 1, e[2] - 1
+                        ci.mult[(a * n + b) * n + c] += 1
+                        ci.mult[(a * n + c) * n + b] += 1
+                        ci.mult[(b * n + a) * n + c] += 1
+                        ci.mult[(b * n + c) * n + a] += 1
+                        ci.mult[(c * n + a) * n + b] += 1
+                        ci.mult[(c * n + b) * n + a] += 1
+                else:
+                        a, b = e[0] - 1, e[1] - 1
+                        ci.mult[a * n + b] += 1
+                        if not oriented:
+                                ci.mult[b * n + a] += 1
 
-                perms = Combinations(range(1, n + 1), s).list()
-                fac = len(perms)
-                p = <int *> malloc (sizeof(int) * s * fac)
-                for i in range(fac):
-                        for j in range(s):
-                                p[(i * s) + j] = <int> perms[i][j]
+        for i in range(t):
+                ci.lab[i] = i
+                ci.used[i] = 1
 
-                cib = combinatorial_info_block()
-                cib.np = fac
-                cib.p = p
-                previous_combinations[key] = cib
-        
-        if number_of:
-                number_of[0] = fac
+        if t >= n:
+                canonical_bound(&ci, n, ci.best)
+        else:
+                canonical_search(&ci, t)
 
-        return p
+        p = 0
+        q = 0
+        if r == 3:
+                for a in range(n - 2):
+                        for b in range(a + 1, n - 1):
+                                for c in range(b + 1, n):
+                                        for j in range(ci.best[p]):
+                                                edges[q] = a + 1
+                                                edges[q + 1] = b + 1
+                                                edges[q + 2] = c + 1
+                                                q += 3
+                                        p += 1
+        else:
+                for a in range(n):
+                        for b in range(n):
+                                if b == a or (b < a and not oriented):
+                                        continue
+                                for j in range(ci.best[p]):
+                                        edges[q] = a + 1
+                                        edges[q + 1] = b + 1
+                                        q += 2
+                                p += 1
 
-def get_combinations (n, s):
+        free(ci.mult)
+        free(ci.lab)
+        free(ci.used)
+        free(ci.best)
+        free(ci.buffers)
+        free(ci.vals)
+        free(ci.hmax)
 
-        cdef int *p
-        cdef int np, i, j
-        
-        p = generate_combinations(n, s, &np)
-        return [[p[(i * s) + j] for j in range(s)] for i in range(np)]
+        return True
 
 
-# Combinations that always contain maximum element
-previous_combinations_plus = {}
+cdef class combinatorial_info_block:
+        """
+        A table of vertices from the table cache: np rows of width entries each, stored
+        as bytes at p. The block holds a reference to the table, so p stays valid for as
+        long as the block is alive, even if the table is evicted from the cache.
+        """
+        pass
 
-cdef int *generate_combinations_plus(int n, int s, int *number_of):
 
-        cdef int *p
-        cdef int fac, i, j
+cdef combinatorial_info_block info_block(key, build, args):
 
-        # see if we've already generated it!
-        key = (n, s)
-        if key in previous_combinations_plus.keys():
-        
-                cib = <combinatorial_info_block>previous_combinations_plus[key]
-                fac = cib.np
-                p = cib.p
+        cdef combinatorial_info_block cib = combinatorial_info_block()
+        cdef const unsigned char[:, ::1] view
 
+        cib.table = table_cache.get(key, build, *args)
+        cib.np = cib.table.shape[0]
+        cib.width = cib.table.shape[1]
+        if cib.table.size > 0:
+                view = cib.table
+                cib.p = <unsigned char *> &view[0, 0]
         else:
+                cib.p = NULL
+        return cib
 
-                perms = Combinations(range(1, n), s - 1).list()
-                fac = len(perms)
-                p = <int *> malloc (sizeof(int) * s * fac)
-                for i in range(fac):
-                        for j in range(s - 1):
-                                p[(i * s) + j] = <int> perms[i][j]
-                        p[(i * s) + s - 1] = n
 
-                cib = combinatorial_info_block()
-                cib.np = fac
-                cib.p = p
-                previous_combinations_plus[key] = cib
-        
-        if number_of:
-                number_of[0] = fac
+cdef inline void load_vertices(int *verts, unsigned char *row, int k):
+        # Copies the k vertices of a row of a table into verts.
+        cdef int i
+        for i in range(k):
+                verts[i] = row[i]
 
-        return p
 
+def vertex_table(rows, width):
+        return numpy.array(rows, dtype=numpy.uint8).reshape(len(rows), width)
 
-def get_combinations_plus (n, s):
 
-        cdef int *p
-        cdef int np, i, j
-        p = generate_combinations_plus(n, s, &np)
-        return [[p[(i * s) + j] for j in range(s)] for i in range(np)]
+def permutations_fixing_table(n, s):
+        perms = Permutations(range(s + 1, n + 1))
+        return vertex_table([list(range(1, s + 1)) + [int(v) for v in perm] for perm in perms], n)
 
+cdef combinatorial_info_block generate_permutations_fixing(int n, int s):
 
-previous_pair_combinations = {}
+        return info_block(("permutations", n, s), permutations_fixing_table, (n, s))
 
-cdef int *generate_pair_combinations(int n, int s, int m1, int m2, int *number_of):
+cdef combinatorial_info_block generate_permutations(int n):
 
-        cdef int *p
-        cdef int fac, i, j
+        return generate_permutations_fixing(n, <int> 0)
 
-        # see if we've already generated it!
-        key = (n, s, m1, m2)
-        if key in previous_pair_combinations.keys():
-        
-                cib = <combinatorial_info_block>previous_pair_combinations[key]
-                fac = cib.np
-                p = cib.p
-        
-        else:
-        
-                fac = falling_factorial(n, s) * binomial(n - s, m1 - s) * binomial(n - m1, m2 - s)
-                p = <int *> malloc (sizeof(int) * n * fac)
-                i = 0
-                vertices = range(1, n + 1)
-                perms = Permutations(vertices, s)
-                for perm in perms:
-                        available_verts = [v for v in vertices if not v in perm]
-                        combs1 = Combinations(available_verts, m1 - s)
-                        first_one = True
-                        for comb1 in combs1:
-                                remaining_verts = [v for v in available_verts if not v in comb1]
-                                combs2 = Combinations(remaining_verts, m2 - s)
-                                first_two = True
-                                for comb2 in combs2:
-                                        for j in range(s):
-                                                if first_one:
-                                                        p[(i * n) + j] = <int> perm[j]
-                                                else:
-                                                        p[(i * n) + j] = <int> 0
-                                        for j in range(m1 - s):
-                                                if first_two:
-                                                        p[(i * n) + s + j] = <int> comb1[j]
-                                                else:
-                                                        p[(i * n) + s + j] = <int> 0
-                                        for j in range(m2 - s):
-                                                p[(i * n) + m1 + j] = <int> comb2[j]
-                                        for j in range(n - m1 - m2 + s):
-                                                p[(i * n) + m1 + m2 - s + j] = <int> 0
-                                        first_one = False
-                                        first_two = False
-                                        i += 1                  
-
-                cib = combinatorial_info_block()
-                cib.np = fac
-                cib.p = p
-                previous_pair_combinations[key] = cib
-        
-        if number_of:
-                number_of[0] = fac
+def get_permutations (n):
+ 
+        return generate_permutations(n).table.tolist()
 
-        return p
 
-def get_pair_combinations (n, s, m1, m2):
+def combinations_table(n, s):
+        combs = Combinations(range(1, n + 1), s)
+        return vertex_table([[int(v) for v in comb] for comb in combs], s)
 
-        cdef int *p
-        cdef int np, i, j
-        
-        p = generate_pair_combinations(n, s, m1, m2, &np)
-        return [[p[(i * n) + j] for j in range(n)] for i in range(np)]
+cdef combinatorial_info_block generate_combinations(int n, int s):
 
+        return info_block(("combinations", n, s), combinations_table, (n, s))
 
-previous_equal_pair_combinations = {}
+def get_combinations (n, s):
 
-cdef int *generate_equal_pair_combinations(int n, int s, int m, int *number_of):
+        return generate_combinations(n, s).table.tolist()
 
-        cdef int *p
-        cdef int fac, i, j, smallest
-        
-        # see if we've already generated it!
-        key = (n, s, m)
-        if key in previous_equal_pair_combinations.keys():
-                
-                cib = <combinatorial_info_block>previous_equal_pair_combinations[key]
-                fac = cib.np
-                p = cib.p
 
-        else:
-                fac = falling_factorial(n, s) * binomial(n - s, m - s) * binomial(n - m, m - s)/2
-                p = <int *> malloc (sizeof(int) * n * fac)
-                i = 0
-                vertices = range(1, n + 1)
-                perms = Permutations(vertices, s)
-                for perm in perms:
-                        available_verts = [v for v in vertices if not v in perm]
-                        combs1 = Combinations(available_verts, m - s)
-                        first_one = True
-                        for comb1 in combs1:
-                                remaining_verts = [v for v in available_verts if not v in comb1]
-                                combs2 = Combinations(remaining_verts, m - s)
-                                smallest = min(comb1)
-                                first_two = True
-                                for comb2 in combs2:
-                                        if min(comb2) < smallest:
-                                                continue
-                                        for j in range(s):
-                                                if first_one:
-                                                        p[(i * n) + j] = <int> perm[j]
-                                                else:
-                                                        p[(i * n) + j] = <int> 0
-                                        for j in range(m - s):
-                                                if first_two:
-                                                        p[(i * n) + s + j] = <int> comb1[j]
-                                                else:
-                                                        p[(i * n) + s + j] = <int> 0
-                                        for j in range(m - s):
-                                                p[(i * n) + m + j] = <int> comb2[j]
-                                        for j in range(n - m - m + s):
-                                                p[(i * n) + m + m - s + j] = <int> 0
-                                        first_one = False
-                                        first_two = False
-                                        i += 1                  
-
-                cib = combinatorial_info_block()
-                cib.np = fac
-                cib.p = p
-                previous_equal_pair_combinations[key] = cib
-        
-        if number_of:
-                number_of[0] = fac
+# Combinations that always contain maximum element
+def combinations_plus_table(n, s):
+        combs = Combinations(range(1, n), s - 1)
+        return vertex_table([[int(v) for v in comb] + [n] for comb in combs], s)
+
+cdef combinatorial_info_block generate_combinations_plus(int n, int s):
+
+        return info_block(("combinations_plus", n, s), combinations_plus_table, (n, s))
+
+
+def get_combinations_plus (n, s):
+
+        return generate_combinations_plus(n, s).table.tolist()
+
+
+def pair_combinations_table(n, s, m1, m2, equal_flags_mode):
+        """
+        Returns the arrangements of an ordered s-tuple and disjoint sets of m1 - s and
+        m2 - s further vertices, one per row of width n. Entries that repeat the previous
+        row are 0, and so are the unused entries at the end of each row. In equal flags
+        mode, only the pairs of sets in which the smallest vertex is in the first set are
+        included.
+        """
+        rows = []
+        vertices = range(1, n + 1)
+        for perm in Permutations(vertices, s):
+                available_verts = [v for v in vertices if not v in perm]
+                first_one = True
+                for comb1 in Combinations(available_verts, m1 - s):
+                        remaining_verts = [v for v in available_verts if not v in comb1]
+                        first_two = True
+                        for comb2 in Combinations(remaining_verts, m2 - s):
+                                if equal_flags_mode and min(comb2) < min(comb1):
+                                        continue
+                                row = [int(v) if first_one else 0 for v in perm]
+                                row += [int(v) if first_two else 0 for v in comb1]
+                                row += [int(v) for v in comb2]
+                                row += [0] * (n - m1 - m2 + s)
+                                rows.append(row)
+                                first_one = False
+                                first_two = False
+        return vertex_table(rows, n)
 
-        return p
+cdef combinatorial_info_block generate_pair_combinations(int n, int s, int m1, int m2):
+
+        return info_block(("pair_combinations", n, s, m1, m2), pair_combinations_table, (n, s, m1, m2, False))
+
+def get_pair_combinations (n, s, m1, m2):
+
+        return generate_pair_combinations(n, s, m1, m2).table.tolist()
+
+
+cdef combinatorial_info_block generate_equal_pair_combinations(int n, int s, int m):
+
+        return info_block(("equal_pair_combinations", n, s, m), pair_combinations_table, (n, s, m, m, True))
 
 def get_equal_pair_combinations (n, s, m):
 
-        cdef int *p
-        cdef int np, i, j
-        p = generate_equal_pair_combinations(n, s, m, &np)
-        return [[p[(i * n) + j] for j in range(n)] for i in range(np)]
+        return generate_equal_pair_combinations(n, s, m).table.tolist()
+
+
+def disjoint_pairs_table(n, s):
+        combs = [set(c) for c in Combinations(range(1, n + 1), s)]
+        pairs = [(a, b) for a in range(len(combs)) for b in range(len(combs))
+                 if combs[a].isdisjoint(combs[b]) and min(combs[a]) < min(combs[b])]
+        return numpy.array(pairs, dtype=numpy.int32).reshape(len(pairs), 2)
+
+cdef generate_disjoint_pairs(int n, int s):
+        """
+        Returns the pairs (a, b) of indices into generate_combinations(n, s) for which the
+        s-sets a and b are disjoint and the smallest element of a is less than that of b,
+        as an int32 array: the indices can be too large to be stored as bytes.
+        """
+
+        return table_cache.get(("disjoint_pairs", n, s), disjoint_pairs_table, n, s)
+
+
+cdef unsigned int flag_hash(HypergraphFlag g):
+
+        cdef unsigned int h, he
+        cdef int i, j
+
+        # The edge hashes are added up, so the result does not depend on the order of the edges.
+        h = <unsigned int> (g._n * 1000003 + g._t * 1009 + g.ne)
+        for i in range(g.ne):
+                he = 2166136261U
+                for j in range(g._r):
+                        he = (he ^ <unsigned int> g._edges[i * g._r + j]) * 16777619U
+                h += he ^ (he >> 15)
+        h ^= h >> 16
+        h *= 2246822519U
+        h ^= h >> 13
+        return h
 
 
 cdef class graph_block:
         def __init__(self, graphs, n):
             
+            # The block only holds pointers to the graphs, so it keeps a reference to a
+            # list of them; flags taken from a PackedGraphs would otherwise be freed.
+            if not isinstance(graphs, list):
+                    graphs = list(graphs)
+            self.source = graphs
             self.n = n
             self.len = len(graphs)
             self.graphs = <void **> malloc(self.len * sizeof(void *))
             for i in range(self.len):
                     self.graphs[i] = <void *> graphs[i]
 
+
+        def __dealloc__(self):
+                free(self.graphs)
+                free(self.table)
+
+
+        cdef int find(self, HypergraphFlag g):
+                """
+                Returns the index of the first graph in the block that is labelled
+                isomorphic to g, or -1 if there is none. The graphs are hashed the
+                first time this is called, so each lookup takes constant time.
+                """
+
+                cdef int i, j
+                cdef unsigned int mask, slot
+
+                if self.table == NULL:
+                        self.table_size = 8
+                        while self.table_size < 2 * self.len:
+                                self.table_size *= 2
+                        self.table = <int *> calloc(self.table_size, sizeof(int))
+                        mask = self.table_size - 1
+                        for i in range(self.len):
+                                if self.find(<HypergraphFlag> self.graphs[i]) != -1:
+                                        continue
+                                slot = flag_hash(<HypergraphFlag> self.graphs[i]) & mask
+                                while self.table[slot] != 0:
+                                        slot = (slot + 1) & mask
+                                self.table[slot] = i + 1
+
+                mask = self.table_size - 1
+                slot = flag_hash(g) & mask
+                while self.table[slot] != 0:
+                        j = self.table[slot] - 1
+                        if g.is_labelled_isomorphic(<HypergraphFlag> self.graphs[j]):
+                                return j
+                        slot = (slot + 1) & mask
+                return -1
+
+
+        def index(self, HypergraphFlag g):
+                return self.find(g)
+
 def make_graph_block(graphs, n):
         return graph_block(graphs, n)
+
+
+cdef class PackedGraphs:
+        """
+        A list of flags of the same order and number of labelled vertices, stored
+        compactly. The vertices of all the edges are packed into one uint8 array (in the
+        format of cache.pack_graphs), and a flag object is only made when it is accessed.
+        A packed flag takes a few bytes per edge, rather than the fixed-size edge array
+        of a HypergraphFlag.
+
+        The flags that are returned are immutable. Slices are PackedGraphs that share the
+        arrays of this one.
+        """
+
+        def __init__(self, graphs, flag_cls=None):
+
+                cdef HypergraphFlag g
+                cdef int i, j
+                cdef numpy.int64_t pos
+                cdef numpy.ndarray[numpy.int32_t, ndim=1] numbers
+                cdef numpy.ndarray[numpy.uint8_t, ndim=1] edges
+
+                if len(graphs) == 0 and flag_cls is None:
+                        raise ValueError("flag_cls must be given if there are no graphs.")
+
+                self.flag_cls = type(graphs[0]) if flag_cls is None else flag_cls
+                self.length = len(graphs)
+                self.first = 0
+
+                numbers = numpy.zeros(self.length, dtype=numpy.int32)
+                self.minimal = True
+                for i in range(self.length):
+                        g = <HypergraphFlag ?> graphs[i]
+                        if g.is_degenerate:
+                                raise NotImplementedError("degenerate graphs are not supported.")
+                        if i == 0:
+                                self.n = g._n
+                                self.t = g._t
+                                self.r = g._r
+                                self.oriented = g._oriented
+                                self.multiplicity = g._multiplicity
+                        elif g._n != self.n or g._t != self.t or g._r != self.r:
+                                raise ValueError("graphs must all have the same order, number of labelled vertices and edge size.")
+                        numbers[i] = g.ne
+                        if not g._certified_minimal_isomorph:
+                                self.minimal = False
+
+                self.numbers = numbers
+                self.offsets = numpy.concatenate([[0], numpy.cumsum(numbers, dtype=numpy.int64) * self.r])
+
+                edges = numpy.empty(self.offsets[self.length], dtype=numpy.uint8)
+                pos = 0
+                for i in range(self.length):
+                        g = <HypergraphFlag> graphs[i]
+                        for j in range(g._r * g.ne):
+                                edges[pos] = g._edges[j]
+                                pos += 1
+                self.edges = edges
+
+
+        @classmethod
+        def from_arrays(cls, flag_cls, header, numbers, edges, oriented=None, multiplicity=None):
+                """
+                Returns the PackedGraphs with the given arrays, as made by cache.pack_graphs.
+                The arrays are used as they are, so they can be memory-mapped. If oriented or
+                multiplicity is not given, it is taken from a flag made by flag_cls().
+                """
+                cdef PackedGraphs pg = cls.__new__(cls)
+                cdef HypergraphFlag g
+                if oriented is None or multiplicity is None:
+                        g = <HypergraphFlag ?> flag_cls()
+                        oriented = g._oriented if oriented is None else oriented
+                        multiplicity = g._multiplicity if multiplicity is None else multiplicity
+                pg.flag_cls = flag_cls
+                pg.n, pg.t, pg.r, pg.minimal = [int(x) for x in header]
+                pg.oriented = oriented
+                pg.multiplicity = multiplicity
+                pg.numbers = numbers
+                pg.offsets = numpy.concatenate([[0], numpy.cumsum(numbers, dtype=numpy.int64) * pg.r])
+                pg.edges = edges
+                pg.first = 0
+                pg.length = len(numbers)
+                return pg
+
+
+        def pack(self):
+                """
+                Returns (header, numbers, edges) as cache.pack_graphs would for these flags.
+                """
+                header = numpy.array([self.n, self.t, self.r, self.minimal], dtype=numpy.int32)
+                numbers = self.numbers[self.first:self.first + self.length]
+                start = self.offsets[self.first]
+                edges = self.edges[start:self.offsets[self.first + self.length]]
+                return header, numbers, edges
+
+
+        def __reduce__(self):
+                header, numbers, edges = self.pack()
+                return (make_packed_graphs, (self.flag_cls, header, numpy.array(numbers), numpy.array(edges),
+                        self.oriented, self.multiplicity))
+
+
+        def __len__(self):
+                return self.length
+
+
+        property nbytes:
+                """
+                The number of bytes used by the arrays of the flags.
+                """
+
+                def __get__(self):
+                        return self.numbers.nbytes + self.offsets.nbytes + self.edges.nbytes
+
+
+        def __getitem__(self, index):
+
+                cdef PackedGraphs pg
+                cdef HypergraphFlag g
+                cdef int i, j, k
+                cdef numpy.int64_t start
+                cdef const numpy.uint8_t[:] edges
+
+                if isinstance(index, slice):
+                        first, last, step = index.indices(self.length)
+                        if step != 1:
+                                return [self[i] for i in range(first, last, step)]
+                        pg = PackedGraphs.__new__(PackedGraphs)
+                        pg.flag_cls = self.flag_cls
+                        pg.n, pg.t, pg.r, pg.minimal = self.n, self.t, self.r, self.minimal
+                        pg.oriented = self.oriented
+                        pg.multiplicity = self.multiplicity
+                        pg.numbers = self.numbers
+                        pg.offsets = self.offsets
+                        pg.edges = self.edges
+                        pg.first = self.first + first
+                        pg.length = max(last - first, 0)
+                        return pg
+
+                i = index
+                if i < 0:
+                        i += self.length
+                if i < 0 or i >= self.length:
+                        raise IndexError("index out of range.")
+                i += self.first
+
+                g = self.flag_cls()
+                g._n = self.n
+                g._r = self.r
+                g._oriented = self.oriented
+                g._multiplicity = self.multiplicity
+                g.ne = self.numbers[i]
+                start = self.offsets[i]
+                edges = self.edges
+                for j in range(self.r * g.ne):
+                        g._edges[j] = edges[start + j]
+                g._t = self.t
+                g._certified_minimal_isomorph = self.minimal
+                g.set_immutable()
+                return g
+
+
+        def __iter__(self):
+                for i in range(self.length):
+                        yield self[i]
+
+
+        def __repr__(self):
+                return "PackedGraphs of %d flags of order %d with %d labelled vertices" % (self.length, self.n, self.t)
+
+
+def make_packed_graphs(flag_cls, header, numbers, edges, oriented=None, multiplicity=None):
+        return PackedGraphs.from_arrays(flag_cls, header, numbers, edges, oriented, multiplicity)
+
+
+def certify_minimal_isomorph(HypergraphFlag g):
+        """
+        Marks g as a minimal isomorph, without checking. Only for flags that were minimal
+        isomorphs when they were stored, such as those read back from the cache.
+        """
+        g._certified_minimal_isomorph = True
+
+
+cdef class induced_flag_index:
+        """
+        The flags of order m with s labelled vertices that are induced in the graphs with
+        indices in range(first, last) of a graph block. For every graph, ordered s-tuple
+        of its vertices (the embedding of the type) and (m - s)-subset of the remaining
+        vertices, the index of the induced flag in self.flags is stored. As the type is
+        not fixed, the index can be shared by all the types of order s.
+        """
+
+        def __init__(self, graph_block gb, int s, int m, first=0, last=None):
+
+                cdef combinatorial_info_block combs_block, perms_block, subsets_block
+                cdef unsigned char *combs
+                cdef unsigned char *perms
+                cdef unsigned char *subsets
+                cdef int *row
+                cdef int ncombs, nperms, i, j, k, c, gi, ne, edge_bytes, num_graphs
+                cdef int verts[MAX_NUMBER_OF_VERTICES]
+                cdef int available[MAX_NUMBER_OF_VERTICES]
+                cdef int in_type[MAX_NUMBER_OF_VERTICES + 1]
+                cdef int edges[MAX_NUMBER_OF_EDGE_INTS]
+                cdef HypergraphFlag g, ig
+
+                if s < 0 or m < s or m > gb.n:
+                        raise ValueError("must have 0 <= s <= m <= n.")
+
+                self.n = gb.n
+                self.s = s
+                self.m = m
+                self.first = max(first, 0)
+                self.last = gb.len if last is None else min(last, gb.len)
+                self.flags = []
+
+                combs_block = generate_combinations(self.n, s)
+                combs = combs_block.p
+                ncombs = combs_block.np
+                perms_block = generate_permutations(s)
+                perms = perms_block.p
+                nperms = perms_block.np
+                subsets_block = generate_combinations(self.n - s, m - s)
+                subsets = subsets_block.p
+                self.num_subsets = subsets_block.np
+                self.num_embeddings = ncombs * nperms
+
+                num_graphs = max(self.last - self.first, 0)
+                self.ids = <int *> malloc(sizeof(int) * max(num_graphs * self.num_embeddings * self.num_subsets, 1))
+
+                # Flags are looked up by their labelled edges first, so that each one is only
+                # made minimal the first time those edges are seen.
+                canonical_ids = {}
+                labelled_ids = {}
+
+                for gi in range(self.first, self.last):
+
+                        g = <HypergraphFlag> gb.graphs[gi]
+                        if g.is_degenerate:
+                                raise NotImplementedError("degenerate graphs are not supported.")
+
+                        edge_bytes = g._r * sizeof(int)
+                        row = &self.ids[(gi - self.first) * self.num_embeddings * self.num_subsets]
+
+                        for i in range(ncombs):
+
+                                memset(in_type, 0, sizeof(int) * (self.n + 1))
+                                for k in range(s):
+                                        in_type[combs[i * s + k]] = 1
+                                k = 0
+                                for j in range(1, self.n + 1):
+                                        if not in_type[j]:
+                                                available[k] = j
+                                                k += 1
+
+                                for j in range(nperms):
+
+                                        for k in range(s):
+                                                verts[k] = combs[i * s + perms[j * s + k] - 1]
+
+                                        for c in range(self.num_subsets):
+
+                                                for k in range(m - s):
+                                                        verts[s + k] = available[subsets[c * (m - s) + k] - 1]
+
+                                                ne = g.c_induced_edges(verts, m, edges)
+                                                key = (<char *> edges)[:ne * edge_bytes]
+                                                fi = labelled_ids.get(key)
+
+                                                if fi is None:
+                                                        ig = g.c_induced_subgraph(verts, m)
+                                                        ig.t = s
+                                                        ig.make_minimal_isomorph()
+                                                        canonical_key = (<char *> ig._edges)[:ig.ne * edge_bytes]
+                                                        fi = canonical_ids.get(canonical_key)
+                                                        if fi is None:
+                                                                fi = len(self.flags)
+                                                                canonical_ids[canonical_key] = fi
+                                                                self.flags.append(ig)
+                                                        labelled_ids[key] = fi
+
+                                                row[0] = fi
+                                                row += 1
+
+
+        def __dealloc__(self):
+                free(self.ids)
+
+
+cdef indexed_flag_products(induced_flag_index index, graph_block flags):
+        """
+        Returns the products of the flags with themselves in the graphs covered by index,
+        in the same form as flag_products.
+        """
+
+        cdef const numpy.int32_t[:, ::1] pairs_view
+        cdef int *pairs
+        cdef int *row
+        cdef int *flag_map
+        cdef int *mapped
+        cdef int *grb
+        cdef int npairs, found, i, e, gi, a, b, nrows, capacity
+        cdef numpy.int64_t *buf
+        cdef int size = index.num_embeddings * index.num_subsets
+
+        pairs_table = generate_disjoint_pairs(index.n - index.s, index.m - index.s)
+        npairs = pairs_table.shape[0]
+        pairs = NULL
+        if npairs > 0:
+                pairs_view = pairs_table
+                pairs = <int *> &pairs_view[0, 0]
+
+        flag_map = <int *> malloc(sizeof(int) * max(len(index.flags), 1))
+        for i in range(len(index.flags)):
+                flag_map[i] = flags.find(<HypergraphFlag> index.flags[i])
+
+        mapped = <int *> malloc(sizeof(int) * max(index.num_subsets, 1))
+        grb = <int *> malloc(sizeof(int) * max(flags.len * flags.len, 1))
+        nrows = 0
+        capacity = 1024
+        buf = <numpy.int64_t *> malloc(sizeof(numpy.int64_t) * 5 * capacity)
+
+        for gi in range(index.first, index.last):
+
+                memset(grb, 0, flags.len * flags.len * sizeof(int))
+
+                for e in range(index.num_embeddings):
+
+                        row = &index.ids[(gi - index.first) * size + e * index.num_subsets]
+
+                        found = 0
+                        for i in range(index.num_subsets):
+                                mapped[i] = flag_map[row[i]]
+                                if mapped[i] != -1:
+                                        found = 1
+
+                        if found == 0:
+                                continue
+
+                        for i in range(npairs):
+                                a = mapped[pairs[2 * i]]
+                                b = mapped[pairs[2 * i + 1]]
+                                if a != -1 and b != -1:
+                                        grb[(a * flags.len) + b] += 1
+
+                buf = store_products(buf, &nrows, &capacity, gi, grb, flags.len, flags.len,
+                        True, index.num_embeddings * npairs * 2)
+
+        rarray = products_array(buf, nrows)
+
+        free(buf)
+        free(flag_map)
+        free(mapped)
+        free(grb)
+
+        return rarray
     
 # def make_graph_block(graphs, n):
 # 
@@ -0,0 +1,227 @@
+"""
+
+flagmatic 2
+
+Copyright (c) 2012, E. R. Vaughan. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1) Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+
+2) Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation and/or
+other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Further development of Flagmatic is supported by ERC.
+http://cordis.europa.eu/project/rcn/104324_en.html
+"""
+
+import atexit, math, os, shutil, tempfile
+import multiprocessing as mp
+import numpy
+
+from tqdm import tqdm
+
+from .cache import pack_graphs
+
+pool_processes = None
+pool_start_method = None
+pool_chunksize = None
+
+shared_pool = None
+
+
+def configure_pool(processes=None, start_method=None, chunksize=None):
+    r"""
+    Sets up the worker pool shared by Problem, BlowupConstruction and graph generation.
+
+    INPUT:
+
+     - ``processes`` -- (default: None) number of worker processes. If None, the number
+       of CPUs is used.
+
+     - ``start_method`` -- (default: None) "fork", "spawn" or "forkserver". If None, the
+       platform default is used.
+
+     - ``chunksize`` -- (default: None) number of items sent to a worker at a time by
+       ``chunked_map``. If None, the items are split into about four chunks per worker.
+
+    Any running pool is shut down; a new one is started the next time it is needed.
+    Problem and BlowupConstruction objects that use the shared pool fetch it each time,
+    so existing ones move to the new pool. Pools passed to them explicitly are not
+    affected.
+    """
+    global pool_processes, pool_start_method, pool_chunksize
+    close_pool()
+    pool_processes = processes
+    pool_start_method = start_method
+    pool_chunksize = chunksize
+
+
+def get_pool():
+    r"""
+    Returns the shared worker pool, starting it if necessary.
+    """
+    global shared_pool
+    if shared_pool is None:
+        context = mp.get_context(pool_start_method)
+        shared_pool = context.Pool(pool_processes)
+    return shared_pool
+
+
+def close_pool():
+    r"""
+    Shuts down the shared worker pool and waits for its processes to exit.
+    """
+    global shared_pool
+    if shared_pool is not None:
+        shared_pool.close()
+        shared_pool.join()
+        shared_pool = None
+
+
+atexit.register(close_pool)
+
+
+def pool_size(pool):
+    r"""
+    Returns the number of worker processes of pool.
+    """
+    return getattr(pool, "_processes", None) or mp.cpu_count()
+
+
+def apply_chunk_mp(func, chunk, shared):
+    return [func(item, *shared) for item in chunk]
+
+
+def chunked_map(pool, func, items, shared=(), show_progress=False):
+    r"""
+    Returns the list [func(item, *shared) for item in items], computed by the workers of
+    pool. The items are sent in chunks, so the arguments in ``shared`` are pickled once
+    per chunk rather than once per item.
+    """
+    items = list(items)
+    if len(items) == 0:
+        return []
+
+    chunksize = pool_chunksize
+    if chunksize is None:
+        chunksize = max(1, -(-len(items) // (4 * pool_size(pool))))
+
+    arguments = [(func, items[i:i + chunksize], shared) for i in range(0, len(items), chunksize)]
+
+    results = []
+    for chunk_results in pool.starmap(apply_chunk_mp, tqdm(arguments) if show_progress else arguments, chunksize=1):
+        results.extend(chunk_results)
+    return results
+
+
+def split_work(costs, sizes, parts):
+    r"""
+    Splits jobs into work units of roughly equal cost. Job i consists of ``sizes[i]``
+    items, each of which costs about ``costs[i]``, and is cut into ranges of consecutive
+    items so that there are about ``parts`` units in all.
+
+    Returns a list of triples (i, first, last), most expensive first, so that the largest
+    units are started first and the small ones fill in at the end.
+    """
+    total = sum(c * s for c, s in zip(costs, sizes))
+    unit_cost = max(total / max(parts, 1), 1)
+
+    units = []
+    for i, (c, s) in enumerate(zip(costs, sizes)):
+        pieces = max(1, min(s, int(math.ceil(c * s / unit_cost))))
+        step = max(1, -(-s // pieces))
+        units.append((c * min(step, s), i, 0, min(step, s)))
+        for first in range(step, s, step):
+            last = min(first + step, s)
+            units.append((c * (last - first), i, first, last))
+
+    units.sort(key=lambda u: -u[0])
+    return [u[1:] for u in units]
+
+
+# Lists opened by this process from shared graph files, keyed on (directory, index).
+loaded_graphs = {}
+
+
+class SharedGraphs(object):
+    r"""
+    Several lists of flags, packed into two memory-mapped files so that worker processes
+    can read them without the lists themselves being pickled. Pickling a SharedGraphs
+    object only sends the directory name and the offsets of the lists.
+
+    Each list must consist of flags of the same order and number of labelled vertices.
+    Call ``close`` once the workers are finished to delete the files.
+    """
+
+    def __init__(self, flag_cls, graph_lists):
+
+        self.flag_cls = flag_cls
+        self.directory = tempfile.mkdtemp(prefix="flagmatic-")
+        self._owner = os.getpid()
+
+        packed = [pack_graphs(graphs) for graphs in graph_lists]
+        self.headers = numpy.array([p[0] for p in packed], dtype=numpy.int32).reshape(-1, 4)
+        self.graph_offsets = numpy.cumsum([0] + [len(p[1]) for p in packed])
+        self.edge_offsets = numpy.cumsum([0] + [len(p[2]) for p in packed])
+
+        numbers = numpy.concatenate([p[1] for p in packed] + [numpy.zeros(0, dtype=numpy.int32)])
+        edges = numpy.concatenate([p[2] for p in packed] + [numpy.zeros(0, dtype=numpy.uint8)])
+        numpy.save(os.path.join(self.directory, "numbers.npy"), numbers)
+        numpy.save(os.path.join(self.directory, "edges.npy"), edges)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_owner"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._owner = None
+
+    def __len__(self):
+        return len(self.headers)
+
+    def graphs(self, i, keep=False):
+        r"""
+        Returns the i-th list of flags, as a PackedGraphs over the memory-mapped files, so
+        that a flag is only unpacked when it is accessed. If ``keep`` is True, the list is
+        also kept by this process, so that later calls with the same i do not open it again.
+        """
+        from .hypergraph_flag import PackedGraphs
+
+        key = (self.directory, i)
+        if key in loaded_graphs:
+            return loaded_graphs[key]
+
+        numbers = numpy.load(os.path.join(self.directory, "numbers.npy"), mmap_mode="r")
+        edges = numpy.load(os.path.join(self.directory, "edges.npy"), mmap_mode="r")
+        graphs = PackedGraphs.from_arrays(self.flag_cls, self.headers[i],
+                                          numbers[self.graph_offsets[i]:self.graph_offsets[i + 1]],
+                                          edges[self.edge_offsets[i]:self.edge_offsets[i + 1]])
+        if keep:
+            for other in [k for k in loaded_graphs if k[0] != self.directory]:
+                del loaded_graphs[other]
+            loaded_graphs[key] = graphs
+        return graphs
+
+    def close(self):
+        r"""
+        Deletes the files. Only the process that created them can do this.
+        """
+        if self._owner == os.getpid() and os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
@@ -31,22 +31,23 @@ Further development of Flagmatic is supported by ERC.
 http://cordis.europa.eu/project/rcn/104324_en.html
 """
 
-import gzip, json, os, sys
+import gzip, json, os, queue, shutil, sys, tempfile, threading
 import numpy
 import itertools
-import pexpect
 import sage.all
 
 from sage.structure.sage_object import SageObject
 from sage.rings.all import Integer, Rational, QQ, ZZ, RDF
+from sage.arith.all import binomial, gcd, random_prime
+from sage.rings.finite_rings.finite_field_constructor import GF
 from sage.functions.other import floor
-from sage.matrix.all import matrix, identity_matrix, block_matrix, block_diagonal_matrix
+from sage.matrix.all import matrix, identity_matrix, diagonal_matrix, block_matrix, block_diagonal_matrix
 from sage.modules.misc import gram_schmidt
 from sage.misc.misc import SAGE_TMP
 #from sage.combinat.all import Permutations, Combinations, Tuples
 from sage.matrix.constructor import ones_matrix, vector
 
-from .hypergraph_flag import make_graph_block, print_graph_block
+from .hypergraph_flag import make_graph_block, print_graph_block, induced_flag_index, PackedGraphs
 from .flag import *
 from .three_graph_flag import *
 from .graph_flag import *
@@ -54,15 +55,15 @@ from .oriented_graph_flag import *
 from .multigraph_flag import *
 from .construction import *
 from .blowup_construction import *
+from .sdp_solver import CSDPSolver, DSDPSolver, SDPASolver, make_run_directory, read_sdp_solution
+from .parallel import get_pool, pool_size, chunked_map, split_work, SharedGraphs
+from .cache import lookup_graphs, store_graphs, graphs_digest, products_key, lookup_products, store_products, set_cache, clear_cache
 
 from copy import copy, deepcopy
 import math
 
 from tqdm import tqdm
 
-# pexpect in Sage 4.8 has a bug, which prevents it using commands with full paths.
-# So for now, CSDP has to be in a directory in $PATH.
-
 cdsp_cmd = "csdp"
 sdpa_cmd = "sdpa"
 sdpa_dd_cmd = "sdpa_dd"
@@ -119,6 +120,8 @@ def safe_gram_schmidt(M):
 
 
 def LDLdecomposition(M):  # TODO: does this handle matrices with zero eigenvalues?
+    if M.base_ring() == QQ:
+        return fraction_free_LDLdecomposition(M)
     MS = M.parent()
     D = MS.matrix()
     if M.is_zero():
@@ -134,31 +137,407 @@ def LDLdecomposition(M):  # TODO: does this handle matrices with zero eigenvalue
     return L, D
 
 
-def process_products_mp(tg, flag, n, flag_cls, graphs):
-    graph_block = make_graph_block(graphs, n)
-    
-    s = tg.n
-    m = (n + s) / 2
-    
-    flags_block = make_graph_block(flag, m)
-    rarray = flag_cls.flag_products(graph_block, tg, flags_block, None)
-    
-    return rarray
+def fraction_free_LDLdecomposition(M):
+    r"""
+    Returns the same decomposition M = L * D * L.T as ``LDLdecomposition``, for a rational
+    matrix M. It is computed by fraction-free (Bareiss) elimination on an integer multiple
+    of M, in which every intermediate entry is an integer (a minor of that multiple), so
+    that there is no growth of rational entries; fractions are formed only for the final
+    entries of L and D.
+    """
+    MS = M.parent()
+    n = M.nrows()
+    if M.is_zero():
+        D = MS.matrix()
+        D.set_immutable()
+        return D, D
+    d = M.denominator()
+    A = numpy.array([int(x) for x in (M * d).list()], dtype=object).reshape(n, n)
+    L = dict(((i, i), Integer(1)) for i in range(n))
+    D = {}
+    previous = 1
+    for k in range(n):
+        pivot = A[k, k]
+        D[(k, k)] = Integer(pivot) / (previous * d)
+        if k + 1 < n:
+            if pivot == 0:
+                raise ZeroDivisionError("rational division by zero")
+            for i, x in enumerate(A[k + 1:, k].tolist(), k + 1):
+                if x != 0:
+                    L[(i, k)] = Integer(x) / pivot
+            A[k + 1:, k + 1:] = (pivot * A[k + 1:, k + 1:] - numpy.outer(A[k + 1:, k], A[k, k + 1:])) // previous
+        previous = pivot
+    L = MS(L)
+    D = MS(D)
+    L.set_immutable()
+    D.set_immutable()
+    return L, D
+
+
+def verify_modular(R, D, Q):
+    r"""
+    Checks that Q = R * D * R.T modulo a random prime of about 60 bits (chosen so that it
+    divides none of the denominators). If the identity does not hold, this returns True
+    only with a negligible probability.
+    """
+    denominator = R.denominator().lcm(D.denominator()).lcm(Q.denominator())
+    p = random_prime(2 ** 61, lbound=2 ** 60)
+    while denominator % p == 0:
+        p = random_prime(2 ** 61, lbound=2 ** 60)
+    F = GF(p)
+    R = R.change_ring(F)
+    return Q.change_ring(F) == R * D.change_ring(F) * R.T
+
+
+class LazyMatrixList(object):
+    r"""
+    A list of square matrices over field, kept as numpy arrays. Each one is turned into an
+    (immutable) Sage matrix the first time it is accessed.
+    """
+
+    def __init__(self, field, arrays):
+        self._field = field
+        self._arrays = arrays
+        self._matrices = [None] * len(arrays)
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def __getitem__(self, i):
+        if self._matrices[i] is None:
+            M = matrix(self._field, self._arrays[i].shape[0], self._arrays[i].shape[1], self._arrays[i].flatten().tolist())
+            M.set_immutable()
+            self._matrices[i] = M
+        return self._matrices[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def array(self, i):
+        return self._arrays[i]
+
+
+class IncrementalRank(object):
+    r"""
+    Keeps a set of linearly independent vectors in echelon form, so that testing whether a
+    new vector is independent of them, and adding it if it is, takes O(rank * length)
+    operations rather than an echelonization from scratch.
+
+    If ``prime`` is given (it must be less than 2^25), the vectors must be rational, and the
+    test is done modulo ``prime`` with numpy. A vector that is independent modulo the prime
+    is independent over the rationals; with an unlucky prime, an independent vector may
+    (rarely) be rejected.
+    """
+
+    def __init__(self, field, length, prime=None):
+        if prime is not None and (prime >= 2 ** 25 or not Integer(prime).is_prime()):
+            raise ValueError("prime must be a prime less than 2^25.")
+        self._field = field
+        self._prime = prime
+        self._pivots = []
+        if prime is None:
+            self._rows = []
+        else:
+            self._rows = numpy.zeros((0, length), dtype=numpy.int64)
+
+    def rank(self):
+        return len(self._pivots)
+
+    def add(self, v):
+        r"""
+        Adds the vector v if it is independent of the vectors added so far. Returns True
+        if it was added, and False otherwise.
+        """
+        if self._prime is None:
+            return self._add_exact(v)
+        return self._add_modular(v)
+
+    def _add_exact(self, v):
+        # Each row is zero in the pivots of the rows before it, so one pass suffices.
+        v = vector(self._field, v)
+        for q, row in zip(self._pivots, self._rows):
+            if v[q] != 0:
+                v -= v[q] * row
+        nonzero = v.nonzero_positions()
+        if len(nonzero) == 0:
+            return False
+        q = nonzero[0]
+        self._rows.append(v / v[q])
+        self._pivots.append(q)
+        return True
+
+    def _add_modular(self, v):
+        # The rows are kept fully reduced, so v is reduced with one matrix product (split
+        # up so that the sums cannot overflow).
+        p = self._prime
+        try:
+            w = numpy.array([int(x.numerator()) * pow(int(x.denominator()), -1, p) % p
+                             for x in (QQ(x) for x in v)], dtype=numpy.int64)
+        except ValueError:
+            raise ValueError("the prime divides a denominator.")
+        c = w[self._pivots]
+        for start in range(0, len(c), 4096):
+            w = (w - c[start:start + 4096] @ self._rows[start:start + 4096] % p) % p
+        nonzero = numpy.flatnonzero(w)
+        if len(nonzero) == 0:
+            return False
+        q = nonzero[0]
+        w = w * pow(int(w[q]), p - 2, p) % p
+        self._rows = numpy.vstack([(self._rows - numpy.outer(self._rows[:, q], w) % p) % p, w])
+        self._pivots.append(q)
+        return True
+
+
+def exact_product_sums(num_graphs, product_arrays, Q_matrices):
+    r"""
+    Returns a list whose gi-th entry is the sum, over the given types, of the inner
+    products of the Q matrix with the matrix of flag products for graph gi. The Q matrices
+    must be rational. They and the products are scaled to integers over common
+    denominators, and the sums are accumulated in arrays of Python integers, so that the
+    only rational arithmetic is in the final division.
+    """
+    numerators = numpy.zeros(num_graphs, dtype=object)
+    denominator = Integer(1)
+
+    for rarray, Q in zip(product_arrays, Q_matrices):
+        rarray = numpy.asarray(rarray, dtype=numpy.int64).reshape(-1, 5)
+        if len(rarray) == 0:
+            continue
+        q_denominator = Q.denominator()
+        QI = numpy.array([int(x) for x in (Q * q_denominator).list()], dtype=object).reshape(Q.nrows(), Q.ncols())
+        p_denominator = int(numpy.lcm.reduce(rarray[:, 4]))
+        j, k = rarray[:, 1], rarray[:, 2]
+        weights = (rarray[:, 3] * (p_denominator // rarray[:, 4]) * numpy.where(j != k, 2, 1)).astype(object)
+        sums = numpy.zeros(num_graphs, dtype=object)
+        numpy.add.at(sums, rarray[:, 0], weights * QI[j, k])
+
+        d = q_denominator * p_denominator
+        new_denominator = denominator.lcm(d)
+        numerators = numerators * int(new_denominator // denominator) + sums * int(new_denominator // d)
+        denominator = new_denominator
+
+    return [Integer(n) / denominator for n in numerators.tolist()]
+
+
+def sdp_value_strings(numerators, denominators, digits):
+    r"""
+    Returns an array with the decimal expansions, to the given number of digits, of the
+    fractions numerators[i] / denominators[i]. Products take only a few distinct values,
+    so each distinct fraction is converted only once.
+    """
+    pairs = numpy.stack([numpy.asarray(numerators, dtype=numpy.int64),
+                         numpy.asarray(denominators, dtype=numpy.int64)], axis=1).reshape(-1, 2)
+    if len(pairs) == 0:
+        return numpy.zeros(0, dtype=object)
+    distinct, inverse = numpy.unique(pairs, axis=0, return_inverse=True)
+    strings = numpy.array([str((Integer(int(a)) / Integer(int(b))).n(digits=digits)) for a, b in distinct], dtype=object)
+    return strings[inverse.reshape(-1)]
+
+
+def write_sdp_entries(f, constraints, blocks, rows, cols, values, chunk_size=100000):
+    r"""
+    Writes lines "constraint block row column value" to f, formatting them in chunks so
+    that there is one call to f.write per chunk.
+    """
+    for start in range(0, len(values), chunk_size):
+        stop = start + chunk_size
+        f.write("".join(["%d %d %d %d %s\n" % line for line in zip(constraints[start:stop].tolist(), blocks[start:stop].tolist(),
+                                                                   rows[start:stop].tolist(), cols[start:stop].tolist(),
+                                                                   values[start:stop].tolist())]))
+
+
+def integral_rows(M):
+    r"""
+    Returns the matrix obtained by scaling each row of the rational matrix M to a primitive
+    integer vector. Row subdivisions are kept.
+    """
+    rows = []
+    for row in M.rows():
+        row = row * row.denominator()
+        g = gcd(row.list())
+        rows.append(row / g if g != 0 else row)
+    N = matrix(ZZ, M.nrows(), M.ncols(), rows, sparse=True)
+    N.subdivide(M.subdivisions()[0], None)
+    return N
+
+
+def transform_products(rarray, B, exact=False):
+    r"""
+    Given the rows (gi, j, k, numerator, denominator) of the flag products of a type, with
+    j <= k, returns the entries with a <= b of the products B * P * B.T, where P is the
+    symmetric matrix of products for graph gi, and B is a rational matrix. The result is
+    a tuple (gi, a, b, numerators, denominator) of arrays and a common denominator; only
+    non-zero entries are included, sorted by (gi, a, b).
+
+    The arithmetic is done with int64 arrays, and ValueError is raised if it could
+    overflow. If ``exact`` is True, Python integers are used instead, which cannot
+    overflow.
+    """
+    rarray = numpy.asarray(rarray, dtype=numpy.int64).reshape(-1, 5)
+    dtype = object if exact else numpy.int64
+
+    radix = max(B.nrows(), B.ncols())
+    entries = B.dict()
+    scale = Integer(1)
+    for v in entries.values():
+        scale = scale.lcm(QQ(v).denominator())
+    brows = numpy.array([key[0] for key in entries], dtype=numpy.int64)
+    bcols = numpy.array([key[1] for key in entries], dtype=numpy.int64)
+    bvalues = numpy.array([int(v * scale) for v in entries.values()], dtype=dtype)
+    order = numpy.argsort(bcols, kind="stable")
+    brows, bvalues = brows[order], bvalues[order]
+    counts = numpy.bincount(bcols, minlength=B.ncols())
+    starts = numpy.cumsum(counts) - counts
+
+    if len(rarray) == 0 or len(entries) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty, empty, numpy.zeros(0, dtype=dtype), 1
+
+    denominator = int(numpy.lcm.reduce(rarray[:, 4]))
+    gi, j, k = rarray[:, 0], rarray[:, 1], rarray[:, 2]
+    numerators = (rarray[:, 3] * (denominator // rarray[:, 4])).astype(dtype)
+
+    if not exact:
+        # No partial sum of an entry of B * P * B.T is larger than this.
+        row_norms = numpy.zeros(B.nrows(), dtype=object)
+        numpy.add.at(row_norms, brows, numpy.abs(bvalues).astype(object))
+        if int(numpy.abs(numerators).max()) * int(row_norms.max()) ** 2 >= 2 ** 63:
+            raise ValueError("the entries of the basis are too large.")
+
+    # Each stored entry with j < k stands for both (j, k) and (k, j).
+    off = j != k
+    gi = numpy.concatenate([gi, gi[off]])
+    j, k = numpy.concatenate([j, k[off]]), numpy.concatenate([k, j[off]])
+    numerators = numpy.concatenate([numerators, numerators[off]])
+
+    def multiply(gi, fixed, columns, numerators):
+        # Multiplies the entries (gi, fixed, column) by B.T on the right, giving entries
+        # (gi, fixed, row) with the sums of the products collected together.
+        lengths = counts[columns]
+        which = numpy.repeat(numpy.arange(len(columns)), lengths)
+        first = numpy.cumsum(lengths) - lengths
+        pos = starts[columns][which] + numpy.arange(len(which)) - first[which]
+        keys = (gi[which] * radix + fixed[which]) * radix + brows[pos]
+        keys, inverse = numpy.unique(keys, return_inverse=True)
+        sums = numpy.zeros(len(keys), dtype=dtype)
+        numpy.add.at(sums, inverse.reshape(-1), numerators[which] * bvalues[pos])
+        nonzero = sums != 0
+        keys, sums = keys[nonzero], sums[nonzero]
+        return keys // (radix * radix), keys // radix % radix, keys % radix, sums
+
+    # P * B.T, and then B * (P * B.T), using that P is symmetric.
+    gi, j, b, numerators = multiply(gi, j, k, numerators)
+    gi, b, a, numerators = multiply(gi, b, j, numerators)
+
+    upper = a <= b
+    gi, a, b, numerators = gi[upper], a[upper], b[upper], numerators[upper]
+    order = numpy.lexsort((b, a, gi))
+    return gi[order], a[order], b[order], numerators[order], denominator * int(scale) ** 2
+
+
+def change_products_basis(rarray, B, block_offsets):
+    r"""
+    Returns the rows (gi, a, b, numerator, denominator) of the flag products of a type in
+    the basis B (see ``transform_products``). B must be an integer matrix whose row
+    subdivisions, starting at block_offsets, make the transformed products block diagonal
+    (as the invariant anti-invariant bases returned by ``flag_basis`` do); entries between
+    blocks are checked to vanish.
+    """
+    gi, a, b, numerators, denominator = transform_products(rarray, B)
+
+    block_offsets = numpy.array(block_offsets)
+    if numpy.any(numpy.searchsorted(block_offsets, a, side="right") != numpy.searchsorted(block_offsets, b, side="right")):
+        raise ValueError("products are not block diagonal in the given basis.")
+
+    return numpy.stack([gi, a, b, numerators, numpy.full(len(numerators), denominator)], axis=1).astype(numpy.int64)
+
+
+# Largest number of entries of an induced_flag_index built by products_of_order.
+max_index_size = 2 ** 24
+
+# Number of graphs that add_assumption puts in one graph block, so that a PackedGraphs
+# is only unpacked this many graphs at a time.
+assumption_block_size = 2 ** 12
+
+
+def products_of_order(flag_cls, graphs, n, types, flags, first, last):
+    r"""
+    Returns the list of product arrays of the given types, which must all have the same
+    order s, in the graphs with indices in range(first, last). The flags induced in each
+    graph are found once, in an ``induced_flag_index`` that is shared by all the types.
+    The graphs are indexed a few at a time, so that an index has at most
+    ``max_index_size`` entries; if graphs is a ``PackedGraphs``, only those graphs are
+    unpacked at any one time.
+    """
+    s = types[0].n
+    m = (n + s) // 2
+    flags_blocks = [make_graph_block(F, m) for F in flags]
+
+    step = max(1, max_index_size // (math.perm(n, s) * math.comb(n - s, m - s)))
+    pieces = [[] for tg in types]
+    for start in range(first, last, step):
+        graph_block = make_graph_block(graphs[start:min(start + step, last)], n)
+        index = induced_flag_index(graph_block, s, m)
+        for i, tg in enumerate(types):
+            rarray = flag_cls.flag_products(graph_block, tg, flags_blocks[i], None, index=index)
+            rarray[:, 0] += start
+            pieces[i].append(rarray)
+
+    return [numpy.concatenate(P + [numpy.zeros((0, 5), dtype=numpy.int64)]) for P in pieces]
+
+
+def process_products_mp(types, flags, n, flag_cls, graphs, first):
+    # graphs is the slice of the graphs starting at index first.
+    rarrays = products_of_order(flag_cls, graphs, n, types, flags, 0, len(graphs))
+    for rarray in rarrays:
+        rarray[:, 0] += first
+    return rarrays
+
+
+def process_shared_products_mp(tis, first, last, shared, n):
+    graphs = shared.graphs(0, keep=True)
+    types = [shared.graphs(1 + 2 * ti)[0] for ti in tis]
+    flags = [shared.graphs(2 + 2 * ti) for ti in tis]
+    return products_of_order(shared.flag_cls, graphs, n, types, flags, first, last)
 
 
 def generate_flags_mp(flag_cls, m, tg, forbidden_edge_numbers, forbidden_graphs, forbidden_induced_graphs):
     return flag_cls.generate_flags(m, tg, forbidden_edge_numbers=forbidden_edge_numbers, forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs)
 
 
-def compute_densities_mp(g, dg):
-    dv = 0
-    for h, coeff in dg:
-        if h.n == g.n:
-            if g == h:
-                dv += coeff
-        else:
-            dv += coeff * g.subgraph_density(h)
-    return dv
+def subgraph_census_mp(flag_cls, graphs, k):
+    subgraphs, rows = flag_cls.subgraph_census(graphs, k)
+    return [str(h) for h in subgraphs], rows
+
+
+def subgraph_census(flag_cls, graphs, k, pool=None):
+    r"""
+    Returns a dictionary mapping the string representation of each (minimal) induced
+    subgraph of order k of the given graphs, which must all have the same order n, to
+    an int64 array of (gi, count) rows: graph gi has count k-sets of vertices that
+    induce it. With a pool, the graphs are split into chunks that are counted by the
+    workers. If graphs is a ``PackedGraphs``, the chunks are slices of it, and the
+    graphs are unpacked one at a time as they are counted.
+    """
+    if not isinstance(graphs, (list, PackedGraphs)):
+        graphs = list(graphs)
+    if pool is None or len(graphs) == 0:
+        parts = [subgraph_census_mp(flag_cls, graphs, k)]
+        offsets = [0]
+    else:
+        chunksize = max(1, -(-len(graphs) // (4 * pool_size(pool))))
+        offsets = list(range(0, len(graphs), chunksize))
+        parts = pool.starmap(subgraph_census_mp, [(flag_cls, graphs[i:i + chunksize], k) for i in offsets])
+
+    rows_by_subgraph = {}
+    for offset, (names, rows) in zip(offsets, parts):
+        for hi, name in enumerate(names):
+            hrows = rows[rows[:, 1] == hi][:, 0::2]
+            hrows[:, 0] += offset
+            rows_by_subgraph.setdefault(name, []).append(hrows)
+
+    return dict((name, numpy.concatenate(hrows)) for name, hrows in rows_by_subgraph.items())
 
 
 def round_mp(sdp_Qdash_matrix, q_size, field, meet_target_bound, denominator):
@@ -202,27 +581,39 @@ def round_mp(sdp_Qdash_matrix, q_size, field, meet_target_bound, denominator):
     return M, D, L
 
 
-def construct_r_mp(ti, flag, num_sharps, product_density, sharp_graphs, inverse_flag_base):
-    Ds = [matrix(QQ, len(flag), len(flag))
-        for si in range(num_sharps)]
-
-    for row in product_density:
-        gi = row[0]
-        if not gi in sharp_graphs:
-            continue
-        si = sharp_graphs.index(gi)
-        j = row[1]
-        k = row[2]
-        value = Integer(row[3]) / Integer(row[4])
-        Ds[si][j, k] = value
-        Ds[si][k, j] = value
-
-    if inverse_flag_base is not None:
+def construct_r_mp(ti, product_density, sharp_graphs, inverse_flag_base):
+    r"""
+    Returns the non-zero entries of the matrices B.T * D * B on or above the diagonal, as a
+    tuple (ti, si, j, k, values), where D is the matrix of products for the si-th sharp
+    graph and B is the inverse flag base (if it is not None).
+    """
+    rarray = numpy.asarray(product_density, dtype=numpy.int64).reshape(-1, 5)
+    sharp_graphs = numpy.array(sharp_graphs, dtype=numpy.int64)
+    order = numpy.argsort(sharp_graphs)
+    rarray = rarray[numpy.isin(rarray[:, 0], sharp_graphs)].copy()
+    rarray[:, 0] = order[numpy.searchsorted(sharp_graphs[order], rarray[:, 0])]
+
+    if inverse_flag_base is None:
+        si, j, k = rarray[:, 0], rarray[:, 1], rarray[:, 2]
+        values = [Integer(a) / Integer(b) for a, b in zip(rarray[:, 3].tolist(), rarray[:, 4].tolist())]
+    elif inverse_flag_base.base_ring() == QQ:
+        si, j, k, numerators, denominator = transform_products(rarray, inverse_flag_base.T, exact=True)
+        values = [Integer(a) / denominator for a in numerators]
+    else:
+        # Irrational bases: conjugate the matrix of each sharp graph.
         B = inverse_flag_base
-        for si in range(num_sharps):
-            Ds[si] = B.T * Ds[si] * B
-    
-    return ti, Ds
+        nf, q = B.nrows(), B.ncols()
+        Ds = [matrix(QQ, nf, nf) for si in range(len(sharp_graphs))]
+        for row in rarray.tolist():
+            Ds[row[0]][row[1], row[2]] = Ds[row[0]][row[2], row[1]] = Integer(row[3]) / Integer(row[4])
+        entries = []
+        for s_ in range(len(sharp_graphs)):
+            M = B.T * Ds[s_] * B
+            entries.extend((s_, j_, k_, value) for (j_, k_), value in sorted(M.dict().items()) if j_ <= k_)
+        si, j, k = (numpy.array([e[i] for e in entries], dtype=numpy.int64) for i in range(3))
+        values = [e[3] for e in entries]
+
+    return ti, si, j, k, values
 
 
 def diagonalize_mp(exact_Qdash_matrix, inverse_flag_base):
@@ -232,8 +623,11 @@ def diagonalize_mp(exact_Qdash_matrix, inverse_flag_base):
     return R, M
 
 
-def verify_mp(exact_r_matrix, exact_diagonal_matrix, exact_Q_matrix):
-    assert exact_Q_matrix == exact_r_matrix * exact_diagonal_matrix * exact_r_matrix.T
+def verify_mp(exact_r_matrix, exact_diagonal_matrix, exact_Q_matrix, modular=False):
+    if modular:
+        assert verify_modular(exact_r_matrix, exact_diagonal_matrix, exact_Q_matrix)
+    else:
+        assert exact_Q_matrix == exact_r_matrix * exact_diagonal_matrix * exact_r_matrix.T
     
 
 def eigvals_mp(ti, exact_Qdash_matrix):
@@ -250,7 +644,7 @@ class Problem(SageObject):
     def __init__(self, flag_cls, order=None, forbid_induced=None, forbid=None,
                  forbid_homomorphic_images=False, density=None, minimize=False,
                  type_orders=None, types=None, max_flags=None, compute_products=True,
-                 mode="plain", use_mp=True):
+                 mode="plain", use_mp=True, use_cache=True, pool=None):
         
         r"""
         Creates a new Problem object. Generally it is not necessary to call this method
@@ -280,12 +674,13 @@ class Problem(SageObject):
         - max_flags:
         - compute_products: set to True if need to compute flag products
         - mode: plain/optimization/feasibility (see Flagmatic documentation)
+        - use_cache: set to False to generate graphs and flags without using the on-disk cache
+        - use_mp: set to False to do everything in the current process
+        - pool: a multiprocessing pool to use instead of the shared one (see configure_pool)
         """
 
-        self.pool = None
-        if use_mp:
-            import multiprocessing as mp
-            self.pool = mp.Pool()
+        self._pool = pool
+        self._use_mp = use_mp
         
         self._flagmatic_version = "2.0"
 
@@ -310,7 +705,10 @@ class Problem(SageObject):
 
         self._assumptions = []
         self._assumption_flags = []
-        
+
+        self._sdp_use_blocks = False
+        self._sdp_project_zero_eigenvectors = False
+
         self.state("specify", "yes")
         self.set_objective(minimize=minimize)
 
@@ -347,9 +745,21 @@ class Problem(SageObject):
 
             
         if not order is None:
-            self.generate_flags(order, type_orders=type_orders, types=types, max_flags=max_flags, compute_products=compute_products)
+            self.generate_flags(order, type_orders=type_orders, types=types, max_flags=max_flags, compute_products=compute_products,
+                                use_cache=use_cache)
             
 
+    @property
+    def pool(self):
+        r"""
+        The worker pool to use, or None. Unless a pool was given, this is the shared pool,
+        fetched each time it is needed, so that a later ``configure_pool`` takes effect.
+        """
+        pool = getattr(self, "_pool", None)
+        if pool is None and getattr(self, "_use_mp", False):
+            pool = get_pool()
+        return pool
+
     def state(self, state_name=None, action=None):
         r"""
         Keeps track of which things have been done. To get a list of all the states, enter
@@ -410,15 +820,15 @@ class Problem(SageObject):
             }),
             ("set_block_matrix_structure", {
                 "requires": ["compute_flags"],
-                "depends": ["set_active_types"]
+                "depends": ["set_active_types", "set_construction", "add_zero_eigenvectors"]
             }),
             ("write_sdp_input_file", {
                 "requires": ["set_block_matrix_structure"],
-                "depends": ["set_objective", "set_active_types"]
+                "depends": ["set_objective", "set_active_types", "set_block_matrix_structure"]
             }),
             ("write_sdp_initial_point_file", {
                 "requires": ["set_block_matrix_structure"],
-                "depends": ["set_objective", "set_active_types"]
+                "depends": ["set_objective", "set_active_types", "set_block_matrix_structure"]
             }),
             ("run_sdp_solver", {
                 "requires": ["write_sdp_input_file"],
@@ -524,7 +934,8 @@ class Problem(SageObject):
 
     # TODO: sanity checking of type orders
 
-    def generate_flags(self, order, type_orders=None, types=None, max_flags=None, compute_products=True):
+    def generate_flags(self, order, type_orders=None, types=None, max_flags=None, compute_products=True, use_cache=True,
+                       compact=False):
         r"""
         Generates the types and flags that will be used in the problem.
 
@@ -548,6 +959,18 @@ class Problem(SageObject):
            will be computed. For some large problems this may take a long time. If False,
            then the flag products must be computed later using the ``compute_products``
            method.
+
+         - ``use_cache`` -- (default: True) Boolean. If True then graphs, types and flags
+           are looked up in the on-disk cache (see ``set_cache`` and ``clear_cache``)
+           before being generated, and stored there afterwards.
+
+         - ``compact`` -- (default: False) Boolean. If True then the admissible graphs and
+           the flags are kept as ``PackedGraphs``, which store the edges of each list in
+           one array of bytes and only make flag objects when they are accessed. This
+           uses much less memory for large problems, at the cost of unpacking the graphs
+           whenever they are used. Graphs and flags found in the cache are never all
+           unpacked at once; ones that have to be generated are packed as soon as they
+           have been generated.
         """
 
         n = order
@@ -564,14 +987,28 @@ class Problem(SageObject):
         self.state("compute_flags", "yes")
         self._n = n
 
+        forbidden = (self._forbidden_edge_numbers, self._forbidden_graphs, self._forbidden_induced_graphs)
+
         sys.stdout.write("Generating graphs...\n")
-        self._graphs = self._flag_cls.generate_graphs(n, forbidden_edge_numbers=self._forbidden_edge_numbers,
-                                                      forbidden_graphs=self._forbidden_graphs, forbidden_induced_graphs=self._forbidden_induced_graphs,
-                                                      use_mp=self.pool is not None, show_progress=True)
+        self._graphs = lookup_graphs(self._flag_cls, n, None, *forbidden, compact=compact) if use_cache else None
+        if self._graphs is None:
+            self._graphs = self._flag_cls.generate_graphs(n, forbidden_edge_numbers=self._forbidden_edge_numbers,
+                                                          forbidden_graphs=self._forbidden_graphs, forbidden_induced_graphs=self._forbidden_induced_graphs,
+                                                          use_mp=self.pool is not None, show_progress=True,
+                                                          pool=self.pool)
+            if use_cache:
+                store_graphs(self._flag_cls, n, None, *forbidden, self._graphs)
+        else:
+            sys.stdout.write("Using cached graphs.\n")
         sys.stdout.write("Generated %d graphs.\n" % len(self._graphs))
 
-        for g in self._graphs:    # Make all the graphs immutable
-            g.set_immutable()
+        if compact:
+            # Flags taken from a PackedGraphs are already immutable.
+            if not isinstance(self._graphs, PackedGraphs):
+                self._graphs = PackedGraphs(self._graphs, self._flag_cls)
+        else:
+            for g in self._graphs:    # Make all the graphs immutable
+                g.set_immutable()
 
         sys.stdout.write("Computing density...\n")
         self._compute_densities()
@@ -591,27 +1028,42 @@ class Problem(SageObject):
 
         for s, m in orders:
 
-            these_types = self._flag_cls.generate_graphs(s, forbidden_edge_numbers=self._forbidden_edge_numbers,
-                                                         forbidden_graphs=self._forbidden_graphs,
-                                                         forbidden_induced_graphs=self._forbidden_induced_graphs)
+            these_types = lookup_graphs(self._flag_cls, s, None, *forbidden) if use_cache else None
+            if these_types is None:
+                these_types = self._flag_cls.generate_graphs(s, forbidden_edge_numbers=self._forbidden_edge_numbers,
+                                                             forbidden_graphs=self._forbidden_graphs,
+                                                             forbidden_induced_graphs=self._forbidden_induced_graphs)
+                if use_cache:
+                    store_graphs(self._flag_cls, s, None, *forbidden, these_types)
 
             if types:
                 these_types = [h for h in these_types if h in allowed_types]
 
             sys.stdout.write("Generated %d types of order %d, " % (len(these_types), s))
 
+            these_flags = [lookup_graphs(self._flag_cls, m, tg, *forbidden, compact=compact) if use_cache else None for tg in these_types]
+            missing = [i for i in range(len(these_types)) if these_flags[i] is None]
+
             if self.pool is not None:
-                arguments = [(self._flag_cls, m, tg, self._forbidden_edge_numbers, self._forbidden_graphs, self._forbidden_induced_graphs) for tg in these_types]
-                these_flags = self.pool.starmap(generate_flags_mp, arguments)
+                arguments = [(self._flag_cls, m, these_types[i], self._forbidden_edge_numbers, self._forbidden_graphs, self._forbidden_induced_graphs) for i in missing]
+                for i, flags in zip(missing, self.pool.starmap(generate_flags_mp, arguments)):
+                    these_flags[i] = flags
                 
             else:
-                these_flags = []
-                for tg in these_types:
-                    these_flags.append(self._flag_cls.generate_flags(m, tg, forbidden_edge_numbers=self._forbidden_edge_numbers,
-                                                                     forbidden_graphs=self._forbidden_graphs,
-                                                                     forbidden_induced_graphs=self._forbidden_induced_graphs))
+                for i in missing:
+                    these_flags[i] = self._flag_cls.generate_flags(m, these_types[i], forbidden_edge_numbers=self._forbidden_edge_numbers,
+                                                                   forbidden_graphs=self._forbidden_graphs,
+                                                                   forbidden_induced_graphs=self._forbidden_induced_graphs)
+
+            if use_cache:
+                for i in missing:
+                    store_graphs(self._flag_cls, m, these_types[i], *forbidden, these_flags[i])
             sys.stdout.write("with %s flags of order %d.\n" % (sum([len(L) for L in these_flags]), m))
 
+            if compact:
+                these_flags = [flags if isinstance(flags, PackedGraphs) else PackedGraphs(flags, self._flag_cls)
+                               for flags in these_flags]
+
             self._types.extend(these_types)
             self._flags.extend(these_flags)
 
@@ -631,11 +1083,12 @@ class Problem(SageObject):
 
         for ti in range(num_types):              # Make everything immutable!
             self._types[ti].set_immutable()
-            for g in self._flags[ti]:
-                g.set_immutable()
+            if not isinstance(self._flags[ti], PackedGraphs):
+                for g in self._flags[ti]:
+                    g.set_immutable()
 
         if compute_products:
-            self.compute_products()
+            self.compute_products(use_cache=use_cache)
 
 
     @property
@@ -645,7 +1098,7 @@ class Problem(SageObject):
         no effect on the Problem.
 
         """
-        return copy(self._graphs)
+        return list(self._graphs)
 
     @property
     def types(self):
@@ -664,7 +1117,7 @@ class Problem(SageObject):
         will have no effect on the Problem.
 
         """
-        return copy(self._flags)
+        return [list(flags) for flags in self._flags]
 
     @property
     def density_graphs(self):
@@ -708,24 +1161,36 @@ class Problem(SageObject):
         
     def _compute_densities(self):
 
+        # The densities of all the smaller graphs of one order are found by a single
+        # census of the admissible graphs, rather than one pass over them per graph.
+        # Edge and non-edge densities are still given by subgraph_density, which just
+        # counts edges.
+        censuses = {}
+        for dg in self._density_graphs:
+            for h, coeff in dg:
+                if h.n < self._n and h.n != h.r and h.n not in censuses:
+                    censuses[h.n] = subgraph_census(self._flag_cls, self._graphs, h.n, pool=self.pool)
+
         self._densities = []
         for dg in self._density_graphs:
-            if self.pool is not None:
-                arguments = [(g, dg) for g in self._graphs]
-                density_values = self.pool.starmap(compute_densities_mp, arguments)
-            else:
-                density_values = []
-                for g in self._graphs:
-                    dv = 0
-                    for h, coeff in dg:
-                        if h.n == g.n:
-                            # comparison will be fast, as both g and h should have
-                            # _certified_minimal_isomorph set to True
-                            if g == h:
-                                dv += coeff
-                        else:
-                            dv += coeff * g.subgraph_density(h)
-                    density_values.append(dv)
+            density_values = [0 for g in self._graphs]
+            for h, coeff in dg:
+                if h.n == self._n:
+                    # comparison will be fast, as both g and h should have
+                    # _certified_minimal_isomorph set to True
+                    for gi, g in enumerate(self._graphs):
+                        if g == h:
+                            density_values[gi] += coeff
+                elif h.n == h.r:
+                    for gi, g in enumerate(self._graphs):
+                        density_values[gi] += coeff * g.subgraph_density(h)
+                else:
+                    minh = h.__copy__()
+                    minh.t = 0
+                    minh.make_minimal_isomorph()
+                    total = binomial(self._n, h.n)
+                    for gi, count in censuses[h.n].get(str(minh), ()):
+                        density_values[gi] += coeff * Integer(count) / total
             self._densities.append(density_values)
         
             
@@ -1142,19 +1607,20 @@ class Problem(SageObject):
         quantum_graphs = [[Integer(0) for i in range(num_graphs)] for j in range(num_densities)]
         
         assumption_flags_block = make_graph_block(assumption_flags, m)
-        graph_block = make_graph_block(self._graphs, self.n)
-        
-        for i in range(len(terms)):
-            fg = terms[i][0]
-            flags_block = make_graph_block([fg], fg.n)
-            rarray = self._flag_cls.flag_products(graph_block, tg, flags_block, assumption_flags_block)
-            
-            for row in rarray:
-                gi = row[0]
-                j = row[1]  # always 0
-                k = row[2]
-                value = Integer(row[3]) / Integer(row[4])
-                quantum_graphs[k][gi] += value * terms[i][1]
+        flags_blocks = [make_graph_block([term[0]], term[0].n) for term in terms]
+
+        for start in range(0, num_graphs, assumption_block_size):
+            graph_block = make_graph_block(self._graphs[start:start + assumption_block_size], self.n)
+
+            for i in range(len(terms)):
+                rarray = self._flag_cls.flag_products(graph_block, tg, flags_blocks[i], assumption_flags_block)
+
+                for row in rarray:
+                    gi = start + row[0]
+                    j = row[1]  # always 0
+                    k = row[2]
+                    value = Integer(row[3]) / Integer(row[4])
+                    quantum_graphs[k][gi] += value * terms[i][1]
 
         self._assumptions.append((tg, terms))
         self._assumption_flags.append(assumption_flags)
@@ -1577,59 +2043,117 @@ class Problem(SageObject):
                 MT.set_immutable()
                 self._inverse_flag_bases.append(MT)
 
-    def compute_products(self):
+    def compute_products(self, use_cache=True, share_graphs=True):
         r"""
         Computes the products of the flags. This method is by default called from
         ``generate_flags``, and so would normally not need to be invoked directly.
+
+        If ``use_cache`` is True, the product array of each type is looked up in the
+        on-disk cache first (keyed on the graphs, the type and its flags), and stored
+        there once computed. Cached arrays are memory-mapped rather than read into memory.
+
+        The types are taken an order at a time: the flags induced in each graph are found
+        once for all the types of the same order (see ``products_of_order``).
+
+        If a worker pool is in use, the work is split into ranges of graphs for each order,
+        of roughly equal estimated cost, so that large orders are shared between workers.
+        If ``share_graphs`` is True, the graphs and flags are written once to memory-mapped
+        files that the workers read from, rather than being pickled for every task.
         """
         self.state("compute_products", "yes")
 
         num_types = len(self._types)
-        graph_block = make_graph_block(self._graphs, self._n)
-        self._product_densities_arrays = []
+        self._product_densities_arrays = [None] * num_types
+
+        if use_cache:
+            graphs_hash = graphs_digest(self._graphs)
+            keys = [products_key(self._flag_cls, graphs_hash, self._types[ti], graphs_digest(self._flags[ti])) for ti in range(num_types)]
+            for ti in range(num_types):
+                self._product_densities_arrays[ti] = lookup_products(keys[ti])
+
+        missing = [ti for ti in range(num_types) if self._product_densities_arrays[ti] is None]
+        if len(missing) < num_types:
+            sys.stdout.write("Using cached products for %d types.\n" % (num_types - len(missing)))
 
         #sys.stdout.write("Computing products")
         print("Computing products...")
 
-        if self.pool is not None:
+        orders = sorted(set(self._types[ti].n for ti in missing))
+        groups = [[ti for ti in missing if self._types[ti].n == s] for s in orders]
 
-            # print("Applying pool to "+str(num_types)+" types in parallel")
+        if self.pool is not None and len(missing) > 0:
 
-            arguments = []
-            for ti in range(num_types):
-                arguments.append( (self._types[ti], self._flags[ti], self._n, self._flag_cls, self._graphs) )
+            # The cost of a graph is estimated by the number of flags that are indexed in
+            # it, plus the number of pairs of flags that are then looked up for each type.
+            costs = []
+            for group in groups:
+                s = self._types[group[0]].n
+                m = (self._n + s) // 2
+                costs.append(math.perm(self._n, s) * math.comb(self._n - s, m - s) * (1 + math.comb(self._n - m, m - s) * len(group)))
+            units = split_work(costs, [len(self._graphs)] * len(groups), 4 * pool_size(self.pool))
 
-            # print("Using "+str(mp.cpu_count())+" cores")
+            if share_graphs:
+                # The graphs, types and flags are written to memory-mapped files once, and
+                # only the type indices and graph ranges are sent to the workers.
+                graph_lists = [self._graphs]
+                for ti in range(num_types):
+                    graph_lists.extend([[self._types[ti]], self._flags[ti]])
+                shared = SharedGraphs(self._flag_cls, graph_lists)
+                arguments = [(groups[i], first, last, shared, self._n) for i, first, last in units]
+                try:
+                    rarrays = self.pool.starmap(process_shared_products_mp, tqdm(arguments), chunksize=1)
+                finally:
+                    shared.close()
+            else:
+                # Each task is only sent the graphs that it works on.
+                arguments = [([self._types[ti] for ti in groups[i]], [self._flags[ti] for ti in groups[i]], self._n,
+                              self._flag_cls, self._graphs[first:last], first) for i, first, last in units]
+                rarrays = self.pool.starmap(process_products_mp, tqdm(arguments), chunksize=1)
+
+            pieces = [[] for group in groups]
+            for (i, first, last), group_rarrays in zip(units, rarrays):
+                pieces[i].append((first, group_rarrays))
+            for i, group in enumerate(groups):
+                pieces[i].sort(key=lambda piece: piece[0])
+                for j, ti in enumerate(group):
+                    if len(pieces[i]) == 1:
+                        self._product_densities_arrays[ti] = pieces[i][0][1][j]
+                    else:
+                        self._product_densities_arrays[ti] = numpy.concatenate([group_rarrays[j] for first, group_rarrays in pieces[i]])
 
-            for rarray in self.pool.starmap(process_products_mp, tqdm(arguments)):
-                self._product_densities_arrays.append(rarray)
-            
-        
         else:
-            for ti in tqdm(range(num_types)):
-            
-                tg = self._types[ti]
-                s = tg.n
-                m = (self._n + s) / 2
-            
-                flags_block = make_graph_block(self._flags[ti], m)
-                rarray = self._flag_cls.flag_products(graph_block, tg, flags_block, None)
-                self._product_densities_arrays.append(rarray)
-            
-                #sys.stdout.write(".")
-                #sys.stdout.flush()
-            
-            #sys.stdout.write("\n")
+            for group in tqdm(groups):
+                rarrays = products_of_order(self._flag_cls, self._graphs, self._n, [self._types[ti] for ti in group],
+                                            [self._flags[ti] for ti in group], 0, len(self._graphs))
+                for ti, rarray in zip(group, rarrays):
+                    self._product_densities_arrays[ti] = rarray
+
+        if use_cache:
+            for ti in missing:
+                store_products(keys[ti], self._product_densities_arrays[ti])
 
     def _set_block_matrix_structure(self):
 
         self.state("set_block_matrix_structure", "yes")
 
         self._block_matrix_structure = []
+        self._sdp_block_bases = {}
+        self._sdp_block_products = {}
 
         for ti in self._active_types:
 
-            num_blocks, block_sizes, block_offsets = 1, [len(self._flags[ti])], [0]
+            B = None
+            if getattr(self, "_sdp_use_blocks", False):
+                B = self._flag_cls.flag_basis(self._types[ti], self._flags[ti], orthogonalize=False)
+            if getattr(self, "_sdp_project_zero_eigenvectors", False):
+                B = self._zero_eigenvector_complement(ti, B)
+
+            if B is not None:
+                B = integral_rows(B)
+                num_blocks, block_sizes, block_offsets = block_structure(B)
+                self._sdp_block_bases[ti] = B
+            else:
+                num_blocks, block_sizes, block_offsets = 1, [len(self._flags[ti])], [0]
 
             # Remove zero-sized blocks
             bi = 0
@@ -1660,12 +2184,91 @@ class Problem(SageObject):
                 block_offsets.append(b[2])
 
         return num_blocks, block_sizes, block_offsets, block_indices
-        
-        
+
+    def _zero_eigenvector_complement(self, ti, B=None):
+        r"""
+        Returns a matrix whose rows span the vectors orthogonal to the zero eigenvectors of
+        type ti. If a block basis B is given, the rows are found block by block, and the
+        returned matrix is subdivided in the same way.
+        """
+        nf = len(self._flags[ti])
+        Z = self._zero_eigenvectors[ti]
+
+        if B is None:
+            blocks = [identity_matrix(QQ, nf, sparse=True)]
+        else:
+            num_blocks, block_sizes, block_offsets = block_structure(B)
+            blocks = [B.subdivision(bi, 0) for bi in range(num_blocks)]
+
+        rows = []
+        for C in blocks:
+            K = (C * Z.T).T.right_kernel().basis_matrix() * C
+            if K.nrows() > 0:
+                rows.append(K)
+
+        if len(rows) == 0:
+            return matrix(QQ, 0, nf, sparse=True)
+        return block_matrix([[K] for K in rows], subdivide=True)
+
+    def _sdp_products(self, ti):
+        r"""
+        Returns the rows of the flag products of type ti, in the basis used for the SDP.
+        """
+        if not ti in self._sdp_block_bases:
+            return numpy.asarray(self._product_densities_arrays[ti], dtype=numpy.int64).reshape(-1, 5)
+        if not ti in self._sdp_block_products:
+            num_blocks, block_sizes, block_offsets = block_structure(self._sdp_block_bases[ti])
+            self._sdp_block_products[ti] = change_products_basis(self._product_densities_arrays[ti],
+                                                                 self._sdp_block_bases[ti], block_offsets)
+        return self._sdp_block_products[ti]
+
+    def _sdp_basis_size(self, ti):
+        r"""
+        Returns the number of vectors in the basis used for type ti in the SDP.
+        """
+        if ti in self._sdp_block_bases:
+            return self._sdp_block_bases[ti].nrows()
+        return len(self._flags[ti])
+
+    def _to_sdp_basis(self, ti, M, dual=False):
+        r"""
+        Expresses a matrix of type ti, given in the basis of the flags, in the basis used for
+        the SDP. If B is the basis, the primal matrix Q becomes B^-T Q B^-1 (so that
+        Q = B^T X B), and the dual slack matrix Z becomes B Z B^T. M may be a Sage matrix or
+        a numpy array.
+        """
+        if not ti in self._sdp_block_bases:
+            return M
+        B = self._sdp_block_bases[ti]
+        if isinstance(M, numpy.ndarray):
+            B = numpy.array(B.numpy(), dtype=float)
+            if dual:
+                return B @ M @ B.T
+            Bi = numpy.linalg.pinv(B)
+            return Bi.T @ M @ Bi
+        if dual:
+            return B * M * B.T
+        # B has full row rank, but need not be square.
+        Bi = B.T * (B * B.T).inverse()
+        return Bi.T * M * Bi
+
+    def _from_sdp_basis(self, ti, M, dual=False):
+        r"""
+        The inverse of ``_to_sdp_basis``, for numpy arrays.
+        """
+        if not ti in self._sdp_block_bases:
+            return M
+        B = numpy.array(self._sdp_block_bases[ti].numpy(), dtype=float)
+        if dual:
+            Bi = numpy.linalg.pinv(B)
+            return Bi @ M @ Bi.T
+        return B.T @ M @ B
+
     def solve_sdp(self, show_output=False, solver="csdp",
         force_sharp_graphs=False, force_zero_eigenvectors=False,
         check_solution=True, tolerance=1e-5, show_sorted=False, show_all=False,
-        use_initial_point=False, import_solution_file=None, csdp_settings=None):
+        use_initial_point=False, import_solution_file=None, csdp_settings=None, digits=64, timeout=None,
+        gap=1e-6, warm_start=None, use_blocks=False, project_zero_eigenvectors=False):
         r"""
         Solves a semi-definite program to get a bound on the problem.
 
@@ -1687,6 +2290,11 @@ class Problem(SageObject):
             directory listed in PATH. The name of the solver should be "csdp", "sdpa", "sdpa_dd",
             "sdpa_qd" or "dsdp".
 
+            If a list of solvers is given, they are run at the same time, and the first one that
+            finishes with a relative duality gap of at most ``gap`` is used; the others are
+            stopped. The solver used is recorded in ``_sdp_solver_used``, and the time each one
+            took in ``_sdp_solver_times``.
+
          - ``force_sharp_graphs`` - Boolean (default: False). If True, then the SDP is set up so
            that graphs that are supposed to be sharp are not given any "slack". Generally, this
            option is not particularly useful. It can sometimes improve the "quality" of a solution.
@@ -1718,24 +2326,70 @@ class Problem(SageObject):
             solver will not be run; instead the output file from a previous run of an SDP solver
             will be read. Care should be taken to ensure that the file being imported is for
             exactly the same problem, as minimal sanity-checking is done.
+
+          - ``digits`` - Integer (default: 64). The number of decimal digits to which the
+            coefficients are written in the SDP input file.
+
+          - ``timeout`` - Number or None (default: None). If not None, the SDP solver is
+            stopped, and TimeoutError raised, if it runs for longer than this many seconds.
+
+          - ``gap`` - Number (default: 0.000001). The relative duality gap a solver must reach
+            to be accepted when a list of solvers is given.
+
+          - ``warm_start`` - A solution returned by ``export_sdp_solution`` of a related problem,
+            or None (default: None). If given, it is used as the initial point for the solver
+            (see ``write_sdp_warm_start_file``). As with ``use_initial_point``, only CSDP uses it.
+
+          - ``use_blocks`` - Boolean (default: False). Whether to write the SDP in the invariant
+            anti-invariant basis of each type (see ``compute_block_bases``), so that the solver
+            sees two smaller blocks for each type with a non-trivial symmetry instead of one. The
+            solution is changed back to the basis of the flags when it is read.
+
+          - ``project_zero_eigenvectors`` - Boolean (default: False). Whether to restrict each
+            type's matrix to the vectors orthogonal to the zero eigenvectors given by the
+            construction, before solving. The blocks of the SDP are then smaller, and the
+            solution has the zero eigenvectors exactly, which helps ``make_exact``. If the
+            construction is not extremal, the bound found will be worse.
         """
 
+        if project_zero_eigenvectors:
+            self.state("set_construction", "ensure_yes")
+            if self._field != QQ:
+                raise NotImplementedError("zero eigenvectors can only be projected out over the rationals.")
+
+        # Problems saved before block bases existed have no _sdp_block_bases, so their
+        # block structure is set up again.
+        if (use_blocks != getattr(self, "_sdp_use_blocks", False) or not hasattr(self, "_sdp_block_bases")
+                or project_zero_eigenvectors != getattr(self, "_sdp_project_zero_eigenvectors", False)):
+            self._sdp_use_blocks = use_blocks
+            self._sdp_project_zero_eigenvectors = project_zero_eigenvectors
+            self._set_block_matrix_structure()
+
         if import_solution_file is None:
 
-            if solver=='csdp':
+            if solver == "csdp" or (isinstance(solver, (list, tuple)) and "csdp" in solver):
                 self.write_csdp_settings_file(csdp_settings)
             
             if self.state("write_sdp_input_file") != "yes":
                 self.write_sdp_input_file(force_sharp_graphs=force_sharp_graphs,
-                                          force_zero_eigenvectors=force_zero_eigenvectors)
-            if use_initial_point and self.state("write_sdp_initial_point_file") != "yes":
+                                          force_zero_eigenvectors=force_zero_eigenvectors, digits=digits)
+            if warm_start is not None:
+                self.write_sdp_warm_start_file(warm_start, force_zero_eigenvectors=force_zero_eigenvectors)
+                use_initial_point = True
+            elif use_initial_point and self.state("write_sdp_initial_point_file") != "yes":
                 self.write_sdp_initial_point_file()
             self._run_sdp_solver(show_output=show_output, solver=solver,
-                                 use_initial_point=use_initial_point)
+                                 use_initial_point=use_initial_point, timeout=timeout, gap=gap)
+
+            if warm_start is not None and warm_start["elapsed"] is not None:
+                elapsed = self._sdp_solver_times[self._sdp_solver_used]
+                sys.stdout.write("Warm-started solve took %.2fs, against %.2fs for the solve it was started from.\n"
+                                 % (elapsed, warm_start["elapsed"]))
 
         else:
 
             self._sdp_output_filename = import_solution_file
+            self._sdp_output_format = "csdp"
             # pretend we have run the solver!
             self.state("run_sdp_solver", "force_yes")
 
@@ -1768,7 +2422,7 @@ class Problem(SageObject):
             }
             
             
-        self._csdp_settings_filename = os.path.join(str(SAGE_TMP), "param.csdp")
+        self._csdp_settings_filename = os.path.join(self._sdp_directory_name(), "param.csdp")
         
         if os.path.exists(self._csdp_settings_filename):
             sys.stdout.write("Deleting existing CSDP settings file...\n")
@@ -1790,7 +2444,8 @@ class Problem(SageObject):
             
     # TODO: add option for forcing sharps
 
-    def write_sdp_input_file(self, force_sharp_graphs=False, force_zero_eigenvectors=False):
+    def write_sdp_input_file(self, force_sharp_graphs=False, force_zero_eigenvectors=False, digits=64,
+                             compress=False, stream=None):
         r"""
         Writes an input file for the SDP solver, specifying the SDP to be solved. This method is
         by default called by ``solve_sdp``.
@@ -1800,6 +2455,18 @@ class Problem(SageObject):
          - ``force_sharp_graphs`` - Boolean (default: False). If True, then the SDP is set up so
            that graphs that are supposed to be sharp are not given any "slack". Generally, this
            option is not particularly useful. It can sometimes improve the "quality" of a solution.
+
+         - ``digits`` - Integer (default: 64). The number of decimal digits to which the
+           coefficients are written.
+
+         - ``compress`` - Boolean (default: False). If True, a gzip copy of the file is also
+           written, to "sdp.dat-s.gz", for keeping or sending elsewhere. Its name is stored in
+           ``_sdp_compressed_input_filename``. The solvers are always given the plain file, as
+           none of them read compressed input.
+
+         - ``stream`` - A text stream or None (default: None). If not None, the SDP is written
+           to this stream (for instance the standard input of a solver process) instead of to
+           a file.
         """
         num_graphs = len(self._graphs)
         num_types = len(self._types)
@@ -1814,112 +2481,127 @@ class Problem(SageObject):
 
         if self.state("set_block_matrix_structure") != "yes":
             self._set_block_matrix_structure()
+
+        self.state("write_sdp_input_file", "yes")
+
+        if stream is not None:
+            self._write_sdp_input(stream, force_sharp_graphs, force_zero_eigenvectors, digits)
+            return
+
+        self._sdp_input_filename = os.path.join(self._sdp_directory_name(), "sdp.dat-s")
+
+        sys.stdout.write("Writing SDP input file...\n")
+
+        with open(self._sdp_input_filename, "w", buffering=2 ** 20) as f:
+            self._write_sdp_input(f, force_sharp_graphs, force_zero_eigenvectors, digits)
+
+        if compress:
+            self._sdp_compressed_input_filename = self._sdp_input_filename + ".gz"
+            sys.stdout.write("Compressing SDP input file...\n")
+            with open(self._sdp_input_filename, "rb") as inf:
+                with gzip.open(self._sdp_compressed_input_filename, "wb", compresslevel=1) as f:
+                    shutil.copyfileobj(inf, f, 2 ** 20)
+
+    def _write_sdp_input(self, f, force_sharp_graphs, force_zero_eigenvectors, digits):
+
+        num_graphs = len(self._graphs)
+        num_active_densities = len(self._active_densities)
+        num_density_coeff_blocks = len(self._density_coeff_blocks)
         total_num_blocks = len(self._block_matrix_structure)
 
+        if force_zero_eigenvectors and len(self._sdp_block_bases) > 0:
+            raise NotImplementedError("force_zero_eigenvectors cannot be used with use_blocks or project_zero_eigenvectors.")
+
         if force_zero_eigenvectors:
             num_extra_matrices = sum(self._zero_eigenvectors[ti].nrows() for ti in self._active_types)
         else:
             num_extra_matrices = 0
 
-        self.state("write_sdp_input_file", "yes")
-
-        self._sdp_input_filename = os.path.join(str(SAGE_TMP), "sdp.dat-s")
-
-        sys.stdout.write("Writing SDP input file...\n")
+        # num constraints
+        f.write("%d\n" % (num_graphs + num_density_coeff_blocks + num_extra_matrices,))
 
-        with open(self._sdp_input_filename, "w") as f:
+        # num blocks in each constraint
+        f.write("%d\n" % (total_num_blocks + 3 + (1 if force_zero_eigenvectors else 0),))
 
-            # num constraints
-            f.write("%d\n" % (num_graphs + num_density_coeff_blocks + num_extra_matrices,))
+        # block sizes
+        f.write("1 ")
+        for b in self._block_matrix_structure:
+            f.write("%d " % b[1])
 
-            # num blocks in each constraint
-            f.write("%d\n" % (total_num_blocks + 3 + (1 if force_zero_eigenvectors else 0),))
+        f.write("-%d -%d" % (num_graphs, num_active_densities))
+        if force_zero_eigenvectors:
+            f.write(" -%d" % num_extra_matrices)
+        f.write("\n")
 
-            # block sizes
-            f.write("1 ")
-            for b in self._block_matrix_structure:
-                f.write("%d " % b[1])
+        # RHS of the SDP problem
+        f.write("0.0 " * num_graphs)
+        f.write("1.0 " * num_density_coeff_blocks)
+        f.write("0.0 " * num_extra_matrices)
+        f.write("\n")
 
-            f.write("-%d -%d" % (num_graphs, num_active_densities))
-            if force_zero_eigenvectors:
-                f.write(" -%d" % num_extra_matrices)
-            f.write("\n")
+        # objective function (\delta)
+        if not self._minimize:
+            f.write("0 1 1 1 -1.0\n")
+        else:
+            f.write("0 1 1 1 1.0\n")
 
-            # RHS of the SDP problem
-            f.write("0.0 " * num_graphs)
-            f.write("1.0 " * num_density_coeff_blocks)
-            f.write("0.0 " * num_extra_matrices)
-            f.write("\n")
+        if force_zero_eigenvectors:
+            for mi in range(num_extra_matrices):
+                f.write("0 %d %d %d %s\n" % (total_num_blocks + 4, mi + 1, mi + 1, "1.0" if self._minimize else "-1.0"))
 
-            # objective function (\delta)
+        # slack vars and bound c for each constraint
+        for i in range(num_graphs):
             if not self._minimize:
-                f.write("0 1 1 1 -1.0\n")
+                f.write("%d 1 1 1 -1.0\n" % (i + 1,))
             else:
-                f.write("0 1 1 1 1.0\n")
+                f.write("%d 1 1 1 1.0\n" % (i + 1,))
+            # if not graph sharp, add buffer var to make constraint equality
+            if not (force_sharp_graphs and i in self._sharp_graphs):
+                f.write("%d %d %d %d 1.0\n" % (i + 1, total_num_blocks + 2, i + 1, i + 1))
+
+        # add objective function to the SDP
+        for i in range(num_graphs):
+            for j in range(num_active_densities):
+                d = self._densities[self._active_densities[j]][i]
+                if d != 0:
+                    if self._minimize:
+                        d *= -1
+                    f.write("%d %d %d %d %s\n" % (i + 1, total_num_blocks + 3, j + 1, j + 1, d.n(digits=digits)))
+
+        # set constant equal to 1
+        for i in range(num_density_coeff_blocks):
+            for di in self._density_coeff_blocks[i]:
+                if di in self._active_densities:
+                    j = self._active_densities.index(di)
+                    f.write("%d %d %d %d 1.0\n" % (num_graphs + i + 1, total_num_blocks + 3, j + 1, j + 1))
+
+        # fill block_matrix with entries stored in product_densities_arrays
+        for ti in self._active_types:
 
-            if force_zero_eigenvectors:
-                for mi in range(num_extra_matrices):
-                    f.write("0 %d %d %d %s\n" % (total_num_blocks + 4, mi + 1, mi + 1, "1.0" if self._minimize else "-1.0"))
+            num_blocks, block_sizes, block_offsets, block_indices = self._get_block_matrix_structure(ti)
 
-            # slack vars and bound c for each constraint
-            for i in range(num_graphs):
-                if not self._minimize:
-                    f.write("%d 1 1 1 -1.0\n" % (i + 1,))
-                else:
-                    f.write("%d 1 1 1 1.0\n" % (i + 1,))
-                # if not graph sharp, add buffer var to make constraint equality
-                if not (force_sharp_graphs and i in self._sharp_graphs):
-                    f.write("%d %d %d %d 1.0\n" % (i + 1, total_num_blocks + 2, i + 1, i + 1))
+            rarray = self._sdp_products(ti)
+            j = rarray[:, 1]
+            k = rarray[:, 2]
+            bi = numpy.searchsorted(numpy.array(block_offsets), j, side="right") - 1
+            offsets = numpy.array(block_offsets)[bi]
+            write_sdp_entries(f, rarray[:, 0] + 1, numpy.array(block_indices)[bi] + 2, j - offsets + 1, k - offsets + 1,
+                              sdp_value_strings(rarray[:, 3], rarray[:, 4], digits))
 
-            # add objective function to the SDP
-            for i in range(num_graphs):
-                for j in range(num_active_densities):
-                    d = self._densities[self._active_densities[j]][i]
-                    if d != 0:
-                        if self._minimize:
-                            d *= -1
-                        f.write("%d %d %d %d %s\n" % (i + 1, total_num_blocks + 3, j + 1, j + 1, d.n(digits=64)))
-
-            # set constant equal to 1
-            for i in range(num_density_coeff_blocks):
-                for di in self._density_coeff_blocks[i]:
-                    if di in self._active_densities:
-                        j = self._active_densities.index(di)
-                        f.write("%d %d %d %d 1.0\n" % (num_graphs + i + 1, total_num_blocks + 3, j + 1, j + 1))
-
-            # fill block_matrix with entries stored in product_densities_arrays
+        # TODO: get working with blocks, inactive types
+        if force_zero_eigenvectors:
+            mi = 0
             for ti in self._active_types:
-
-                num_blocks, block_sizes, block_offsets, block_indices = self._get_block_matrix_structure(ti)
-
-                for row in self._product_densities_arrays[ti]:
-                    gi = row[0]
-                    j = row[1]
-                    k = row[2]
-                    bi = num_blocks - 1
-                    if bi > 0:
-                        while block_offsets[bi] > j:
-                            bi -= 1
-                        j -= block_offsets[bi]
-                        k -= block_offsets[bi]
-                    value = Integer(row[3]) / Integer(row[4])
-                    f.write("%d %d %d %d %s\n" %
-                            (gi + 1, block_indices[bi] + 2, j + 1, k + 1, value.n(digits=64)))
-
-            # TODO: get working with blocks, inactive types
-            if force_zero_eigenvectors:
-                mi = 0
-                for ti in self._active_types:
-                    nf = len(self._flags[ti])
-                    for zi in range(self._zero_eigenvectors[ti].nrows()):
-                        for j in range(nf):
-                            for k in range(j, nf):
-                                value = self._zero_eigenvectors[ti][zi, j] * self._zero_eigenvectors[ti][zi, k]
-                                if value != 0:
-                                    f.write("%d %d %d %d %s\n" %
-                                            (num_graphs + num_density_coeff_blocks + mi + 1, ti + 2, j + 1, k + 1, value.n(digits=64)))
-                        f.write("%d %d %d %d -1.0\n" % (num_graphs + num_density_coeff_blocks + mi + 1, total_num_blocks + 4, mi + 1, mi + 1))
-                        mi += 1
+                nf = len(self._flags[ti])
+                for zi in range(self._zero_eigenvectors[ti].nrows()):
+                    for j in range(nf):
+                        for k in range(j, nf):
+                            value = self._zero_eigenvectors[ti][zi, j] * self._zero_eigenvectors[ti][zi, k]
+                            if value != 0:
+                                f.write("%d %d %d %d %s\n" %
+                                        (num_graphs + num_density_coeff_blocks + mi + 1, ti + 2, j + 1, k + 1, value.n(digits=digits)))
+                    f.write("%d %d %d %d -1.0\n" % (num_graphs + num_density_coeff_blocks + mi + 1, total_num_blocks + 4, mi + 1, mi + 1))
+                    mi += 1
         
     def get_sdp(self):
         # Some old code
@@ -2001,7 +2683,7 @@ class Problem(SageObject):
         num_types = Integer(len(self._types))
         num_active_densities = Integer(len(self._active_densities))
 
-        self._sdp_initial_point_filename = os.path.join(str(SAGE_TMP), "sdp.ini-s")
+        self._sdp_initial_point_filename = os.path.join(self._sdp_directory_name(), "sdp.ini-s")
 
         if self.state("set_block_matrix_structure") != "yes":
             self._set_block_matrix_structure()
@@ -2047,6 +2729,10 @@ class Problem(SageObject):
                     for j in range(nf):
                         z_matrix[j, j] += small_change
 
+                    if ti in self._sdp_block_bases:
+                        z_matrix = z_matrix + z_matrix.T - diagonal_matrix(z_matrix.diagonal())
+                        z_matrix = self._to_sdp_basis(ti, z_matrix, dual=True)
+
                     num_blocks, block_sizes, block_offsets, block_indices = self._get_block_matrix_structure(ti)
 
                     for bi in range(num_blocks):
@@ -2093,11 +2779,12 @@ class Problem(SageObject):
                 for ti in range(num_types):
 
                     num_blocks, block_sizes, block_offsets, block_indices = self._get_block_matrix_structure(ti)
+                    Q = self._to_sdp_basis(ti, self._exact_Q_matrices[ti])
 
                     for bi in range(num_blocks):
                         for j in range(block_sizes[bi]):
                             for k in range(j, block_sizes[bi]):
-                                value = self._exact_Q_matrices[ti][block_offsets[bi] + j, block_offsets[bi] + k]
+                                value = Q[block_offsets[bi] + j, block_offsets[bi] + k]
                                 if j == k:
                                     value += small_change
                                 if value != 0:
@@ -2147,140 +2834,316 @@ class Problem(SageObject):
                 for j in range(num_active_densities):
                     f.write("2 %d %d %d %s\n" % (total_num_blocks + 3, j + 1, j + 1, value.n(digits=64)))
 
-    # TODO: report error if problem infeasible
+    def export_sdp_solution(self):
+        r"""
+        Returns the solution found by the SDP solver, in a form that can be passed as
+        ``warm_start`` to ``solve_sdp`` of a related problem (for instance one with fewer
+        types, or with some graphs forbidden). The blocks are labelled by the types, flags and
+        graphs they belong to, rather than by their positions.
+        """
+        if not hasattr(self, "_sdp_solution"):
+            raise ValueError("no SDP solution has been read.")
 
-    def _run_sdp_solver(self, show_output=False, solver="csdp", use_initial_point=False):
+        solution = self._sdp_solution
+        num_graphs = len(self._graphs)
+        num_blocks = len(self._block_matrix_structure)
+        graph_names = [str(g) for g in self._graphs]
 
-        self.state("run_sdp_solver", "yes")
+        types = {}
+        for ti in range(len(self._types)):
+            nb = self._sdp_basis_size(ti)
+            X, Z = numpy.zeros((nb, nb)), numpy.zeros((nb, nb))
+            for bi in range(num_blocks):
+                tj, size, offset = self._block_matrix_structure[bi]
+                if tj == ti:
+                    X[offset:offset + size, offset:offset + size] = solution.X[bi + 1]
+                    Z[offset:offset + size, offset:offset + size] = solution.Z[bi + 1]
+            X, Z = self._from_sdp_basis(ti, X), self._from_sdp_basis(ti, Z, dual=True)
+            types[str(self._types[ti])] = ([str(f) for f in self._flags[ti]], X, Z)
+
+        return {
+            "flag_cls": self._flag_cls.__name__,
+            "first": (solution.X[0][0, 0], solution.Z[0][0, 0]),
+            "types": types,
+            "graphs": dict((graph_names[gi], (solution.y[gi], solution.X[num_blocks + 1][gi], solution.Z[num_blocks + 1][gi]))
+                           for gi in range(num_graphs)),
+            "densities": (list(solution.y[num_graphs:]), solution.X[num_blocks + 2], solution.Z[num_blocks + 2]),
+            "elapsed": getattr(self, "_sdp_solver_times", {}).get(getattr(self, "_sdp_solver_used", None)),
+        }
 
-        previous_directory = os.getcwd()
-        os.chdir(str(SAGE_TMP))
+    def write_sdp_warm_start_file(self, warm_start, small_change=1/Integer(1000), force_zero_eigenvectors=False):
+        r"""
+        Writes an initial point file for the SDP solver from a solution exported by
+        ``export_sdp_solution`` (possibly of a different problem). Types, flags and graphs
+        are matched by their string representations: the parts of the solution for types
+        or graphs that this problem does not have are dropped, and new ones start at
+        ``small_change`` times the identity. ``small_change`` is also added to the leading
+        diagonals, so that the starting matrices have no zero eigenvalues.
+
+        ``force_zero_eigenvectors`` must be the same as when the SDP input file was
+        written; if it is True, the point is extended by the extra block that it adds.
+        """
+        if warm_start["flag_cls"] != self._flag_cls.__name__:
+            raise ValueError("solution is for a different kind of flag.")
 
-        print("Now in directory "+str( os.getcwd() ))
-        
-        if solver == "csdp":
-            cmd = "%s %s sdp.out" % (cdsp_cmd, self._sdp_input_filename)
+        if self.state("set_block_matrix_structure") != "yes":
+            self._set_block_matrix_structure()
+        total_num_blocks = len(self._block_matrix_structure)
+        num_graphs = len(self._graphs)
+        num_active_densities = len(self._active_densities)
+        eps = float(small_change)
 
-            if use_initial_point and self.state("write_sdp_initial_point_file") == "yes":
-                cmd += " %s" % self._sdp_initial_point_filename
+        if force_zero_eigenvectors:
+            num_extra_matrices = sum(self._zero_eigenvectors[ti].nrows() for ti in self._active_types)
+        else:
+            num_extra_matrices = 0
 
-        elif solver == "dsdp":
-            cmd = "%s %s -gaptol 1e-18 -print 1 -save sdp.out" % (dsdp_cmd, self._sdp_input_filename)
+        self._sdp_initial_point_filename = os.path.join(self._sdp_directory_name(), "sdp.ini-s")
+        self.state("write_sdp_initial_point_file", "yes")
 
-        elif solver == "sdpa":
-            cmd = "%s -ds %s -o sdpa.out" % (sdpa_cmd, self._sdp_input_filename)
+        sys.stdout.write("Writing SDP initial point file from previous solution...\n")
 
-        elif solver == "sdpa_dd":
-            cmd = "%s -ds %s -o sdpa.out" % (sdpa_dd_cmd, self._sdp_input_filename)
+        graphs = [warm_start["graphs"].get(str(g)) for g in self._graphs]
+        density_y, density_X, density_Z = warm_start["densities"]
+        y = [0.0 if g is None else g[0] for g in graphs]
+        y += [density_y[i] if i < len(density_y) else 0.0 for i in range(len(self._density_coeff_blocks))]
+        y += [0.0] * num_extra_matrices
 
-        elif solver == "sdpa_qd":
-            cmd = "%s -ds %s -o sdpa.out" % (sdpa_qd_cmd, self._sdp_input_filename)
+        entries = []
 
-        else:
-            raise ValueError("unknown solver.")
+        def add_block(mi, block, M):
+            j, k = numpy.triu_indices(M.shape[0])
+            keep = M[j, k] != 0
+            entries.append((mi, block, j[keep] + 1, k[keep] + 1, M[j, k][keep]))
 
-        sys.stdout.write(f"Running SDP solver with command '{cmd}'...\n")
+        for mi, which in ((1, 2), (2, 1)):
+            add_block(mi, 1, numpy.array([[max(warm_start["first"][which - 1], 0.0) + eps]]))
 
-        # For maximization problems, the objective value returned by the SDP solver
-        # must be negated.
-        obj_value_factor = 1.0 if self._minimize else -1.0
+            for ti in range(len(self._types)):
+                nf = len(self._flags[ti])
+                M = eps * numpy.identity(nf)
+                previous = warm_start["types"].get(str(self._types[ti]))
+                if previous is not None:
+                    positions = dict((name, i) for i, name in enumerate(previous[0]))
+                    new_indices = [i for i in range(nf) if str(self._flags[ti][i]) in positions]
+                    old_indices = [positions[str(self._flags[ti][i])] for i in new_indices]
+                    M[numpy.ix_(new_indices, new_indices)] += previous[which][numpy.ix_(old_indices, old_indices)]
+                M = self._to_sdp_basis(ti, M, dual=(which == 2))
+                num_blocks, block_sizes, block_offsets, block_indices = self._get_block_matrix_structure(ti)
+                for bi in range(num_blocks):
+                    o, size = block_offsets[bi], block_sizes[bi]
+                    add_block(mi, block_indices[bi] + 2, M[o:o + size, o:o + size])
 
-        child = pexpect.spawnu(cmd, timeout=2**32)
-        obj_val = None
-        self._sdp_solver_output = ""
-        sys.stdout.write("Reading output file...\n")
+            values = numpy.array([eps if g is None else max(g[which], 0.0) + eps for g in graphs])
+            add_block(mi, total_num_blocks + 2, numpy.diag(values))
 
-        # import time
-        # time.sleep(1)
+            previous = density_X if which == 1 else density_Z
+            values = numpy.array([max(previous[j], 0.0) + eps if j < len(previous) else eps for j in range(num_active_densities)])
+            add_block(mi, total_num_blocks + 3, numpy.diag(values))
 
-        while True:
-            if child.eof():
-                break
-            try:
-                child.expect("\r\n")
-                line = child.before.strip()  + "\n"
-                self._sdp_solver_output += line
+            if num_extra_matrices > 0:
+                add_block(mi, total_num_blocks + 4, eps * numpy.identity(num_extra_matrices))
 
-                if show_output:
-                    sys.stdout.write(line)
+        with open(self._sdp_initial_point_filename, "w") as f:
+            f.write(" ".join(repr(float(v)) for v in y) + "\n")
+            # CSDP expects the dual slack matrix Z (1) first, then the primal matrix X (2).
+            for mi, block, j, k, values in entries:
+                write_sdp_entries(f, numpy.full(len(j), mi), numpy.full(len(j), block), j, k,
+                                  numpy.array([repr(float(v)) for v in values], dtype=object))
 
-                if "Primal objective value:" in line:  # CSDP
-                    obj_val = self._approximate_field(line.split()[-1]) * obj_value_factor
-                elif "objValPrimal" in line:  # SDPA
-                    obj_val = self._approximate_field(line.split()[-1]) * obj_value_factor
-                elif "DSDP Solution" in line:  # DSDP: seems to print absolute value
-                    obj_val = self._approximate_field(line.split()[-1])
+    # TODO: report error if problem infeasible
 
-            except OverflowError:
-                continue
+    def _sdp_directory_name(self):
+        r"""
+        Returns the directory in which the SDP files of this problem are kept. Each problem
+        has a directory of its own, so that problems solved at the same time do not
+        overwrite each other's files.
+        """
+        directory = getattr(self, "_sdp_directory", None)
+        if directory is None or not os.path.isdir(directory):
+            directory = tempfile.mkdtemp(prefix="sdp-", dir=str(SAGE_TMP))
+            self._sdp_directory = directory
+        return directory
 
-            except pexpect.EOF:
-                break
+    def _make_sdp_solver(self, solver):
+
+        if solver == "csdp":
+            return CSDPSolver(cdsp_cmd)
+        elif solver == "dsdp":
+            return DSDPSolver(dsdp_cmd)
+        elif solver == "sdpa":
+            return SDPASolver(sdpa_cmd)
+        elif solver == "sdpa_dd":
+            return SDPASolver(sdpa_dd_cmd, name="sdpa_dd")
+        elif solver == "sdpa_qd":
+            return SDPASolver(sdpa_qd_cmd, name="sdpa_qd")
+        else:
+            raise ValueError("unknown solver.")
+
+    def _run_sdp_solver(self, show_output=False, solver="csdp", use_initial_point=False, timeout=None, gap=1e-6):
+
+        self.state("run_sdp_solver", "yes")
+        self._remove_sdp_run_directory()
+
+        if isinstance(solver, (list, tuple)):
+            run = self._run_sdp_portfolio(solver, show_output, use_initial_point, timeout, gap)
+        else:
+            sdp_solver, directory, initial_point_filename = self._prepare_sdp_run(solver, use_initial_point)
+            # Recorded before the run, so that a failed run's directory is deleted next time.
+            self._sdp_run_directory = directory
+            run = sdp_solver.run(directory, self._sdp_input_filename, initial_point_filename,
+                                 timeout=timeout, show_output=show_output)
+            self._sdp_solver_used = solver
+            self._sdp_solver_times = {solver: run.elapsed}
 
-        child.close()
-        self._sdp_solver_returncode = child.exitstatus
+        self._sdp_solver_output = run.output
+        self._sdp_solver_returncode = run.returncode
+
+        # For maximization problems, the objective value returned by the SDP solver
+        # must be negated. DSDP seems to print the absolute value.
+        obj_val = None
+        if run.objective_value is not None:
+            obj_val = self._approximate_field(run.objective_value)
+            if run.solver_name != "dsdp" and not self._minimize:
+                obj_val *= -1
 
         print(f"Returncode is {self._sdp_solver_returncode}. Objective value is {obj_val}.")
 
         # TODO: if program is infeasible, a returncode of 1 is given,
         # and output contains "infeasible"
 
-        if "sdpa" in solver:
+        self._sdp_output_filename = run.solution_filename
+        self._sdp_output_format = run.output_format
+        self._sdp_run_directory = run.directory
 
-            with open("sdpa.out", "r") as inf:
-                with open("sdp.out", "w") as f:
+    def _remove_sdp_run_directory(self):
+        r"""
+        Deletes the directory of the last solver run, if it has not been deleted yet. This
+        is done when the next run starts.
+        """
+        directory = getattr(self, "_sdp_run_directory", None)
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+            self._sdp_run_directory = None
 
-                    found, diagonal = False, False
-                    t, row, col = 0, 1, 1
+    def _prepare_sdp_run(self, solver, use_initial_point):
+        r"""
+        Returns an SDPSolver for solver, a new directory to run it in, and the initial point
+        file to give it (or None).
+        """
+        sdp_solver = self._make_sdp_solver(solver)
+        directory = make_run_directory(self._sdp_directory_name())
 
-                    for line in inf:
-                        if line[:6] == "yMat =":
-                            break
-                    else:
-                        raise ValueError
+        initial_point_filename = None
+        if solver == "csdp":
+            # CSDP reads its settings from the directory it is run in.
+            settings_filename = getattr(self, "_csdp_settings_filename", None)
+            if settings_filename is not None and os.path.exists(settings_filename):
+                shutil.copy(settings_filename, directory)
+            if use_initial_point and self.state("write_sdp_initial_point_file") == "yes":
+                initial_point_filename = self._sdp_initial_point_filename
 
-                    for line in inf:
+        return sdp_solver, directory, initial_point_filename
 
-                        if line == "}":
-                            break
-                        elif line[:3] == "{ {":
-                            t += 1
-                            row = 1
-                            diagonal = False
-                        elif line[:2] == "{+" or line[:2] == "{-":
-                            t += 1
-                            row = 1
-                            diagonal = True
-
-                        line = line.replace("{", "")
-                        line = line.replace("}", "")
-                        col = 1
-                        for a in line.split(","):
-                            try:
-                                v = a.strip()
-                                vf = float(v)  # only done to see if we get ValueError
-                                if diagonal:
-                                    f.write("2 %d %d %d %s\n" % (t, row, col, v))
-                                    row += 1
-                                elif row <= col:
-                                    f.write("2 %d %d %d %s\n" % (t, row, col, v))
-                                col += 1
-                            except ValueError:
-                                pass
-
-                        if col > 1:  # at least one number found...
-                            row += 1
-
-        self._sdp_output_filename = os.path.join(str(SAGE_TMP), "sdp.out")
-        os.chdir(previous_directory)
+    def _run_sdp_portfolio(self, solvers, show_output, use_initial_point, timeout, gap):
+        r"""
+        Runs several SDP solvers at the same time on the same input file. The first one to
+        finish successfully with a relative duality gap of at most gap is used, and the
+        others are stopped. A run whose gap is not known (DSDP does not report one) is not
+        accepted early. If none reaches the gap, the successful run with the smallest gap
+        is used, runs with unknown gaps coming last.
+        """
+        results = queue.Queue()
+
+        # Every solver is set up before any thread starts, so that the solvers to cancel
+        # are all known when the first good result comes in.
+        prepared = dict((solver, self._prepare_sdp_run(solver, use_initial_point)) for solver in solvers)
+
+        def run_solver(solver, sdp_solver, directory, initial_point_filename):
+            try:
+                results.put((solver, sdp_solver.run(directory, self._sdp_input_filename, initial_point_filename,
+                                                    timeout=timeout, show_output=show_output), None))
+            except Exception as e:
+                results.put((solver, None, e))
+
+        threads = [threading.Thread(target=run_solver, args=(solver,) + prepared[solver]) for solver in solvers]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        runs, errors, winner = {}, {}, None
+        try:
+            for i in range(len(solvers)):
+                solver, run, error = results.get()
+                if error is not None:
+                    errors[solver] = error
+                    sys.stdout.write("SDP solver %s failed: %s\n" % (solver, error))
+                    continue
+                runs[solver] = run
+                if run.succeeded() and run.gap() is not None and run.gap() <= gap:
+                    winner = solver
+                    break
+        finally:
+            for solver, (sdp_solver, directory, initial_point_filename) in prepared.items():
+                if solver != winner:
+                    sdp_solver.cancel()
+            for thread in threads:
+                thread.join()
+
+        while not results.empty():
+            solver, run, error = results.get()
+            if error is not None:
+                errors[solver] = error
+            else:
+                runs[solver] = run
+
+        if winner is None:
+            finished = [solver for solver in solvers if solver in runs and runs[solver].succeeded()]
+            if len(finished) == 0:
+                for sdp_solver, directory, initial_point_filename in prepared.values():
+                    shutil.rmtree(directory, ignore_errors=True)
+                if len(runs) == 0 and all(isinstance(e, TimeoutError) for e in errors.values()):
+                    raise TimeoutError("none of the SDP solvers finished within %s seconds." % timeout)
+                raise ValueError("none of the SDP solvers succeeded.")
+            winner = min(finished, key=lambda solver: runs[solver].gap() if runs[solver].gap() is not None else float("inf"))
+            sys.stdout.write("Warning: no SDP solver reached a gap of %s.\n" % gap)
+
+        self._sdp_solver_used = winner
+        self._sdp_solver_times = dict((solver, runs[solver].elapsed if solver in runs else None) for solver in solvers)
+
+        # Only the winner's solution is read; the directories of the other runs, including
+        # cancelled and failed ones, are deleted.
+        for solver, (sdp_solver, directory, initial_point_filename) in prepared.items():
+            if solver != winner:
+                shutil.rmtree(directory, ignore_errors=True)
+
+        for solver in solvers:
+            if solver == winner:
+                status = "used"
+            elif solver in errors:
+                status = "failed"
+            elif runs[solver].cancelled:
+                status = "stopped"
+            else:
+                status = "finished"
+            elapsed = self._sdp_solver_times[solver]
+            sys.stdout.write("  %s: %s%s\n" % (solver, status, "" if elapsed is None else " after %.2fs" % elapsed))
+
+        return runs[winner]
 
     # TODO: read in dual solution
 
+    def _sdp_block_sizes(self):
+        r"""
+        Returns the sizes of the blocks of the SDP, as written by ``write_sdp_input_file``
+        (without the extra block used by ``force_zero_eigenvectors``).
+        """
+        return [1] + [b[1] for b in self._block_matrix_structure] + [-len(self._graphs), -len(self._active_densities)]
+
     def _read_sdp_output_file(self):
 
         self.state("read_solution", "yes")
 
-        num_graphs = len(self._graphs)
         num_types = len(self._types)
         num_densities = len(self._densities)
 
@@ -2288,36 +3151,22 @@ class Problem(SageObject):
             self._set_block_matrix_structure()
         num_blocks = len(self._block_matrix_structure)
 
-        with open(self._sdp_output_filename, "r") as f:
+        self._sdp_solution = read_sdp_solution(self._sdp_output_filename, self._sdp_block_sizes(),
+                                               getattr(self, "_sdp_output_format", "csdp"))
+        # The run's files, including the output file, are kept until the next run, so
+        # that they can still be inspected or passed back as import_solution_file.
+        X = self._sdp_solution.X
 
-            self._sdp_Q_matrices = [matrix(self._approximate_field,
-                len(self._flags[ti]), len(self._flags[ti])) for ti in range(num_types)]
+        Q = [numpy.zeros((self._sdp_basis_size(ti), self._sdp_basis_size(ti))) for ti in range(num_types)]
+        for bi in range(num_blocks):
+            ti, size, offset = self._block_matrix_structure[bi]
+            Q[ti][offset:offset + size, offset:offset + size] = X[bi + 1]
+        Q = [self._from_sdp_basis(ti, Q[ti]) for ti in range(num_types)]
+        self._sdp_Q_matrices = LazyMatrixList(self._approximate_field, Q)
 
-            self._sdp_density_coeffs = [self._approximate_field(0) for i in range(num_densities)]
-
-            for line in f:
-                numbers = line.split()
-                if numbers[0] != "2":
-                    continue
-                bi = int(numbers[1]) - 2
-                if bi == num_blocks + 1:
-                    j = int(numbers[2]) - 1
-                    di = self._active_densities[j]
-                    self._sdp_density_coeffs[di] = self._approximate_field(numbers[4])
-                    continue
-                if bi < 0 or bi >= num_blocks:
-                    continue
-                j = int(numbers[2]) - 1
-                k = int(numbers[3]) - 1
-                ti, size, offset = self._block_matrix_structure[bi]
-                j += offset
-                k += offset
-
-                self._sdp_Q_matrices[ti][j, k] = self._approximate_field(numbers[4])
-                self._sdp_Q_matrices[ti][k, j] = self._sdp_Q_matrices[ti][j, k]
-
-        for ti in range(num_types):
-            self._sdp_Q_matrices[ti].set_immutable()
+        self._sdp_density_coeffs = [self._approximate_field(0) for i in range(num_densities)]
+        for j, di in enumerate(self._active_densities):
+            self._sdp_density_coeffs[di] = self._approximate_field(X[num_blocks + 2][j])
 
     def check_solution(self, tolerance=1e-5, show_sorted=False, show_all=False):
         r"""
@@ -2348,19 +3197,23 @@ class Problem(SageObject):
 
         sys.stdout.write("Checking numerical bound...\n")
 
-        fbounds = [sum([self._densities[j][i] * self._sdp_density_coeffs[j] for j in range(num_densities)]) for i in range(num_graphs)]
+        fbounds = numpy.array([float(sum([self._densities[j][i] * self._sdp_density_coeffs[j] for j in range(num_densities)]))
+                               for i in range(num_graphs)])
 
         for ti in self._active_types:
-            for row in self._product_densities_arrays[ti]:
-                gi, j, k, numer, denom = row
-                d = Integer(numer) / Integer(denom)
-                value = self._sdp_Q_matrices[ti][j, k]
-                if j != k:
-                    d *= 2
-                if not self._minimize:
-                    fbounds[gi] += d * value
-                else:
-                    fbounds[gi] -= d * value
+            rarray = numpy.asarray(self._product_densities_arrays[ti], dtype=numpy.int64).reshape(-1, 5)
+            if isinstance(self._sdp_Q_matrices, LazyMatrixList):
+                Q = self._sdp_Q_matrices.array(ti)
+            else:
+                Q = self._sdp_Q_matrices[ti].numpy()
+            j, k = rarray[:, 1], rarray[:, 2]
+            values = rarray[:, 3] / rarray[:, 4] * numpy.where(j != k, 2.0, 1.0) * Q[j, k]
+            if not self._minimize:
+                fbounds += numpy.bincount(rarray[:, 0], weights=values, minlength=num_graphs)
+            else:
+                fbounds -= numpy.bincount(rarray[:, 0], weights=values, minlength=num_graphs)
+
+        fbounds = [self._approximate_field(x) for x in fbounds]
 
         if not self._minimize:
             bound = max(fbounds)
@@ -2539,7 +3392,7 @@ class Problem(SageObject):
 
     def make_exact(self, denominator=1024, meet_target_bound=True,
                    protect=None, use_densities=True, use_blocks=True, rank=None, show_changes=False,
-                   check_exact_bound=True, diagonalize=True, verify=True):
+                   check_exact_bound=True, diagonalize=True, verify=True, prime=None):
         r"""
         Makes an exact bound for the problem using the approximate floating point bound
         found by the SDP solver.
@@ -2582,6 +3435,15 @@ class Problem(SageObject):
           - ``diagonalize`` - Boolean (default: True). Whether to diagonalize the Q
              matrices afterwards. If ``meet_target_bound`` is False, the Q matrices are
              always diagonalized.
+
+          - ``verify`` - Boolean or "modular" (default: True). How to check the
+             diagonalization; see ``diagonalize``.
+
+          - ``prime`` - Integer or None (default: None). If a prime less than 2^25 is given,
+             the columns of the DR matrix are tested for independence modulo this prime,
+             which is much faster for large problems. Very rarely, an unlucky prime can
+             cause the DR matrix to have too small a rank, and the bound not to be met.
+             The field must be the rationals.
         """
 
         if meet_target_bound and self.state("set_construction") != "yes":
@@ -2689,66 +3551,30 @@ class Problem(SageObject):
             triples.sort()
             triple_to_index = dict((triples[i], i) for i in range(num_triples))
 
-            R = matrix(self._field, num_sharps, num_triples, sparse=True)
+            sys.stdout.write("Constructing R matrix...\n")
 
+            arguments = [(ti, self._product_densities_arrays[ti], self._sharp_graphs,
+                          self._inverse_flag_bases[ti] if self.state("transform_solution") == "yes" else None)
+                         for ti in self._active_types]
             if self.pool is not None:
-                sys.stdout.write("Constructing R matrix ...\n")
-                arguments = [(ti, self._flags[ti], num_sharps, self._product_densities_arrays[ti], self._sharp_graphs, self._inverse_flag_bases[ti] if self.state("transform_solution") == "yes" else None) for ti in self._active_types]
-                for ti, Ds in self.pool.starmap(construct_r_mp, tqdm(arguments)):
-                    for si in range(num_sharps):
-                        for j in range(q_sizes[ti]):
-                            for k in range(j, q_sizes[ti]):
-                                trip = (ti, j, k)
-                                value = Ds[si][j, k]
-                                if j != k:
-                                    value *= 2
-                                if self._minimize:
-                                    value *= -1
-                                R[si, triple_to_index[trip]] = value
+                results = self.pool.starmap(construct_r_mp, arguments)
             else:
-                sys.stdout.write("Constructing R matrix")
-
-                # TODO: only use triples that correspond to middle blocks.
-
-                for ti in self._active_types:
+                results = [construct_r_mp(*a) for a in arguments]
 
-                    Ds = [matrix(QQ, len(self._flags[ti]), len(self._flags[ti]))
-                        for si in range(num_sharps)]
-
-                    for row in self._product_densities_arrays[ti]:
-                        gi = row[0]
-                        if not gi in self._sharp_graphs:
-                            continue
-                        si = self._sharp_graphs.index(gi)
-                        j = row[1]
-                        k = row[2]
-                        value = Integer(row[3]) / Integer(row[4])
-                        Ds[si][j, k] = value
-                        Ds[si][k, j] = value
-
-                    if self.state("transform_solution") == "yes":
-                        B = self._inverse_flag_bases[ti]
-                        for si in range(num_sharps):
-                            Ds[si] = B.T * Ds[si] * B
-
-                    for si in range(num_sharps):
-                        for j in range(q_sizes[ti]):
-                            for k in range(j, q_sizes[ti]):
-                                trip = (ti, j, k)
-                                value = Ds[si][j, k]
-                                if j != k:
-                                    value *= 2
-                                if self._minimize:
-                                    value *= -1
-                                R[si, triple_to_index[trip]] = value
+            entries = {}
+            for ti, si, j, k, values in results:
+                for s_, j_, k_, value in zip(si.tolist(), j.tolist(), k.tolist(), values):
+                    if j_ != k_:
+                        value *= 2
+                    if self._minimize:
+                        value *= -1
+                    entries[(s_, triple_to_index[(ti, j_, k_)])] = value
 
-                    sys.stdout.write(".")
-                    sys.stdout.flush()
-                sys.stdout.write("\n")
+            R = matrix(self._field, num_sharps, num_triples, entries, sparse=True)
 
             density_cols_to_use = []
             DR = matrix(self._field, num_sharps, 0)  # sparsity harms performance too much here
-            EDR = DR.T
+            EDR = IncrementalRank(self._field, num_sharps, prime)
 
             sys.stdout.write("Constructing DR matrix")
 
@@ -2763,10 +3589,7 @@ class Problem(SageObject):
                     new_col = matrix(QQ, [[self._densities[j][gi]] for gi in self._sharp_graphs])
                     if new_col.is_zero():
                         continue
-                    EDR = EDR.stack(new_col.T)
-                    EDR.echelonize()
-                    if EDR[-1, :].is_zero():
-                        EDR = EDR[:-1, :]
+                    if not EDR.add(new_col.column(0)):
                         sys.stdout.write("~")
                         sys.stdout.flush()
                         continue
@@ -2802,10 +3625,7 @@ class Problem(SageObject):
                 new_col = R[:, i: i + 1]
                 if new_col.is_zero():
                     continue
-                EDR = EDR.stack(new_col.T)
-                EDR.echelonize()
-                if EDR[-1, :].is_zero():
-                    EDR = EDR[:-1, :]
+                if not EDR.add(new_col.column(0)):
                     sys.stdout.write("~")
                     sys.stdout.flush()
                     continue
@@ -2934,17 +3754,25 @@ class Problem(SageObject):
         bounds = [sum([self._densities[j][i] * self._exact_density_coeffs[j]
                   for j in range(num_densities)]) for i in range(num_graphs)]
 
-        for ti in self._active_types:
-            for row in self._product_densities_arrays[ti]:
-                gi, j, k, numer, denom = row
-                d = Integer(numer) / Integer(denom)
-                value = self._exact_Q_matrices[ti][j, k]
-                if j != k:
-                    value *= 2
-                if not self._minimize:
-                    bounds[gi] += d * value
-                else:
-                    bounds[gi] -= d * value
+        if self._field == QQ:
+            sums = exact_product_sums(num_graphs, [self._product_densities_arrays[ti] for ti in self._active_types],
+                                      [self._exact_Q_matrices[ti] for ti in self._active_types])
+            if not self._minimize:
+                bounds = [bounds[gi] + sums[gi] for gi in range(num_graphs)]
+            else:
+                bounds = [bounds[gi] - sums[gi] for gi in range(num_graphs)]
+        else:
+            for ti in self._active_types:
+                for row in self._product_densities_arrays[ti]:
+                    gi, j, k, numer, denom = row
+                    d = Integer(numer) / Integer(denom)
+                    value = self._exact_Q_matrices[ti][j, k]
+                    if j != k:
+                        value *= 2
+                    if not self._minimize:
+                        bounds[gi] += d * value
+                    else:
+                        bounds[gi] -= d * value
 
         if self._field == QQ:
             if not self._minimize:
@@ -3004,6 +3832,14 @@ class Problem(SageObject):
         ``make_exact``. Note that if the solution has not been adjusted to meet a target
         bound, a simpler method of rounding is performed, and diagonalization is done
         at the same time.
+
+        INPUT:
+
+         - ``verify`` - Boolean or "modular" (default: True). Whether to check that
+           Q = R * M * R.T. If True, the product is computed exactly. If "modular", it is
+           compared with Q modulo a random large prime, which is much faster for large
+           types (this is only done over the rationals; otherwise the exact check is used).
+           The modular check is probabilistic, and the output says when it was used.
         """
 
         self.state("diagonalize", "yes")
@@ -3033,16 +3869,23 @@ class Problem(SageObject):
         # Q can now be computed as Q = R * M * R.T
 
         if verify:
+            modular = verify == "modular" and self._field == QQ
+            if modular:
+                sys.stdout.write("Verification is modular: Q = R * M * R.T is only checked modulo a random prime.\n")
             if self.pool is not None:
                 sys.stdout.write("Verifying ... \n")
-                arguments = [(self._exact_r_matrices[ti], self._exact_diagonal_matrices[ti], self._exact_Q_matrices[ti]) for ti in range(len(self._types))]
+                arguments = [(self._exact_r_matrices[ti], self._exact_diagonal_matrices[ti], self._exact_Q_matrices[ti], modular) for ti in range(len(self._types))]
                 self.pool.starmap(verify_mp, tqdm(arguments))
 
             else:
                 sys.stdout.write("Verifying")
                 for ti in range(len(self._types)):
-                    Q = self._exact_r_matrices[ti] * self._exact_diagonal_matrices[ti] * self._exact_r_matrices[ti].T
-                    if Q != self._exact_Q_matrices[ti]:
+                    R, M, Q = self._exact_r_matrices[ti], self._exact_diagonal_matrices[ti], self._exact_Q_matrices[ti]
+                    if modular:
+                        verified = verify_modular(R, M, Q)
+                    else:
+                        verified = Q == R * M * R.T
+                    if not verified:
                         raise ValueError  # TODO: choose appropriate error
                     sys.stdout.write(".")
                     sys.stdout.flush()
@@ -3242,11 +4085,11 @@ class Problem(SageObject):
             "bound": self._bound, # needs to be passed manually (not yet available)
             "order_of_admissible_graphs": self._n,
             "number_of_admissible_graphs": len(self._graphs),
-            "admissible_graphs": self._graphs,
+            "admissible_graphs": list(self._graphs),
             "number_of_types": len(self._types),
             "types": self._types,
             "numbers_of_flags": [len(L) for L in self._flags],
-            "flags": self._flags,
+            "flags": [list(flags) for flags in self._flags],
             "qdash_matrices": [upper_triangular_matrix_to_list(M) for M in qdash_matrices],
             "r_matrices": [matrix_to_list(M) for M in r_matrices],
         }
@@ -3302,11 +4145,11 @@ class Problem(SageObject):
             "bound": self._bound,
             "order_of_admissible_graphs": self._n,
             "number_of_admissible_graphs": len(self._graphs),
-            "admissible_graphs": self._graphs,
+            "admissible_graphs": list(self._graphs),
             "number_of_types": len(self._types),
             "types": self._types,
             "numbers_of_flags": [len(L) for L in self._flags],
-            "flags": self._flags,
+            "flags": [list(flags) for flags in self._flags],
             "qdash_matrices": [upper_triangular_matrix_to_list(M) for M in qdash_matrices],
             "r_matrices": [matrix_to_list(M) for M in r_matrices],
         }
@@ -4380,10 +5223,18 @@ def dens(graph, family_dimension):
 
     quantum_graph = list()
 
-    for h in grphs:
-        dgh = h.subgraph_density(g)
-        if dgh > 0:
-            quantum_graph.append((h, dgh))
+    if g.n == g.r:
+        for h in grphs:
+            dgh = h.subgraph_density(g)
+            if dgh > 0:
+                quantum_graph.append((h, dgh))
+        return quantum_graph
+
+    total = binomial(n_gr, g.n)
+    counts = dict((int(gi), Integer(count)) for gi, count in subgraph_census(GraphFlag, grphs, g.n).get(str(g), ()))
+    for hi, h in enumerate(grphs):
+        if hi in counts:
+            quantum_graph.append((h, counts[hi] / total))
             
     return quantum_graph
 
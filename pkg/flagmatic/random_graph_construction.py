@@ -36,6 +36,7 @@ from sage.rings.all import Integer, RationalField
 
 from .construction import *
 from .three_graph_flag import *
+from .hypergraph_flag import make_graph_block
 
 
 class RandomGraphConstruction(Construction):
@@ -64,6 +65,7 @@ class RandomGraphConstruction(Construction):
     def zero_eigenvectors(self, tg, flags):
 
         rows = set()
+        flags_block = make_graph_block(flags, flags[0].n)
         for p in Tuples([0, 1], binomial(tg.n, 2)):
             edges = []
             c = 0
@@ -76,10 +78,9 @@ class RandomGraphConstruction(Construction):
             row = [0 for f in flags]
             for pair in graphs:
                 g, den = pair
-                for i in range(len(flags)):
-                    if g.is_labelled_isomorphic(flags[i]):
-                        row[i] = den
-                        break
+                i = flags_block.index(g)
+                if i != -1:
+                    row[i] = den
             rows.add(tuple(row))
 
         return matrix_of_independent_rows(self._field, list(rows), len(flags))
@@ -37,6 +37,7 @@ from sage.rings.all import Integer, RationalField
 
 from .construction import *
 from .three_graph_flag import *
+from .hypergraph_flag import make_graph_block
 
 
 class RandomTournamentConstruction(Construction):
@@ -57,6 +58,7 @@ class RandomTournamentConstruction(Construction):
     def zero_eigenvectors(self, tg, flags):
 
         rows = set()
+        flags_block = make_graph_block(flags, flags[0].n)
         for p in Tuples([0, 1], binomial(tg.n, 2)):
             edges = []
             c = 0
@@ -71,10 +73,9 @@ class RandomTournamentConstruction(Construction):
             row = [0 for f in flags]
             for pair in graphs:
                 g, den = pair
-                for i in range(len(flags)):
-                    if g.is_labelled_isomorphic(flags[i]):
-                        row[i] = den
-                        break
+                i = flags_block.index(g)
+                if i != -1:
+                    row[i] = den
             rows.add(tuple(row))
 
         return matrix_of_independent_rows(self._field, list(rows), len(flags))
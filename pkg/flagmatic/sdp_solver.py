@@ -0,0 +1,405 @@
+"""
+
+flagmatic 2
+
+Copyright (c) 2012, E. R. Vaughan. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1) Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+
+2) Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation and/or
+other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Further development of Flagmatic is supported by ERC.
+http://cordis.europa.eu/project/rcn/104324_en.html
+"""
+
+import os, signal, subprocess, sys, tempfile, threading, time
+import queue
+import numpy
+
+
+class SDPSolver(object):
+    r"""
+    Runs an SDP solver on an input file in SDPA sparse format, in a directory of its own.
+
+    Subclasses give the command line for a particular solver, recognise the line of its
+    output that contains the objective value, and convert its solution file to the CSDP
+    format read by Problem, if necessary.
+    """
+
+    name = None
+
+    def __init__(self, command):
+        self.command = command
+        self._process = None
+        self._cancelled = threading.Event()
+
+    def arguments(self, input_filename, initial_point_filename=None):
+        raise NotImplementedError
+
+    def objective_value(self, line):
+        r"""
+        Returns the objective value (as a string) if line is the one that reports it,
+        and None otherwise.
+        """
+        return None
+
+    def dual_objective_value(self, line):
+        r"""
+        As objective_value, for the objective value of the dual problem.
+        """
+        return None
+
+    output_format = "csdp"
+
+    def solution_filename(self, directory):
+        return os.path.join(directory, "sdp.out")
+
+    def cancel(self):
+        r"""
+        Stops the solver, if it is running. This can be called from another thread.
+        """
+        self._cancelled.set()
+        self._kill()
+
+    def _kill(self):
+        # The solver is started in a process group of its own, so that this also stops any
+        # processes started by a wrapper script.
+        process = self._process
+        if process is not None and process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                process.kill()
+
+    def run(self, directory, input_filename, initial_point_filename=None, timeout=None, show_output=False):
+        r"""
+        Runs the solver in directory, and returns an SDPSolverRun.
+
+        If ``timeout`` (in seconds) is not None and the solver takes longer than this, it is
+        killed and TimeoutError is raised. If the solver is cancelled, or the run is
+        interrupted, the solver is killed as well.
+        """
+        args = [self.command] + self.arguments(input_filename, initial_point_filename)
+        sys.stdout.write("Running SDP solver with command '%s'...\n" % " ".join(args))
+
+        result = SDPSolverRun(self.name, directory)
+        start_time = time.time()
+
+        self._process = subprocess.Popen(args, cwd=directory, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT, universal_newlines=True, start_new_session=True)
+        if self._cancelled.is_set():
+            self._kill()
+
+        # The output is read in another thread, so that the timeout can be enforced
+        # even when the solver prints nothing for a long time.
+        lines = queue.Queue()
+
+        def read_output(stream):
+            for line in stream:
+                lines.put(line)
+            lines.put(None)
+
+        reader = threading.Thread(target=read_output, args=(self._process.stdout,))
+        reader.daemon = True
+        reader.start()
+
+        output = []
+        try:
+            while True:
+                wait = None
+                if timeout is not None:
+                    wait = start_time + timeout - time.time()
+                    if wait <= 0:
+                        self._kill()
+                        raise TimeoutError("SDP solver %s did not finish within %s seconds." % (self.name, timeout))
+                try:
+                    line = lines.get(timeout=wait)
+                except queue.Empty:
+                    continue
+                if line is None:
+                    break
+                line = line.strip() + "\n"
+                output.append(line)
+                if show_output:
+                    sys.stdout.write(line)
+                value = self.objective_value(line)
+                if value is not None:
+                    result.objective_value = value
+                value = self.dual_objective_value(line)
+                if value is not None:
+                    result.dual_objective_value = value
+            self._process.wait()
+        except BaseException:
+            if self._process.poll() is None:
+                self._kill()
+                self._process.wait()
+            raise
+        finally:
+            reader.join(1)
+            self._process.stdout.close()
+
+        result.returncode = self._process.returncode
+        result.cancelled = self._cancelled.is_set()
+        result.output = "".join(output)
+        result.elapsed = time.time() - start_time
+        self._process = None
+
+        if not result.cancelled:
+            result.solution_filename = self.solution_filename(directory)
+            result.output_format = self.output_format
+
+        return result
+
+
+class SDPSolverRun(object):
+    r"""
+    The outcome of running an SDPSolver.
+    """
+
+    def __init__(self, solver_name, directory):
+        self.solver_name = solver_name
+        self.directory = directory
+        self.returncode = None
+        self.objective_value = None
+        self.dual_objective_value = None
+        self.output = ""
+        self.elapsed = None
+        self.cancelled = False
+        self.solution_filename = None
+        self.output_format = None
+
+    def succeeded(self):
+        return self.returncode == 0 and not self.cancelled
+
+    def gap(self):
+        r"""
+        Returns the relative gap between the primal and dual objective values, or None if
+        the solver did not report both.
+        """
+        if self.objective_value is None or self.dual_objective_value is None:
+            return None
+        p, d = float(self.objective_value), float(self.dual_objective_value)
+        return abs(p - d) / (1.0 + abs(p) + abs(d))
+
+    def read_solution(self, block_sizes):
+        r"""
+        Returns the SDPSolution written by the solver.
+        """
+        return read_sdp_solution(self.solution_filename, block_sizes, self.output_format)
+
+
+class CSDPSolver(SDPSolver):
+
+    name = "csdp"
+
+    def arguments(self, input_filename, initial_point_filename=None):
+        args = [input_filename, "sdp.out"]
+        if initial_point_filename is not None:
+            args.append(initial_point_filename)
+        return args
+
+    def objective_value(self, line):
+        if "Primal objective value:" in line:
+            return line.split()[-1]
+
+    def dual_objective_value(self, line):
+        if "Dual objective value:" in line:
+            return line.split()[-1]
+
+
+class DSDPSolver(SDPSolver):
+
+    name = "dsdp"
+
+    def arguments(self, input_filename, initial_point_filename=None):
+        return [input_filename, "-gaptol", "1e-18", "-print", "1", "-save", "sdp.out"]
+
+    def objective_value(self, line):
+        if "DSDP Solution" in line:
+            return line.split()[-1]
+
+
+class SDPASolver(SDPSolver):
+
+    name = "sdpa"
+
+    def __init__(self, command, name=None):
+        super(SDPASolver, self).__init__(command)
+        if name is not None:
+            self.name = name
+
+    def arguments(self, input_filename, initial_point_filename=None):
+        return ["-ds", input_filename, "-o", "sdpa.out"]
+
+    def objective_value(self, line):
+        if "objValPrimal" in line:
+            return line.split()[-1]
+
+    def dual_objective_value(self, line):
+        if "objValDual" in line:
+            return line.split()[-1]
+
+    output_format = "sdpa"
+
+    def solution_filename(self, directory):
+        return os.path.join(directory, "sdpa.out")
+
+
+def make_run_directory(parent):
+    r"""
+    Returns a new, empty directory inside parent, for the files of one solver run.
+    """
+    return tempfile.mkdtemp(prefix="run-", dir=parent)
+
+
+class SDPSolution(object):
+    r"""
+    A solution of an SDP with the given block sizes (negative sizes denote diagonal
+    blocks), using CSDP's conventions: y is the vector of the dual problem, X the
+    primal matrix and Z the dual slack matrix. X and Z are lists with a numpy array
+    for each block; diagonal blocks are stored as vectors.
+    """
+
+    def __init__(self, block_sizes):
+        self.block_sizes = list(block_sizes)
+        self.y = numpy.zeros(0)
+        self.Z = [numpy.zeros((b, b)) if b > 0 else numpy.zeros(-b) for b in self.block_sizes]
+        self.X = [numpy.zeros((b, b)) if b > 0 else numpy.zeros(-b) for b in self.block_sizes]
+
+    def _add_entries(self, data):
+        r"""
+        Stores rows (matrix, block, row, column, value) read from a CSDP solution file.
+        """
+        matrices = data[:, 0].astype(numpy.int64)
+        blocks = data[:, 1].astype(numpy.int64)
+        keep = ((matrices == 1) | (matrices == 2)) & (blocks >= 1) & (blocks <= len(self.block_sizes))
+        data, matrices, blocks = data[keep], matrices[keep], blocks[keep]
+
+        keys = matrices * (len(self.block_sizes) + 1) + blocks
+        order = numpy.argsort(keys, kind="stable")
+        keys = keys[order]
+        starts = numpy.flatnonzero(numpy.concatenate([[True], keys[1:] != keys[:-1]]))
+        ends = numpy.concatenate([starts[1:], [len(keys)]])
+
+        for start, end in zip(starts, ends):
+            rows = data[order[start:end]]
+            target = self.X if rows[0, 0] == 2 else self.Z
+            block = target[int(rows[0, 1]) - 1]
+            j = rows[:, 2].astype(numpy.int64) - 1
+            k = rows[:, 3].astype(numpy.int64) - 1
+            if block.ndim == 1:
+                block[j] = rows[:, 4]
+            else:
+                block[j, k] = rows[:, 4]
+                block[k, j] = rows[:, 4]
+
+
+def read_csdp_solution(filename, block_sizes, chunk_size=2 ** 22):
+    r"""
+    Reads a solution file in CSDP's format. The file is read in chunks of about
+    ``chunk_size`` bytes, each of which is converted to numbers in one go.
+    """
+    solution = SDPSolution(block_sizes)
+    with open(filename, "r") as f:
+        solution.y = numpy.array(f.readline().split(), dtype=numpy.float64)
+        while True:
+            lines = f.readlines(chunk_size)
+            if len(lines) == 0:
+                break
+            data = numpy.array("".join(lines).split(), dtype=numpy.float64)
+            solution._add_entries(data.reshape(-1, 5))
+    return solution
+
+
+sdpa_separators = str.maketrans("{},", "   ")
+
+
+def read_sdpa_solution(filename, block_sizes):
+    r"""
+    Reads the xVec, xMat and yMat sections of an output file written by SDPA. In CSDP's
+    conventions these are y, Z and X respectively.
+
+    Each line of a matrix section holds a row of a dense block, or the whole of a
+    diagonal block. Dense blocks are made symmetric using their upper triangle.
+    """
+    solution = SDPSolution(block_sizes)
+    targets = {"xVec": None, "xMat": solution.Z, "yMat": solution.X}
+    y = []
+
+    with open(filename, "r") as f:
+
+        section = None
+        for line in f:
+
+            if section is None:
+                name = line.split("=")[0].strip()
+                if name in targets and "=" in line:
+                    section, depth, bi, row = name, 0, -1, 0
+                continue
+
+            start_depth = depth
+            depth += line.count("{") - line.count("}")
+            values = numpy.array(line.translate(sdpa_separators).split(), dtype=numpy.float64)
+
+            if section == "xVec":
+                y.extend(values)
+
+            elif start_depth == 1 and "{" in line:
+                # a new block
+                bi += 1
+                row = 0
+                dense = line.lstrip()[1:].lstrip().startswith("{")
+                if bi < len(block_sizes) and len(values) > 0:
+                    block = targets[section][bi]
+                    if not dense:
+                        if block.ndim == 1:
+                            block[:len(values)] = values
+                        else:
+                            block[range(len(values)), range(len(values))] = values
+                    else:
+                        block[row, :len(values)] = values
+                        row += 1
+
+            elif start_depth == 2 and bi < len(block_sizes) and len(values) > 0:
+                targets[section][bi][row, :len(values)] = values
+                row += 1
+
+            if depth <= 0 and (start_depth > 0 or "}" in line):
+                section = None
+
+    solution.y = numpy.array(y, dtype=numpy.float64)
+    for blocks in (solution.X, solution.Z):
+        for bi in range(len(blocks)):
+            if blocks[bi].ndim == 2:
+                blocks[bi] = numpy.triu(blocks[bi]) + numpy.triu(blocks[bi], 1).T
+    return solution
+
+
+def read_sdp_solution(filename, block_sizes, output_format="csdp"):
+    r"""
+    Reads a solution file written by an SDP solver, in the format of CSDP ("csdp") or of
+    SDPA ("sdpa"), and returns an SDPSolution.
+    """
+    if output_format == "csdp":
+        return read_csdp_solution(filename, block_sizes)
+    elif output_format == "sdpa":
+        return read_sdpa_solution(filename, block_sizes)
+    else:
+        raise ValueError("unknown solution format.")